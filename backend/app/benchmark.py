@@ -0,0 +1,850 @@
+"""
+Copyright (C) 2020 Mauro Riva
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+import os
+import sys
+import pickle
+import socket
+import struct
+import argparse
+import tempfile
+import time
+import threading
+import cv2
+import numpy as np
+
+from blur_detection import dwt
+from blur_detection import focus_metrics
+from focus import get_focus_score
+from frames import FrameRing
+from capture import FileCapture
+from obj_detector import (
+    DETECTION_DTYPE,
+    ENCODING_FRAMEBUS,
+    PROTOCOL_MAGIC,
+    PROTOCOL_VERSION,
+    REQUEST_HEADER,
+    RESPONSE_HEADER,
+    DetectionStage,
+    DetectorConnection,
+    FrameBus,
+    classify_objects,
+    encode_param,
+    recv_exactly,
+)
+from scoring import FocusScorer
+from tracker import ObjectTracker, box_iou
+from preview import MJPEGBroadcaster, preview_image
+from simulator import M5StackServer, SimulatedCamera, SimulatedLens
+
+resolutions = {"640x480": (480, 640), "1920x1080": (1080, 1920)}
+
+
+def synthetic_frame(shape, seed=0):
+    """Returns a reproducible textured grayscale frame of the given shape."""
+    rng = np.random.RandomState(seed)
+    frame = rng.randint(0, 256, shape).astype(np.uint8)
+    return cv2.GaussianBlur(frame, (5, 5), 1.0)
+
+
+def timeit(func, *args, repeat=10):
+    """Returns the best wall time (in seconds) of ``repeat`` calls to func."""
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func(*args)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def reference_low_res_score(X, N=3):
+    """Per-tap DWT score as originally implemented in blur_detection.dwt
+    (rowdec with symmetric index extension, float64). Kept as the
+    regression reference for the vectorized engine.
+    """
+    h = np.array([-1, 2, 6, 2, -1]) / 8
+    m2 = h.size // 2
+
+    def rowdec(X):
+        c = X.shape[1]
+        xe = np.array(
+            [
+                x
+                for y in [range(m2, 0, -1), range(c), range(c - 2, c - m2 - 2, -1)]
+                for x in y
+            ]
+        )
+        t = np.array(range(0, c - 1, 2))
+        Y = np.zeros((X.shape[0], t.size))
+        for i in range(h.size):
+            Y = Y + h[i] * X[:, xe[t + i]]
+        return Y
+
+    score = np.var(X)
+    X = np.asarray(X, dtype=np.float64)
+    for _ in range(N):
+        X = rowdec(rowdec(X).T).T
+        score += np.var(X)
+    return score
+
+
+def bench_dwt(args):
+    for name, shape in resolutions.items():
+        frame = synthetic_frame(shape)
+
+        expected = reference_low_res_score(frame)
+        score = dwt.low_res_score(frame)
+        rel_err = abs(score - expected) / abs(expected)
+        if rel_err > 1e-5:
+            print(f"dwt {name}: MISMATCH {score} != {expected}")
+            return 1
+
+        t_ref = timeit(reference_low_res_score, frame, repeat=args.repeat)
+        t_new = timeit(dwt.low_res_score, frame, repeat=args.repeat)
+        print(
+            f"dwt {name}: reference {t_ref * 1e3:.2f} ms  "
+            f"vectorized {t_new * 1e3:.2f} ms  "
+            f"speedup {t_ref / t_new:.1f}x  rel_err {rel_err:.1e}"
+        )
+    return 0
+
+
+def bench_metrics(args):
+    for name, shape in resolutions.items():
+        frame = synthetic_frame(shape)
+        for dtype in (np.uint8, np.float32):
+            roi = frame.astype(dtype)
+            timings = "  ".join(
+                f"{metric} {timeit(func, roi, repeat=args.repeat) * 1e6:.0f}"
+                for metric, func in focus_metrics.items()
+            )
+            print(f"metrics {name} {np.dtype(dtype).name} [us/frame]: {timings}")
+    return 0
+
+
+def bench_rois(args):
+    shape = resolutions["1920x1080"]
+    frame = cv2.cvtColor(synthetic_frame(shape), cv2.COLOR_GRAY2BGR)
+    rng = np.random.RandomState(0)
+    for count in (1, 2, 8, 12, 16, 32):
+        # overlapping object-sized boxes around the centre of the frame
+        centres = rng.randint(600, 1300, (count, 1)), rng.randint(300, 700, (count, 1))
+        sizes = rng.randint(150, 500, (count, 2))
+        rois = np.hstack([centres[0], centres[1], centres[0], centres[1]])
+        rois[:, :2] -= sizes // 2
+        rois[:, 2:] += sizes // 2
+        for metric in ("tenengrad", "laplacian", "brenner"):
+
+            def per_roi():
+                return [
+                    get_focus_score(frame[y0:y1, x0:x1], metric)
+                    for x0, y0, x1, y1 in rois
+                ]
+
+            t_crop = timeit(per_roi, repeat=args.repeat)
+            t_batch = timeit(get_focus_score, frame, metric, rois, repeat=args.repeat)
+            print(
+                f"rois 1920x1080 {len(rois)} x {metric}: per-roi crops "
+                f"{t_crop * 1e3:.2f} ms  get_focus_scores {t_batch * 1e3:.2f} ms"
+            )
+    return 0
+
+
+def reference_generate(state):
+    """Per-client MJPEG generator as originally implemented in server.py:
+    every client encodes the shared frame itself under the global lock, as
+    fast as it can.
+    """
+    while True:
+        with state["lock"]:
+            flag, encoded_image = cv2.imencode(".jpg", state["frame"])
+        yield (
+            b"--frame\r\n"
+            b"Content-Type: image/jpeg\r\n\r\n" + bytearray(encoded_image) + b"\r\n"
+        )
+
+
+def run_viewers(update, generators, duration=2.0, fps=30):
+    """Feeds 640x480 frames at fps to update() while one thread per generator
+    consumes it. Returns the CPU time used and the chunks every viewer got.
+    """
+    frames = [
+        cv2.cvtColor(synthetic_frame((480, 640), seed), cv2.COLOR_GRAY2BGR)
+        for seed in range(4)
+    ]
+    received = [0] * len(generators)
+    stop = threading.Event()
+
+    def view(index, generator):
+        for part in generator:
+            received[index] += 1
+            if stop.is_set():
+                break
+        generator.close()
+
+    viewers = [
+        threading.Thread(target=view, args=(i, g)) for i, g in enumerate(generators)
+    ]
+    cpu = time.process_time()
+    for viewer in viewers:
+        viewer.start()
+    for i in range(int(duration * fps)):
+        update(frames[i % len(frames)])
+        time.sleep(1.0 / fps)
+    stop.set()
+    update(frames[0])
+    for viewer in viewers:
+        viewer.join()
+    return time.process_time() - cpu, received
+
+
+def bench_preview(args):
+    # per-frame cost of the preview in box mode: the original full-resolution
+    # copy + overlay + encode against the downscaled preview
+    frame = cv2.cvtColor(synthetic_frame(resolutions["1920x1080"]), cv2.COLOR_GRAY2BGR)
+
+    def full_resolution():
+        frame_draw = frame.copy()
+        cv2.rectangle(frame_draw, (900, 500), (1000, 600), (0, 255, 0), 2)
+        return cv2.imencode(".jpg", frame_draw)[1]
+
+    def downscaled(width=640, quality=80):
+        frame_draw, scale = preview_image(frame, width, draw=True)
+        cv2.rectangle(frame_draw, (300, 166), (333, 200), (0, 255, 0), 2)
+        return cv2.imencode(".jpg", frame_draw, [cv2.IMWRITE_JPEG_QUALITY, quality])[1]
+
+    for name, func, width in (
+        ("full resolution", full_resolution, None),
+        ("640 px", downscaled, 640),
+    ):
+        copied = preview_image(frame, width, draw=True)[0].nbytes
+        print(
+            f"preview 1920x1080 {name}: {timeit(func, repeat=args.repeat) * 1e3:.2f} "
+            f"ms/frame  {copied / 1e6:.1f} MB copied  {func().nbytes / 1e3:.0f} kB"
+        )
+
+    for count in (1, 5, 20):
+        state = {"lock": threading.Lock(), "frame": None}
+
+        def update(image):
+            with state["lock"]:
+                state["frame"] = image
+
+        update(cv2.cvtColor(synthetic_frame((480, 640)), cv2.COLOR_GRAY2BGR))
+        cpu_ref, received_ref = run_viewers(
+            update, [reference_generate(state) for _ in range(count)]
+        )
+
+        broadcaster = MJPEGBroadcaster().start()
+        cpu, received = run_viewers(
+            broadcaster.update, [broadcaster.frames() for _ in range(count)]
+        )
+        broadcaster.stop()
+        print(
+            f"preview 640x480 30 fps {count} viewers: per-client encode "
+            f"{cpu_ref:.2f} s cpu, {np.mean(received_ref):.0f} frames/viewer  "
+            f"broadcast {cpu:.2f} s cpu, {np.mean(received):.0f} frames/viewer, "
+            f"{broadcaster.encoded} encodes"
+        )
+    return 0
+
+
+def run_exchange(write, read, frames, readers=3):
+    """Writes the frames as fast as possible while reader threads fetch the
+    latest one every 0.5 ms. Returns the writer time per frame and the 99th
+    percentile of the read latency, in seconds.
+    """
+    latencies = []
+    done = threading.Event()
+
+    def reader():
+        samples = []
+        while not done.is_set():
+            start = time.perf_counter()
+            read()
+            samples.append(time.perf_counter() - start)
+            time.sleep(0.0005)
+        latencies.extend(samples)
+
+    threads = [threading.Thread(target=reader) for _ in range(readers)]
+    for thread in threads:
+        thread.start()
+    start = time.perf_counter()
+    for image in frames:
+        write(image)
+    elapsed = time.perf_counter() - start
+    done.set()
+    for thread in threads:
+        thread.join()
+    return elapsed / len(frames), np.percentile(latencies, 99)
+
+
+def bench_exchange(args):
+    for name, shape in resolutions.items():
+        frames = [
+            cv2.cvtColor(synthetic_frame(shape, seed), cv2.COLOR_GRAY2BGR)
+            for seed in range(4)
+        ] * 25
+
+        # original exchange: a copy per frame under the global lock
+        lock = threading.Lock()
+        shared = [frames[0]]
+
+        def write_locked(image):
+            with lock:
+                shared[0] = image.copy()
+
+        def read_locked():
+            with lock:
+                return shared[0]
+
+        ring = FrameRing()
+        ring.write(frames[0])
+        t_lock, p_lock = run_exchange(write_locked, read_locked, frames)
+        t_ring, p_ring = run_exchange(ring.write, ring.latest, frames)
+        print(
+            f"exchange {name}: lock + copy {t_lock * 1e3:.2f} ms/frame, "
+            f"read p99 {p_lock * 1e6:.0f} us  ring {t_ring * 1e3:.2f} ms/frame, "
+            f"read p99 {p_ring * 1e6:.0f} us"
+        )
+    return 0
+
+
+def bench_capture(args, duration=2.0):
+    frames = [
+        cv2.cvtColor(synthetic_frame((480, 640), seed), cv2.COLOR_GRAY2BGR)
+        for seed in range(4)
+    ]
+
+    def stage(image):
+        # per-frame work of the capture loop in box mode
+        preview, scale = preview_image(image, 640, draw=True)
+        cv2.rectangle(preview, (300, 200), (400, 300), (0, 255, 0), 2)
+
+    for mode in ("polling", "next_frame"):
+        source = FileCapture(frames, fps=30).start()
+        source.next_frame()
+        runs, seq = 0, -1
+        cpu = time.process_time()
+        end = time.monotonic() + duration
+        while time.monotonic() < end:
+            if mode == "polling":
+                # original loop: read() returns the same frame until a new one
+                image = source.read()
+            else:
+                latest = source.next_frame(seq)
+                if latest is None:
+                    continue
+                seq, timestamp, image = latest
+            stage(image)
+            runs += 1
+        cpu = time.process_time() - cpu
+        source.stop()
+        print(
+            f"capture 640x480 30 fps {mode}: {runs / duration:.0f} stage runs/s "
+            f"for {source.frames / duration:.0f} frames/s, {cpu / duration:.2f} s cpu/s"
+        )
+    return 0
+
+
+def recv_pickled(sock):
+    # original framing of both ends: ">L" size, pickle, data += recv()
+    data = b""
+    payload_size = struct.calcsize(">L")
+    while len(data) < payload_size:
+        chunk = sock.recv(4096)
+        if not chunk:  # the original loops forever on a closed socket
+            raise ConnectionError
+        data += chunk
+    msg_size = struct.unpack(">L", data[:payload_size])[0]
+    data = data[payload_size:]
+    while len(data) < msg_size:
+        data += sock.recv(4096)
+    return pickle.loads(data[:msg_size], fix_imports=True, encoding="bytes")
+
+
+def pickle_detector(sock, framebus, input_size, detections):
+    # detector side as in objdetector/app/restapi.py before the binary format
+    try:
+        while True:
+            frame = recv_pickled(sock)
+            frame = cv2.imdecode(frame, cv2.COLOR_BGR2RGB)
+            cv2.resize(frame, input_size).tobytes()
+            data = pickle.dumps(detections, 0)
+            sock.sendall(struct.pack(">L", len(data)) + data)
+    except (OSError, struct.error):
+        pass
+
+
+def binary_detector(sock, framebus, input_size, detections, latency=0.0):
+    # detector side as in objdetector/app/restapi.py, inference replaced by
+    # a sleep of latency seconds
+    records = np.zeros(len(detections), DETECTION_DTYPE)
+    for record, detection in zip(records, detections):
+        for key, value in detection.items():
+            record[key] = value.encode() if key == "label" else value
+    header = bytearray(REQUEST_HEADER.size)
+    payload = bytearray(1 << 20)
+    try:
+        while True:
+            recv_exactly(sock, memoryview(header))
+            _, _, encoding, frame_id, _, _, size = REQUEST_HEADER.unpack(header)
+            if size > len(payload):
+                payload = bytearray(size)
+            recv_exactly(sock, memoryview(payload)[:size])
+            if encoding == ENCODING_FRAMEBUS:
+                (slot,) = struct.unpack_from(">H", payload)
+                framebus.slots[slot].tobytes()
+            else:
+                frame = np.frombuffer(payload, np.uint8, size)
+                frame = cv2.imdecode(frame, cv2.COLOR_BGR2RGB)
+                cv2.resize(frame, input_size).tobytes()
+            time.sleep(latency)
+            sock.sendall(
+                RESPONSE_HEADER.pack(
+                    PROTOCOL_MAGIC, PROTOCOL_VERSION, frame_id, len(records)
+                )
+                + records.tobytes()
+            )
+    except OSError:
+        pass
+
+
+def bench_detector(args, input_size=(300, 300)):
+    # round trip to the object detector over a socket pair, both ends
+    # without inference
+    detections = [
+        {"label": label, "percent": 80 + i, "x0": 10 * i, "x1": 100 + 10 * i}
+        for i, label in enumerate(("person", "teddy bear", "bird", "cup", "dog"))
+    ]
+    for detection in detections:
+        detection.update(y0=20, y1=200)
+
+    def pickle_request(sock, frame):
+        flag, frame_tmp = cv2.imencode(".jpg", frame, encode_param)
+        data = pickle.dumps(frame_tmp, 0)
+        sock.sendall(struct.pack(">L", len(data)) + data)
+        return recv_pickled(sock)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        framebus = FrameBus.create(os.path.join(tmp, "frames"), input_size)
+        for name, shape in resolutions.items():
+            frame = cv2.cvtColor(synthetic_frame(shape), cv2.COLOR_GRAY2BGR)
+            for protocol, detector in (
+                ("pickle jpeg", pickle_detector),
+                ("binary jpeg", binary_detector),
+                ("binary framebus", binary_detector),
+            ):
+                client, server = socket.socketpair()
+                thread = threading.Thread(
+                    target=detector,
+                    args=(server, framebus, input_size, detections),
+                    daemon=True,
+                )
+                thread.start()
+                if protocol == "pickle jpeg":
+                    func = lambda frame: pickle_request(client, frame)
+                elif protocol == "binary jpeg":
+                    func = DetectorConnection(client).detect
+                else:
+                    func = DetectorConnection(client, framebus).detect
+                if func(frame) != detections:
+                    print(f"detector {protocol}: wrong detections")
+                    return 1
+                print(
+                    f"detector {name} {protocol}: "
+                    f"{timeit(func, frame, repeat=args.repeat) * 1e3:.2f} ms/frame"
+                )
+                client.close()
+                thread.join()
+                server.close()
+    return 0
+
+
+def bench_detection(args, duration=2.0):
+    # preview loop in object mode with a detector answering after latency
+    frames = [
+        cv2.cvtColor(synthetic_frame((480, 640), seed), cv2.COLOR_GRAY2BGR)
+        for seed in range(4)
+    ]
+    detections = [
+        {
+            "label": "teddy bear",
+            "percent": 90,
+            "x0": 100,
+            "y0": 80,
+            "x1": 300,
+            "y1": 400,
+        }
+    ]
+    for latency in (0.02, 0.1):
+        for mode in ("blocking", "stage"):
+            client, server = socket.socketpair()
+            threading.Thread(
+                target=binary_detector,
+                args=(server, None, (300, 300), detections, latency),
+                daemon=True,
+            ).start()
+            source = FileCapture(frames, fps=30).start()
+            tracker = ObjectTracker()
+            stage = DetectionStage(
+                DetectorConnection(client), tracker, ring=source.ring
+            ).start()
+
+            runs, seq = 0, -1
+            end = time.monotonic() + duration
+            while time.monotonic() < end:
+                latest = source.next_frame(seq)
+                if latest is None:
+                    continue
+                seq, timestamp, image = latest
+                if mode == "blocking":
+                    # original loop: detect every frame before the preview
+                    classify_objects(stage.detector, image, tracker, timestamp)
+                else:
+                    stage.submit(seq, image, timestamp)
+                preview, scale = preview_image(image, 640, draw=True)
+                for obj in tracker.predict(timestamp, image.shape[1::-1]):
+                    cv2.rectangle(
+                        preview,
+                        (obj["x0"], obj["y0"]),
+                        (obj["x1"], obj["y1"]),
+                        (0, 255, 0),
+                        2,
+                    )
+                runs += 1
+            stage.stop()
+            source.stop()
+            client.close()
+            objects = tracker.objects()
+            if [obj["label"] for obj in objects] != ["teddy bear"]:
+                print(f"detection {mode}: wrong detections {objects}")
+                return 1
+            detected = stage.submitted if mode == "stage" else runs
+            print(
+                f"detection {latency * 1e3:.0f} ms detector {mode}: "
+                f"preview {runs / duration:.1f} fps, "
+                f"{detected / duration:.1f} detections/s"
+            )
+    return 0
+
+
+def reference_merge_objects(new_objs, obj_detector):
+    """Detections merged into the object list as originally implemented in
+    obj_detector.classify_objects (first object with the same label).
+    """
+    for obj in new_objs:
+        obj_temp = next(
+            (
+                (idx, item)
+                for idx, item in enumerate(obj_detector)
+                if item["label"] == obj["label"]
+            ),
+            False,
+        )
+        if not obj_temp:
+            obj["selected"] = False
+            obj["added"] = time.time_ns()
+            obj_detector.append(obj)
+        else:
+            obj_detector[obj_temp[0]]["x0"] = obj["x0"]
+            obj_detector[obj_temp[0]]["x1"] = obj["x1"]
+            obj_detector[obj_temp[0]]["y0"] = obj["y0"]
+            obj_detector[obj_temp[0]]["y1"] = obj["y1"]
+            obj_detector[obj_temp[0]]["added"] = time.time_ns()
+
+    for idx, obj in enumerate(obj_detector):
+        if obj["added"] < time.time_ns() - 2e9:
+            obj_detector.pop(idx)
+
+
+def bench_tracker(args, fps=30.0, duration=4.0):
+    # two people walking across a 1920x1080 frame at 30 fps, detected every
+    # few frames; the ROIs are compared with the true boxes on every frame.
+    # "hold" keeps the tracks at their last detection, "predict" moves them
+    rng = np.random.RandomState(0)
+
+    def people(t):
+        return [
+            (200 + 300 * t, 300, 400 + 300 * t, 800),
+            (1500 - 250 * t, 250 + 40 * t, 1700 - 250 * t, 750 + 40 * t),
+        ]
+
+    def detect(t):
+        boxes = np.array(people(t)) + rng.normal(0, 3, (2, 4))
+        return [
+            dict(
+                zip(("x0", "y0", "x1", "y1"), box.astype(int).tolist()),
+                label="person",
+                percent=90,
+            )
+            for box in boxes
+        ]
+
+    def rois(objects):
+        return [(o["x0"], o["y0"], o["x1"], o["y1"]) for o in objects]
+
+    frames = int(duration * fps)
+    for every in (1, 3, 6):
+        for mode in ("original", "hold", "predict"):
+            objects, tracker = [], ObjectTracker()
+            ious, elapsed = [], 0.0
+            for index in range(frames):
+                t = index / fps
+                if index % every == 0:
+                    detections = detect(t)
+                    start = time.perf_counter()
+                    if mode == "original":
+                        reference_merge_objects(detections, objects)
+                    else:
+                        tracker.update(detections, t)
+                    elapsed += time.perf_counter() - start
+                if mode == "original":
+                    current = rois(objects)
+                elif mode == "hold":
+                    current = rois(tracker.objects())
+                else:
+                    current = rois(tracker.predict(t))
+                ious.extend(
+                    max(box_iou(box, roi) for roi in current) for box in people(t)
+                )
+            if mode != "original" and len(tracker.objects()) != 2:
+                print(f"tracker: {len(tracker.objects())} tracks for 2 people")
+                return 1
+            print(
+                f"tracker every {every} frames {mode}: "
+                f"{frames / every / duration:.0f} detections/s, "
+                f"mean IoU {np.mean(ious):.2f}, min IoU {np.min(ious):.2f}, "
+                f"update {elapsed / -(-frames // every) * 1e6:.0f} us"
+            )
+    return 0
+
+
+def drift_livefocus(server, lens, after=6.0, shift=150):
+    # live focus while the focus plane moves by shift steps after some time
+    drift = threading.Timer(
+        after, lambda: setattr(lens, "focus_position", lens.focus_position + shift)
+    )
+    drift.start()
+    try:
+        server.livefocus()
+    finally:
+        drift.cancel()
+
+
+# focus strategies of server.py, called with the module and the lens
+focus_strategies = {
+    "autofocus": lambda server, lens: server.autofocus(),
+    "pipelined": lambda server, lens: server.pipelined_autofocus(),
+    "sweep": lambda server, lens: server.sweep_autofocus(),
+    "scan": lambda server, lens: server.scan_autofocus(),
+    "livefocus": lambda server, lens: server.livefocus(),
+    "livefocus_drift": lambda server, lens: drift_livefocus(server, lens),
+    "hill_climbing": lambda server, lens: server.hill_climbing(
+        metric=server.coarse_metric
+    ),
+    "fibonacci_search": lambda server, lens: server.fibonacci_search(
+        (lens.position - 400, lens.position + 400), server.fine_metric
+    ),
+}
+
+
+def run_focus_strategy(strategy, position, focus_position, time_limit=10.0):
+    """Runs a focus strategy of server.py against the simulated rig: a lens
+    behind the M5Stack stand-in HTTP server and a synthetic camera. Strategies
+    that keep running (livefocus) are stopped after time_limit seconds.
+
+    Returns:
+        [dict]: time-to-focus, motor moves, status requests, frames scored
+                and final focus error (in motor steps)
+    """
+    import server
+
+    lens = SimulatedLens(position=position, focus_position=focus_position)
+    m5stack = M5StackServer({"focus": lens, "aperture": SimulatedLens()}).start()
+    camera = SimulatedCamera(lens, ring=server.frame_ring)
+
+    server.m5stack_host = m5stack.host
+    server.focus_config["focus_type"] = "image"
+    server.focus_scorer = FocusScorer(ring=server.frame_ring)
+    server.start_camera(camera)
+    streaming = threading.Thread(target=server.video_streaming)
+    streaming.start()
+
+    server.focus_break = False
+    focusing = threading.Thread(
+        target=focus_strategies[strategy], args=(server, lens), daemon=True
+    )
+    start = time.perf_counter()
+    focusing.start()
+    focusing.join(time_limit)
+    server.focus_break = True
+    focusing.join()
+    elapsed = time.perf_counter() - start
+
+    streaming.do_run = False
+    streaming.join()
+    camera.stop()
+    m5stack.stop()
+    server.focus_scorer.shutdown()
+    return {
+        "time": elapsed,
+        "moves": lens.moves,
+        "status": lens.status_requests,
+        "requests": m5stack.requests,
+        "frames": server.focus_scorer.scored,
+        "error": abs(lens.position - lens.focus_position),
+    }
+
+
+def bench_still(args, fps=30.0):
+    # preview blackout while the photo service takes a reference photo and
+    # four brackets: camera handed over as originally (preview stopped,
+    # camera released, photos taken by the photo service, preview restarted
+    # once the status poll sees the photos) and stills from the live stream
+    frames = [
+        cv2.cvtColor(synthetic_frame((480, 640), seed), cv2.COLOR_GRAY2BGR)
+        for seed in range(4)
+    ]
+    shutters = [None, 1 / 250, 1 / 125, 1 / 30, 1 / 15]
+    ring = FrameRing()
+    status = 0
+
+    for mode in ("release", "still"):
+        arrivals = []
+        done = threading.Event()
+
+        def watch():
+            # preview side: time of every new frame in the ring
+            seq = -1
+            while not done.is_set():
+                latest = ring.latest()
+                if latest is not None and latest[0] != seq:
+                    seq = latest[0]
+                    arrivals.append(time.monotonic())
+                time.sleep(0.002)
+
+        source = FileCapture(frames, fps, ring=ring, auto_exposure=1 / 60).start()
+        source.next_frame(timeout=5.0)
+        watcher = threading.Thread(target=watch, daemon=True)
+        watcher.start()
+        time.sleep(0.2)
+
+        start = time.monotonic()
+        if mode == "release":
+            time.sleep(0.5)
+            source.stop()
+            time.sleep(0.5)
+            time.sleep(args.photo_capture)
+            # status polled every 100 ms, 0.5 s pause, camera reopened
+            time.sleep(0.05 + 0.5)
+            source = FileCapture(frames, fps, ring=ring).start()
+            source.next_frame(timeout=5.0)
+        else:
+            photos = [source.still(shutter)[1:] for shutter in shutters]
+            source.request_exposure(None)
+        elapsed = time.monotonic() - start
+        time.sleep(0.2)
+        done.set()
+        watcher.join()
+        source.stop()
+
+        during = [t for t in arrivals if start <= t <= start + elapsed]
+        gaps = np.diff(
+            [t for t in arrivals if start - 0.1 <= t <= start + elapsed + 0.1]
+        )
+        print(
+            f"still {mode}: photos to preview back {elapsed:.2f} s, longest "
+            f"preview gap {gaps.max() * 1e3:.0f} ms, {len(during)} preview frames "
+            f"of {elapsed * fps:.0f}"
+        )
+
+        if mode == "still":
+            (auto, auto_exposure), (short, short_exposure) = photos[:2]
+            ratio = short.mean() / auto.mean()
+            expected = short_exposure / auto_exposure
+            if abs(ratio - expected) > 0.02 or gaps.max() > 3 / fps:
+                print(
+                    f"still: exposure ratio {ratio:.3f} instead of {expected:.3f}, "
+                    f"preview gap {gaps.max() * 1e3:.0f} ms"
+                )
+                status = 1
+    return status
+
+
+def bench_autofocus(args):
+    for position, focus_position in ((1500, 1234), (800, 2100)):
+        for strategy in args.strategies.split(","):
+            result = run_focus_strategy(strategy, position, focus_position)
+            print(
+                f"autofocus {position}->{focus_position} {strategy}: "
+                f"{result['time']:.2f} s  moves {result['moves']}  "
+                f"status {result['status']}  requests {result['requests']}  "
+                f"frames {result['frames']}  "
+                f"error {result['error']:.0f} steps"
+            )
+    return 0
+
+
+benchmarks = {
+    "dwt": bench_dwt,
+    "metrics": bench_metrics,
+    "rois": bench_rois,
+    "preview": bench_preview,
+    "exchange": bench_exchange,
+    "capture": bench_capture,
+    "detector": bench_detector,
+    "detection": bench_detection,
+    "tracker": bench_tracker,
+    "still": bench_still,
+    "autofocus": bench_autofocus,
+}
+
+
+if __name__ == "__main__":
+    assert sys.version_info >= (3, 6), sys.version_info
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "benchmark",
+        nargs="*",
+        default=list(benchmarks),
+        help="benchmarks to run: {0} (default: all)".format(", ".join(benchmarks)),
+    )
+    parser.add_argument(
+        "--repeat", type=int, default=10, help="repetitions per measurement"
+    )
+    parser.add_argument(
+        "--photo-capture",
+        type=float,
+        default=2.5,
+        help="seconds the photo service needs the camera in the still benchmark",
+    )
+    parser.add_argument(
+        "--strategies",
+        default=",".join(focus_strategies),
+        help="comma separated focus strategies for the autofocus benchmark",
+    )
+    args = parser.parse_args()
+
+    for name in args.benchmark:
+        if name not in benchmarks:
+            parser.error(f"unknown benchmark: {name}")
+
+    status = 0
+    for name in args.benchmark:
+        status |= benchmarks[name](args)
+    sys.exit(status)
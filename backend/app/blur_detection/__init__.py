@@ -4,3 +4,8 @@
 from .detection import fix_image_size
 from .detection import estimate_blur
 from .detection import pretty_blur_map
+from .metrics import focus_metric
+from .metrics import focus_metrics
+from .metrics import get_focus_metric
+from .metrics import batch_focus_metric
+from .metrics import get_focus_scores
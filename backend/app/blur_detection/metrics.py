@@ -0,0 +1,187 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import cv2
+import numpy
+
+from . import dwt
+
+focus_metrics = {}
+batch_focus_metrics = {}
+
+
+def focus_metric(name: str):
+    """Register a focus metric under ``name``. A focus metric takes a 2-D
+    grayscale image (uint8 or float32) and returns a float that increases
+    with sharpness.
+    """
+
+    def register(func):
+        focus_metrics[name] = func
+        return func
+
+    return register
+
+
+def batch_focus_metric(name: str, min_rois: int, min_overlap: float):
+    """Register the batched version of the focus metric ``name``. It takes a
+    2-D grayscale image and an (N, 4) int array of (x0, y0, x1, y1) boxes and
+    returns the N scores, sharing the per-pixel work between the boxes.
+
+    The batched version computes its per-pixel map on the bounding box of
+    all boxes, so it only pays off for many overlapping boxes: it is used
+    for at least ``min_rois`` boxes whose summed areas reach
+    ``min_overlap`` times the bounding box area (measured with
+    ``benchmark.py rois``).
+    """
+
+    def register(func):
+        batch_focus_metrics[name] = (func, min_rois, min_overlap)
+        return func
+
+    return register
+
+
+def get_focus_metric(name: str):
+    try:
+        return focus_metrics[name]
+    except KeyError:
+        raise ValueError(
+            f"unknown focus metric '{name}', choose from: {', '.join(focus_metrics)}"
+        )
+
+
+def get_focus_scores(image: numpy.array, rois, name: str):
+    """Score every (x0, y0, x1, y1) box of ``rois`` on the image (grayscale
+    or BGR).
+
+    When there are many boxes that overlap enough, the image is cut to the
+    bounding box of all boxes and converted to grayscale once, and the
+    batched metric computes its per-pixel map once and reads every score
+    from integral images. Otherwise (or for metrics without a batched
+    version) each box is cut and scored on its own.
+
+    Boxes narrower or lower than MIN_ROI_SIZE pixels once clipped to the
+    image, e.g. outside of it, score 0.
+    """
+    metric = get_focus_metric(name)
+    batch, min_rois, min_overlap = batch_focus_metrics.get(name, (None, 0, 0))
+    if batch is not None and len(rois) >= min_rois:
+        boxes = clip_rois(rois, image.shape)
+        valid = (boxes[:, 2] - boxes[:, 0] >= MIN_ROI_SIZE) & (
+            boxes[:, 3] - boxes[:, 1] >= MIN_ROI_SIZE
+        )
+        if valid.sum() >= min_rois:
+            x0, y0 = boxes[valid, 0].min(), boxes[valid, 1].min()
+            x1, y1 = boxes[valid, 2].max(), boxes[valid, 3].max()
+            if _box_areas(boxes[valid]).sum() >= min_overlap * (x1 - x0) * (y1 - y0):
+                scores = numpy.zeros(len(boxes), dtype=numpy.float64)
+                scores[valid] = batch(
+                    _gray(image[y0:y1, x0:x1]),
+                    boxes[valid] - numpy.array([x0, y0, x0, y0]),
+                )
+                return scores
+
+    # a few boxes: clipped in Python, cheaper than the array bookkeeping
+    height, width = image.shape[:2]
+    scores = numpy.zeros(len(rois), dtype=numpy.float64)
+    for idx, (x0, y0, x1, y1) in enumerate(rois):
+        x0, x1 = min(max(int(x0), 0), width), min(max(int(x1), 0), width)
+        y0, y1 = min(max(int(y0), 0), height), min(max(int(y1), 0), height)
+        if x1 - x0 >= MIN_ROI_SIZE and y1 - y0 >= MIN_ROI_SIZE:
+            scores[idx] = metric(_gray(image[y0:y1, x0:x1]))
+    return scores
+
+
+def _gray(image: numpy.array):
+    return cv2.cvtColor(image, cv2.COLOR_BGR2GRAY) if image.ndim == 3 else image
+
+
+# smallest box side every metric can score: the DWT halves the box at each
+# of its 3 levels
+MIN_ROI_SIZE = 8
+
+
+def clip_rois(rois, shape):
+    """Returns the boxes as an (N, 4) int array clipped to the image shape."""
+    boxes = numpy.array(rois, dtype=numpy.int64).reshape(-1, 4)
+    boxes[:, 0::2] = numpy.clip(boxes[:, 0::2], 0, shape[1])
+    boxes[:, 1::2] = numpy.clip(boxes[:, 1::2], 0, shape[0])
+    return boxes
+
+
+def _box_sums(integral: numpy.array, boxes: numpy.array):
+    """Sums of the image inside each box, read from its integral image."""
+    x0, y0, x1, y1 = boxes.T
+    return integral[y1, x1] - integral[y0, x1] - integral[y1, x0] + integral[y0, x0]
+
+
+def _box_areas(boxes: numpy.array):
+    x0, y0, x1, y1 = boxes.T
+    return numpy.maximum((x1 - x0) * (y1 - y0), 1).astype(numpy.float64)
+
+
+@focus_metric("dwt")
+def dwt_score(image: numpy.array):
+    return dwt.low_res_score(image)
+
+
+@focus_metric("laplacian")
+def laplacian_variance(image: numpy.array):
+    laplacian = cv2.Laplacian(image, cv2.CV_32F)
+    _, stddev = cv2.meanStdDev(laplacian)
+    return float(stddev[0, 0] ** 2)
+
+
+@batch_focus_metric("laplacian", min_rois=12, min_overlap=1.8)
+def batch_laplacian_variance(image: numpy.array, boxes: numpy.array):
+    laplacian = cv2.Laplacian(image, cv2.CV_32F)
+    sums, sqsums = cv2.integral2(laplacian, sdepth=cv2.CV_64F, sqdepth=cv2.CV_64F)
+    areas = _box_areas(boxes)
+    mean = _box_sums(sums, boxes) / areas
+    return _box_sums(sqsums, boxes) / areas - mean * mean
+
+
+def _gradient_energy(image: numpy.array):
+    gx = cv2.Sobel(image, cv2.CV_32F, 1, 0)
+    gy = cv2.Sobel(image, cv2.CV_32F, 0, 1)
+    gx *= gx
+    gy *= gy
+    gx += gy
+    return gx
+
+
+@focus_metric("tenengrad")
+def tenengrad(image: numpy.array):
+    return float(cv2.mean(_gradient_energy(image))[0])
+
+
+@batch_focus_metric("tenengrad", min_rois=12, min_overlap=1.8)
+def batch_tenengrad(image: numpy.array, boxes: numpy.array):
+    sums = cv2.integral(_gradient_energy(image), sdepth=cv2.CV_64F)
+    return _box_sums(sums, boxes) / _box_areas(boxes)
+
+
+def _brenner_energy(image: numpy.array):
+    diff = cv2.subtract(image[:, 2:], image[:, :-2], dtype=cv2.CV_32F)
+    return cv2.multiply(diff, diff)
+
+
+@focus_metric("brenner")
+def brenner(image: numpy.array):
+    return float(cv2.mean(_brenner_energy(image))[0])
+
+
+@batch_focus_metric("brenner", min_rois=16, min_overlap=2.7)
+def batch_brenner(image: numpy.array, boxes: numpy.array):
+    # the difference map is two columns narrower than the image
+    boxes = boxes.copy()
+    boxes[:, 2] = numpy.maximum(boxes[:, 2] - 2, boxes[:, 0])
+    sums = cv2.integral(_brenner_energy(image), sdepth=cv2.CV_64F)
+    return _box_sums(sums, boxes) / _box_areas(boxes)
+
+
+@focus_metric("normvar")
+def normalized_variance(image: numpy.array):
+    mean, stddev = cv2.meanStdDev(image)
+    mean = max(float(mean[0, 0]), 1e-6)
+    return float(stddev[0, 0] ** 2) / mean
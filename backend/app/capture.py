@@ -0,0 +1,354 @@
+"""
+Copyright (C) 2020 Mauro Riva
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+import time
+import logging
+import threading
+import cv2
+import numpy as np
+
+from frames import FrameRing
+
+
+class CaptureSource:
+    """Camera running on its own thread that writes every new frame into a
+    FrameRing and wakes up the consumers.
+
+    Consumers call next_frame(seq), which blocks until a frame newer than
+    seq arrived, so every stage downstream runs exactly once per captured
+    frame. Subclasses implement capture(buffer): grab one frame, if
+    possible straight into buffer (the ring slot to fill, None until the
+    frame shape is known), and return it with its capture timestamp
+    (time.monotonic() clock), or (None, None) when the source is exhausted.
+
+    Still photos are taken from the running stream (see still()), so the
+    preview keeps running while the photo service takes its photos.
+    Subclasses that control the exposure implement set_exposure() and
+    exposure().
+    """
+
+    # camera model, part of the calibration key of the photo service
+    sensor = "unknown"
+    # frame rate, None if unknown
+    fps = None
+    # frames captured before a new exposure takes effect
+    exposure_delay = 0
+
+    def __init__(self, ring=None):
+        self.ring = ring if ring is not None else FrameRing()
+        self.stopped = False
+        self.frames = 0
+        self._cond = threading.Condition()
+        self._latest = None
+        self._thread = None
+        self._frame_time = None
+        self._exposure_request = None
+        self._exposure_seq = None
+        self._exposure_error = None
+        # exposure time of the frames being captured, None for automatic
+        self._shutter = None
+        self._still_lock = threading.Lock()
+
+    def capture(self, buffer):
+        raise NotImplementedError
+
+    def set_exposure(self, shutter, iso=None):
+        """Changes the exposure of the next frames, called on the capture
+        thread.
+
+        Args:
+            shutter ([float]): exposure time in seconds, None for automatic
+            iso ([int]): sensor sensitivity, None to leave it
+        """
+        raise NotImplementedError(f"{type(self).__name__} has a fixed exposure")
+
+    def exposure(self):
+        """Returns the exposure time of the latest frame in seconds, None if
+        the source does not know it.
+        """
+        return None
+
+    def request_exposure(self, shutter=None, iso=None):
+        """Changes the exposure from another thread: it is applied by the
+        capture thread before the next frame.
+        """
+        with self._cond:
+            self._exposure_seq = self._exposure_error = None
+            self._exposure_request = (shutter, iso)
+
+    def still(self, shutter=None, iso=None, timeout=2.0):
+        """Takes a still photo without stopping the stream: the exposure
+        changes for the next frames, and the first frame captured with it is
+        returned. The exposure stays until the next request.
+
+        Args:
+            shutter ([float]): exposure time in seconds, None for automatic
+            iso ([int]): sensor sensitivity, None to leave it
+            timeout ([float]): maximal waiting time per frame in seconds, on
+                               top of the exposure times of the frames
+                               captured until the new exposure applies
+
+        Returns:
+            [tuple]: (timestamp, copy of the frame, exposure time in seconds
+                     or None if unknown)
+        """
+        with self._still_lock:
+            # long exposures lower the frame rate, for the frame being
+            # captured and for the ones of the new exposure
+            longest = max(shutter or 0.0, self._shutter or 0.0)
+            timeout += max(self.exposure_delay, 1) * longest
+            self.request_exposure(shutter, iso)
+            with self._cond:
+                self._cond.wait_for(
+                    lambda: self.stopped
+                    or self._exposure_seq is not None
+                    or self._exposure_error is not None,
+                    timeout,
+                )
+                if self._exposure_seq is None:
+                    raise IOError(f"cannot change the exposure: {self._exposure_error}")
+                seq = self._exposure_seq + self.exposure_delay - 1
+            while True:
+                latest = self.next_frame(seq, timeout)
+                if latest is None:
+                    raise IOError("no frame from the camera")
+                seq, timestamp, frame = latest
+                image = np.array(frame)
+                if self.ring.valid(seq):
+                    exposure = shutter if shutter is not None else self.exposure()
+                    return timestamp, image, exposure
+
+    def pace(self, fps):
+        """Sleeps until the next frame is due at fps (1 / fps after the
+        previous one), like a camera that delivers frames at its own rate.
+        Late frames are not caught up.
+        """
+        now = time.monotonic()
+        due = now if self._frame_time is None else self._frame_time + 1.0 / fps
+        self._frame_time = max(due, now - 1.0 / fps)
+        time.sleep(max(self._frame_time - now, 0.0))
+
+    def close(self):
+        """Releases the device, called on the capture thread when stopping."""
+
+    def start(self):
+        self._thread = threading.Thread(
+            target=self._run, name=type(self).__name__, daemon=True
+        )
+        self._thread.start()
+        return self
+
+    def _run(self):
+        shape = dtype = None
+        try:
+            while not self.stopped:
+                if self._exposure_request is not None:
+                    self._apply_exposure()
+                buffer = self.ring.claim(shape, dtype) if shape else None
+                image, timestamp = self.capture(buffer)
+                if image is None:
+                    break
+                if image is not buffer:
+                    np.copyto(self.ring.claim(image.shape, image.dtype), image)
+                    shape, dtype = image.shape, image.dtype
+
+                latest = self.ring.commit(timestamp)
+                with self._cond:
+                    self._latest = latest
+                    self.frames += 1
+                    self._cond.notify_all()
+        finally:
+            self.close()
+            with self._cond:
+                self.stopped = True
+                self._cond.notify_all()
+
+    def _apply_exposure(self):
+        with self._cond:
+            request, self._exposure_request = self._exposure_request, None
+        try:
+            self.set_exposure(*request)
+            self._shutter = request[0]
+        except Exception as e:
+            logging.error(f"cannot change the exposure: {e}")
+            with self._cond:
+                self._exposure_error = e
+                self._cond.notify_all()
+            return
+        latest = self.ring.latest()
+        with self._cond:
+            # the next frame is the first one captured with the new exposure
+            self._exposure_seq = latest[0] + 1 if latest is not None else 0
+            self._cond.notify_all()
+
+    def next_frame(self, seq=-1, timeout=1.0):
+        """Waits for the first frame newer than seq.
+
+        Args:
+            seq ([int]): sequence number of the last frame processed
+            timeout ([float]): maximal waiting time in seconds
+
+        Returns:
+            [tuple]: (seq, timestamp, read-only frame), None on timeout or
+                     once the source stopped
+        """
+        with self._cond:
+            self._cond.wait_for(
+                lambda: self.stopped
+                or (self._latest is not None and self._latest[0] > seq),
+                timeout,
+            )
+            if self._latest is None or self._latest[0] <= seq:
+                return None
+            return self._latest
+
+    def read(self):
+        """Returns the latest frame without waiting (None before the first)."""
+        latest = self._latest
+        return latest[2] if latest is not None else None
+
+    def stop(self):
+        """Stops the capture thread and waits until the device is released."""
+        self.stopped = True
+        thread = self._thread
+        if thread is not None and thread is not threading.current_thread():
+            thread.join()
+
+
+class OpenCVCapture(CaptureSource):
+    """Camera or video file read with cv2.VideoCapture.
+
+    The frames are decoded straight into the ring buffers. The capture
+    timestamp is the driver's buffer timestamp when it is on the
+    time.monotonic() clock (V4L2 cameras), otherwise the time the frame was
+    grabbed. The exposure is set with the V4L2 controls; exposures longer
+    than the frame time lower the frame rate until the automatic exposure
+    is back.
+
+    Args:
+        src ([int, str]): camera index or video file / stream URL
+        width, height ([int]): requested resolution, None for the default
+        fps ([float]): requested frame rate, None for the default
+        ring ([FrameRing]): ring to write the frames into
+    """
+
+    # the sensor pipeline applies new exposure settings a few frames later
+    exposure_delay = 3
+
+    def __init__(self, src=0, width=None, height=None, fps=None, ring=None):
+        super().__init__(ring)
+        self.stream = cv2.VideoCapture(src)
+        if not self.stream.isOpened():
+            raise IOError(f"cannot open camera {src}")
+        self.sensor = f"{self.stream.getBackendName()}:{src}"
+        for prop, value in (
+            (cv2.CAP_PROP_FRAME_WIDTH, width),
+            (cv2.CAP_PROP_FRAME_HEIGHT, height),
+            (cv2.CAP_PROP_FPS, fps),
+        ):
+            if value:
+                self.stream.set(prop, value)
+        width = int(self.stream.get(cv2.CAP_PROP_FRAME_WIDTH))
+        height = int(self.stream.get(cv2.CAP_PROP_FRAME_HEIGHT))
+        self.fps = fps = self.stream.get(cv2.CAP_PROP_FPS)
+        logging.info(f"camera {src}: {width}x{height} at {fps} fps")
+
+    def capture(self, buffer):
+        ok, image = self.stream.read(buffer)
+        now = time.monotonic()
+        if not ok:
+            return None, None
+        timestamp = self.stream.get(cv2.CAP_PROP_POS_MSEC) / 1e3
+        if abs(timestamp - now) > 1.0:
+            timestamp = now
+        return image, timestamp
+
+    def set_exposure(self, shutter, iso=None):
+        if shutter is None:
+            self.stream.set(cv2.CAP_PROP_AUTO_EXPOSURE, 3)  # V4L2 automatic
+            if self.fps:
+                self.stream.set(cv2.CAP_PROP_FPS, self.fps)
+        else:
+            self.stream.set(cv2.CAP_PROP_AUTO_EXPOSURE, 1)  # V4L2 manual
+            if self.fps and shutter > 1.0 / self.fps:
+                self.stream.set(cv2.CAP_PROP_FPS, 1.0 / shutter)
+            # V4L2 exposure_time_absolute, in 100 us
+            self.stream.set(cv2.CAP_PROP_EXPOSURE, shutter * 1e4)
+        if iso is not None:
+            self.stream.set(cv2.CAP_PROP_ISO_SPEED, iso)
+
+    def exposure(self):
+        exposure = self.stream.get(cv2.CAP_PROP_EXPOSURE)
+        return exposure / 1e4 if exposure > 0 else None
+
+    def close(self):
+        self.stream.release()
+
+
+class FileCapture(CaptureSource):
+    """Replays a video file or a list of images at a fixed frame rate, e.g.
+    to run the backend and the benchmarks without a camera. The frames are
+    taken as exposed auto_exposure seconds, other exposures scale them.
+    Like a camera, exposures longer than the frame time lower the frame
+    rate.
+
+    Args:
+        frames ([str, list]): video file path, or list of BGR images
+        fps ([float]): playback frame rate
+        loop ([bool]): start over at the end instead of stopping
+        ring ([FrameRing]): ring to write the frames into
+        auto_exposure ([float]): exposure time of the frames in seconds
+    """
+
+    sensor = "file"
+
+    def __init__(self, frames, fps=30.0, loop=True, ring=None, auto_exposure=1 / 60):
+        super().__init__(ring)
+        if isinstance(frames, str):
+            stream = cv2.VideoCapture(frames)
+            frames = []
+            while True:
+                ok, image = stream.read()
+                if not ok:
+                    break
+                frames.append(image)
+            stream.release()
+        if not frames:
+            raise ValueError("no frames to replay")
+        self.images = frames
+        self.fps = fps
+        self.loop = loop
+        self.auto_exposure = auto_exposure
+        self.gain = 1.0
+
+    def capture(self, buffer):
+        index = self.frames % len(self.images) if self.loop else self.frames
+        if index >= len(self.images):
+            return None, None
+
+        shutter = self._shutter
+        self.pace(min(self.fps, 1.0 / shutter) if shutter else self.fps)
+        image = self.images[index]
+        if self.gain != 1.0:
+            image = cv2.convertScaleAbs(image, alpha=self.gain)
+        return image, time.monotonic()
+
+    def set_exposure(self, shutter, iso=None):
+        self.gain = shutter / self.auto_exposure if shutter else 1.0
+
+    def exposure(self):
+        return self.auto_exposure * self.gain
@@ -17,29 +17,50 @@ along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
 import cv2
 import numpy as np
-from blur_detection import dwt
-from blur_detection import estimate_blur
+from blur_detection import get_focus_metric, get_focus_scores
 
 phi = 0.5 * (1 + 5 ** 0.5)  # Golden ratio
 
 
-def get_focus_score(focus_frame):
+def get_focus_score(focus_frame, metric="dwt", rois=None):
     """Returns a score that provide information about
     how focused is the provided camera frame
 
     Args:
         focus_frame ([numpy.ndarray]): camera frame
+        metric ([str]): name of the focus metric (see blur_detection.focus_metrics)
+        rois ([list]): optional (x0, y0, x1, y1) boxes to score in one pass;
+                       the frame is converted to grayscale only once
 
     Returns:
-        [int]: how focused is the provided camera frame
+        [float]: how focused is the provided camera frame, or
+        [numpy.ndarray]: one score per box if rois is given
     """
+    if rois is not None:
+        return get_focus_scores(focus_frame, rois, metric)
+
     if focus_frame.ndim == 3:
         focus_frame = cv2.cvtColor(focus_frame, cv2.COLOR_BGR2GRAY)
 
-    score = dwt.low_res_score(focus_frame)
+    score = get_focus_metric(metric)(focus_frame)
     return score
 
 
+def weighted_focus_score(scores, weights=None):
+    """Combines the per-ROI scores returned by get_focus_score(..., rois)
+    into the single value the focus search climbs on.
+
+    Args:
+        scores ([numpy.ndarray]): score of each ROI
+        weights ([list]): relative weight of each ROI (default: equal)
+
+    Returns:
+        [float]: weighted mean of the scores
+    """
+    weights = None if weights is None or not np.any(weights) else weights
+    return float(np.average(scores, weights=weights))
+
+
 def gaussian_fitting(z, f):
     """Fit the autofocus function data according to the equation 16.5 in the
     textbook : 'Microscope Image Processing' by Q.Wu et al'
@@ -92,6 +113,58 @@ def parabola_fitting(z, f):
         )
 
 
+def peak_fitting(z, f, model="gaussian", level=0.5):
+    """Least-squares fit of the peak of a whole (position, score) trace.
+    Only the points around the highest (3-point median filtered) score that
+    are above
+    min + level * (max - min) take part in the fit, which removes the flat
+    tails of the focus curve. The gaussian model fits a parabola to log(f),
+    the parabola model fits f directly. Points with a residual above
+    3 median absolute deviations are dropped and the fit is repeated once.
+
+    Args:
+        z ([numpy.ndarray]): motor positions
+        f ([numpy.ndarray]): focus scores measured at z
+        model ([str]): "gaussian" or "parabola"
+        level ([float]): relative score threshold of the fitted points
+
+    Returns:
+        [float]: position of the peak
+    """
+    z = np.asarray(z, dtype=np.float64)
+    f = np.asarray(f, dtype=np.float64)
+    order = np.argsort(z)
+    z, f = z[order], f[order]
+
+    # contiguous run of points above the threshold around the best score,
+    # located on the median filtered trace so single spikes are ignored
+    smooth = np.median([np.r_[f[:1], f[:-1]], f, np.r_[f[1:], f[-1:]]], axis=0)
+    best = int(np.argmax(smooth))
+    above = smooth >= smooth.min() + level * (smooth.max() - smooth.min())
+    lo = best - np.argmin(above[best::-1]) + 1 if not above[: best + 1].all() else 0
+    hi = best + np.argmin(above[best:]) if not above[best:].all() else len(f)
+    z, f = z[lo:hi], f[lo:hi]
+
+    if len(np.unique(z)) < 3 or (model == "gaussian" and f.min() <= 0):
+        return float(z[np.argmax(f)])
+
+    y = np.log(f) if model == "gaussian" else f
+    keep = np.ones(len(z), dtype=bool)
+    for _ in range(2):
+        coeffs = np.polyfit(z[keep], y[keep], 2)
+        residuals = np.abs(np.polyval(coeffs, z) - y)
+        mad = np.median(residuals[keep])
+        outliers = residuals > 3 * mad if mad > 0 else np.zeros(len(z), dtype=bool)
+        if not outliers.any() or (~outliers).sum() < 3:
+            break
+        keep = ~outliers
+
+    a, b = coeffs[0], coeffs[1]
+    if a >= 0:  # no maximum
+        return float(z[np.argmax(f)])
+    return float(np.clip(-b / (2 * a), z.min(), z.max()))
+
+
 def fibs(n=None):
     """A generator, (thanks to W.J.Earley) that returns the fibonacci series """
     a, b = 0, 1
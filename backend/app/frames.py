@@ -0,0 +1,207 @@
+"""
+Copyright (C) 2020 Mauro Riva
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+import time
+import threading
+import numpy as np
+from collections import OrderedDict, deque, namedtuple
+
+# seq: monotonic number of the captured camera frame
+# timestamp: time.monotonic() when the frame was captured
+# image: frame (or ROI view) to score, never modified after publishing
+# rois, weights: boxes scored on image in object mode, None otherwise
+FocusFrame = namedtuple("FocusFrame", "seq timestamp image rois weights")
+
+
+class FrameRing:
+    """Sequence-numbered ring of preallocated frame buffers, shared by the
+    capture, scoring and streaming threads without locks.
+
+    The capture thread is the only writer: it claims the next buffer, fills
+    it in place and commits it. A commit is a single reference assignment,
+    so readers never wait for the writer and never see a partly written
+    frame. Readers get read-only views of the buffers instead of copies. A
+    buffer is overwritten len(ring) frames later; readers that keep a frame
+    for longer check valid(seq) once they are done with it.
+    """
+
+    def __init__(self, slots=8):
+        self._buffers = [None] * slots
+        self._seqs = [-1] * slots
+        self._next = 0
+        self._latest = None
+        self.overruns = 0
+
+    def __len__(self):
+        return len(self._buffers)
+
+    def claim(self, shape, dtype=np.uint8):
+        """Returns the buffer to write the next frame into. It is only
+        reallocated when the frame shape changes.
+        """
+        idx = self._next % len(self._buffers)
+        self._seqs[idx] = -1  # readers of the previous frame see it is gone
+        buffer = self._buffers[idx]
+        if buffer is None or buffer.shape != tuple(shape) or buffer.dtype != dtype:
+            buffer = self._buffers[idx] = np.empty(shape, dtype)
+        return buffer
+
+    def commit(self, timestamp=None):
+        """Publishes the claimed buffer as the latest frame.
+
+        Returns:
+            [tuple]: (seq, timestamp, read-only view of the frame)
+        """
+        seq = self._next
+        idx = seq % len(self._buffers)
+        view = self._buffers[idx].view()
+        view.flags.writeable = False
+        self._seqs[idx] = seq
+        self._next = seq + 1
+        self._latest = (seq, time.monotonic() if timestamp is None else timestamp, view)
+        return self._latest
+
+    def write(self, image, timestamp=None):
+        """Copies a frame into the next buffer and commits it."""
+        np.copyto(self.claim(image.shape, image.dtype), image)
+        return self.commit(timestamp)
+
+    def latest(self):
+        """Returns (seq, timestamp, frame) of the latest frame, or None."""
+        return self._latest
+
+    def valid(self, seq):
+        """True if frame seq has not been overwritten (yet)."""
+        if self._seqs[seq % len(self._buffers)] == seq:
+            return True
+        self.overruns += 1
+        return False
+
+
+class FrameStore:
+    """Holds the latest focus frame and lets callers wait for a newer one."""
+
+    def __init__(self):
+        self._cond = threading.Condition()
+        self._frame = None
+        self._subscribers = []
+
+    def publish(self, focus_frame):
+        """Replaces the latest frame and wakes up the waiting callers.
+
+        Args:
+            focus_frame ([FocusFrame]): frame to hand over to the focus search
+        """
+        with self._cond:
+            self._frame = focus_frame
+            subscribers = list(self._subscribers)
+            self._cond.notify_all()
+
+        for callback in subscribers:
+            callback(focus_frame)
+
+    def subscribe(self, callback):
+        """Calls callback(focus_frame) from the publishing thread for every
+        published frame, e.g. to score all frames captured during a sweep.
+        The same frame can be published more than once (see FocusFrame.seq).
+        """
+        with self._cond:
+            self._subscribers.append(callback)
+
+    def unsubscribe(self, callback):
+        with self._cond:
+            self._subscribers.remove(callback)
+
+    def latest(self):
+        """Returns the latest FocusFrame (None before the first frame)."""
+        return self._frame
+
+    def wait_after(self, timestamp, timeout=1.0):
+        """Waits for the first frame captured at or after timestamp, e.g.
+        the first frame after the motor settled.
+
+        Args:
+            timestamp ([float]): time.monotonic() reference
+            timeout ([float]): maximal waiting time in seconds
+
+        Returns:
+            [FocusFrame]: the new frame, or the latest one on timeout
+        """
+        with self._cond:
+            self._cond.wait_for(
+                lambda: self._frame is not None and self._frame.timestamp >= timestamp,
+                timeout,
+            )
+            return self._frame
+
+
+class ScoreCache:
+    """Small thread-safe LRU of focus scores keyed by (seq, rois, metric).
+    The ROI part of the key includes the ROI weights.
+    """
+
+    def __init__(self, maxsize=32):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._scores = OrderedDict()
+
+    @staticmethod
+    def key(focus_frame, metric):
+        rois = focus_frame.rois
+        if rois is not None:
+            rois = (
+                tuple(tuple(int(v) for v in roi) for roi in rois),
+                tuple(focus_frame.weights or ()),
+            )
+        return (focus_frame.seq, rois, metric)
+
+    def get(self, key):
+        with self._lock:
+            if key not in self._scores:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._scores.move_to_end(key)
+            return self._scores[key]
+
+    def put(self, key, score):
+        with self._lock:
+            self._scores[key] = score
+            self._scores.move_to_end(key)
+            while len(self._scores) > self.maxsize:
+                self._scores.popitem(last=False)
+
+
+class FrameRate:
+    """Frames per second over a sliding time window."""
+
+    def __init__(self, window=2.0):
+        self.window = window
+        self._ticks = deque()
+
+    def tick(self):
+        now = time.monotonic()
+        self._ticks.append(now)
+        while self._ticks and self._ticks[0] < now - self.window:
+            self._ticks.popleft()
+
+    def rate(self):
+        now = time.monotonic()
+        ticks = [t for t in list(self._ticks) if t >= now - self.window]
+        return len(ticks) / self.window
@@ -15,23 +15,322 @@ You should have received a copy of the GNU General Public License
 along with this program.  If not, see <https://www.gnu.org/licenses/>.
 """
 
+import json
+import time
+import asyncio
+import logging
+import threading
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import NewConnectionError
+
+
+class RoundTripHistogram:
+    """Histogram of request round-trip times in milliseconds."""
+
+    buckets = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000)
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.total = 0.0
+
+    def add(self, seconds):
+        ms = seconds * 1e3
+        idx = next(
+            (i for i, edge in enumerate(self.buckets) if ms <= edge), len(self.buckets)
+        )
+        with self._lock:
+            self.counts[idx] += 1
+            self.total += ms
+
+    def summary(self):
+        """Returns the count, the mean and the bucket counts (key: upper
+        edge in ms) of the recorded round trips.
+        """
+        with self._lock:
+            count = sum(self.counts)
+            edges = [f"<={edge}" for edge in self.buckets] + [f">{self.buckets[-1]}"]
+            return {
+                "count": count,
+                "mean_ms": self.total / count if count else 0.0,
+                "histogram_ms": dict(zip(edges, self.counts)),
+            }
+
+
+def _not_sent(error):
+    """True if a request failed before it reached the board."""
+    reason = getattr(error.args[0], "reason", None) if error.args else None
+    return isinstance(error, requests.ConnectTimeout) or isinstance(
+        reason, NewConnectionError
+    )
+
+
+class MotorClient:
+    """Client of the M5Stack stepper-motor API.
+
+    Requests go through one keep-alive session with a timeout. Failed
+    requests are retried with exponential backoff; moves are only retried
+    when the connection could not be established, so a step is never sent
+    twice. The timeout of a move grows by step_time per step, as the board
+    only answers once the motor stopped; a move that still times out raises
+    requests.Timeout, since the position of the motor is then unknown. The
+    last status of every motor is cached and updated with the position
+    returned by each move.
+
+    Firmware that implements the batched protocol (/goto for absolute moves
+    answering with the motor status, /batch for a queue of absolute moves)
+    is detected on first use; otherwise absolute moves are turned into
+    relative ones from the current position, read from the board since the
+    cached one may be stale after a timeout or a move by another client.
+
+    Args:
+        host ([str]): M5Stack address
+        timeout ([float]): request timeout in seconds
+        retries ([int]): retries of a failed request
+        backoff ([float]): wait before the first retry in seconds
+        step_time ([float]): longest travel time of the motors per step
+    """
+
+    def __init__(self, host, timeout=5.0, retries=3, backoff=0.05, step_time=5e-3):
+        self.host = host
+        self.timeout = timeout
+        self.step_time = step_time
+        self.retries = retries
+        self.backoff = backoff
+        self.round_trips = RoundTripHistogram()
+        self.session = requests.Session()
+        self.session.mount("http://", HTTPAdapter(pool_connections=1, pool_maxsize=4))
+        self._status = {}
+        self.batched = None  # unknown until the first absolute move
+
+    def _get(self, path, idempotent=True, timeout=None):
+        for attempt in range(self.retries + 1):
+            try:
+                start = time.perf_counter()
+                r = self.session.get(
+                    f"http://{self.host}{path}", timeout=timeout or self.timeout
+                )
+                r.raise_for_status()
+                self.round_trips.add(time.perf_counter() - start)
+                return r.json()
+            except requests.RequestException as e:
+                rejected = isinstance(e, requests.HTTPError) and (
+                    e.response.status_code < 500
+                )
+                if (
+                    attempt == self.retries
+                    or rejected
+                    or not (idempotent or _not_sent(e))
+                ):
+                    raise
+                logging.warning(f"motor request {path} failed ({e}), retrying")
+                time.sleep(self.backoff * 2**attempt)
+
+    def _move_timeout(self, steps):
+        return self.timeout + abs(steps) * self.step_time
+
+    def _lost(self, mtype, error):
+        # the move may still be running: the next status is read again
+        self._status.pop(mtype, None)
+        logging.error(f"moving the {mtype} motor timed out: {error}")
+        raise error
+
+    def move(self, mtype, step, mdir):
+        """Moves a motor step steps towards mdir (0: backwards, 1: forwards).
+
+        Returns:
+            [tuple]: (done, position) reported by the motor
+        """
+        try:
+            data = self._get(
+                f"/move/{mtype}/{step}/{mdir}",
+                idempotent=False,
+                timeout=self._move_timeout(step),
+            )
+            done = data["status"] == "true"
+            position = data["position"]
+        except requests.Timeout as e:
+            self._lost(mtype, e)
+        except (requests.RequestException, ValueError, KeyError) as e:
+            logging.error(f"moving the {mtype} motor failed: {e}")
+            return False, self._status.get(mtype, {}).get("position", 0)
+
+        if mtype in self._status:
+            self._status[mtype] = dict(self._status[mtype], position=position)
+        return done, position
+
+    def move_to(self, mtype, position):
+        """Moves a motor to an absolute position. With the batched protocol
+        this is one request answered with the new status, and since it is
+        idempotent it is retried like a status request.
+
+        Returns:
+            [tuple]: (done, position) reported by the motor
+        """
+        position = max(int(position), 0)
+        if self.batched is not False:
+            # the farthest the motor may have to travel
+            steps = max(position, self.status(mtype, cached=True)["max_steps"])
+            try:
+                status = self._get(
+                    f"/goto/{mtype}/{position}", timeout=self._move_timeout(steps)
+                )
+                self.batched = True
+                done = status.pop("status") == "true"
+                self._status[mtype] = status
+                return done, status["position"]
+            except requests.HTTPError as e:
+                if e.response.status_code != 404 or self.batched:
+                    logging.error(f"moving the {mtype} motor failed: {e}")
+                    return False, self._status.get(mtype, {}).get("position", 0)
+                logging.info("motor firmware without /goto, using relative moves")
+                self.batched = False
+            except requests.Timeout as e:
+                self._lost(mtype, e)
+            except (requests.RequestException, ValueError, KeyError) as e:
+                logging.error(f"moving the {mtype} motor failed: {e}")
+                return False, self._status.get(mtype, {}).get("position", 0)
+
+        status = self.status(mtype)
+        step = min(position, status["max_steps"]) - status["position"]
+        return self.move(mtype, abs(step), 0 if step < 0 else 1)
+
+    def move_batch(self, mtype, positions, settle=0.0, dwell=0.0, callback=None):
+        """Moves a motor through a list of absolute positions in one request.
+        The firmware waits settle seconds after every move, signals the
+        reached position (callback(index, done, position) is called as soon
+        as the signal arrives) and holds it for dwell seconds, e.g. to let
+        the camera capture a frame, before the next move.
+
+        Args:
+            mtype ([str]): motor type (focus, aperture)
+            positions ([list]): absolute target positions
+            settle ([float]): wait after each move before signalling
+            dwell ([float]): hold time after each signal
+            callback ([callable]): called for every reached position
+
+        Returns:
+            [list]: (done, position) of every target
+        """
+        positions = [max(int(p), 0) for p in positions]
+        if self.batched is None:
+            # probe the protocol with an absolute move to the current position
+            self.move_to(mtype, self.status(mtype)["position"])
+        if not self.batched:
+            return self._move_sequence(mtype, positions, settle, dwell, callback)
+
+        targets = ",".join(str(p) for p in positions)
+        query = f"settle={int(settle * 1e3)}&dwell={int(dwell * 1e3)}"
+        # the longest wait between two lines: a move, its settle and dwell
+        steps = self.status(mtype, cached=True)["max_steps"]
+        reached = []
+        start = time.perf_counter()
+        try:
+            with self.session.get(
+                f"http://{self.host}/batch/{mtype}/{targets}?{query}",
+                timeout=self._move_timeout(steps) + settle + dwell,
+                stream=True,
+            ) as r:
+                r.raise_for_status()
+                # read byte-wise, every line is a signal to pass on at once
+                for line in r.iter_lines(chunk_size=1):
+                    data = json.loads(line)
+                    if "index" not in data:  # final status of the motor
+                        self._status[mtype] = data
+                        break
+                    reached.append((data["status"] == "true", data["position"]))
+                    if mtype in self._status:
+                        self._status[mtype]["position"] = data["position"]
+                    if callback is not None:
+                        callback(data["index"], *reached[-1])
+        except requests.Timeout as e:
+            self._lost(mtype, e)
+        except (requests.RequestException, ValueError, KeyError) as e:
+            logging.error(f"batched move of the {mtype} motor failed: {e}")
+        self.round_trips.add(time.perf_counter() - start)
+        return reached
+
+    def _move_sequence(self, mtype, positions, settle, dwell, callback):
+        reached = []
+        for index, position in enumerate(positions):
+            reached.append(self.move_to(mtype, position))
+            time.sleep(settle)
+            if callback is not None:
+                callback(index, *reached[-1])
+            time.sleep(dwell)
+        return reached
+
+    def status(self, mtype, cached=False):
+        """Returns the motor status (position, max_steps, calibrated).
+
+        Args:
+            mtype ([str]): motor type (focus, aperture)
+            cached ([bool]): answer from the cache if a status is known; the
+                             cached position follows every move
+        """
+        if cached and mtype in self._status:
+            return dict(self._status[mtype])
+        status = self._get(f"/status/{mtype}")
+        self._status[mtype] = status
+        return dict(status)
+
+
+class AsyncMotorClient:
+    """asyncio variant of MotorClient. The requests run on the default
+    executor, sharing the keep-alive session, cache and histogram of the
+    wrapped client.
+    """
+
+    def __init__(self, client):
+        self.client = client
+
+    async def move(self, mtype, step, mdir):
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(None, self.client.move, mtype, step, mdir)
+
+    async def move_to(self, mtype, position):
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(None, self.client.move_to, mtype, position)
+
+    async def move_batch(self, mtype, positions, settle=0.0, dwell=0.0):
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(
+            None, self.client.move_batch, mtype, positions, settle, dwell
+        )
+
+    async def status(self, mtype, cached=False):
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(None, self.client.status, mtype, cached)
+
+
+_clients = {}
+_clients_lock = threading.Lock()
+
+
+def get_motor_client(m5stack_host):
+    """Returns the shared MotorClient of a host."""
+    with _clients_lock:
+        if m5stack_host not in _clients:
+            _clients[m5stack_host] = MotorClient(m5stack_host)
+        return _clients[m5stack_host]
 
 
 def set_move_motor(m5stack_host, mtype, step, mdir):
-    try:
-        url = f"http://{m5stack_host}/move/{mtype}/{step}/{mdir}"
-        r = requests.get(url)
-        done = True if r.json()["status"] == "true" else False
-        position = r.json()["position"]
-    except:
-        done = False
-        position = 0
-
-    return done, position
-
-
-def get_motor_status(m5stack_host, mtype):
-    url = f"http://{m5stack_host}/status/{mtype}"
-    status = requests.get(url).json()
-    return status
+    return get_motor_client(m5stack_host).move(mtype, step, mdir)
+
+
+def move_motor_to(m5stack_host, mtype, position):
+    return get_motor_client(m5stack_host).move_to(mtype, position)
+
+
+def move_motor_batch(
+    m5stack_host, mtype, positions, settle=0.0, dwell=0.0, callback=None
+):
+    return get_motor_client(m5stack_host).move_batch(
+        mtype, positions, settle, dwell, callback
+    )
+
+
+def get_motor_status(m5stack_host, mtype, cached=False):
+    return get_motor_client(m5stack_host).status(mtype, cached)
@@ -15,92 +15,349 @@ You should have received a copy of the GNU General Public License
 along with this program.  If not, see <https://www.gnu.org/licenses/>.
 """
 
+import os
 import cv2
+import mmap
 import time
+import logging
+import threading
 import numpy as np
-import pickle
 import struct
 
 encode_param = [int(cv2.IMWRITE_JPEG_QUALITY), 90]
 
+# frame bus file, created by the object detector: header (magic, version,
+# slots, width, height) padded to FRAMEBUS_OFFSET bytes, followed by the
+# slots RGB frames of the model input size.
+FRAMEBUS_MAGIC = b"RPFB"
+FRAMEBUS_VERSION = 1
+FRAMEBUS_HEADER = struct.Struct("<4sHHHH")
+FRAMEBUS_OFFSET = 64
 
-def classify_objects(tpu_socket, frame, obj_detector):
+# detector wire format, see also objdetector/app/restapi.py. A request is
+# the header (magic, version, encoding, frame id, width and height of the
+# camera frame, payload size) followed by the payload: the JPEG image, or
+# the slot (uint16) of the frame bus. The answer is the header (magic,
+# version, frame id, number of detections) followed by the detections as
+# packed DETECTION_DTYPE records.
+PROTOCOL_MAGIC = b"RPFD"
+PROTOCOL_VERSION = 1
+ENCODING_JPEG = 0
+ENCODING_FRAMEBUS = 1
+REQUEST_HEADER = struct.Struct(">4sBBIHHI")
+RESPONSE_HEADER = struct.Struct(">4sBxIH")
+DETECTION_DTYPE = np.dtype(
+    [
+        ("label", "S32"),
+        ("percent", "u1"),
+        ("x0", ">i2"),
+        ("y0", ">i2"),
+        ("x1", ">i2"),
+        ("y1", ">i2"),
+    ]
+)
+
+
+class FrameBus:
+    """Shared-memory frame transport to an object detector on the same host.
+
+    The frames are resized to the model input size and converted to RGB
+    straight into a slot of the memory-mapped bus file (e.g. on a tmpfs
+    shared by both containers), and only a small request naming the slot
+    goes over the socket. The detector answers before the next request, so
+    two slots are enough.
+
+    Args:
+        path ([str]): bus file created by the object detector
+    """
+
+    def __init__(self, path):
+        with open(path, "r+b") as bus_file:
+            header = bus_file.read(FRAMEBUS_HEADER.size)
+            if len(header) < FRAMEBUS_HEADER.size:
+                raise ValueError(f"{path} is not a frame bus")
+            magic, version, slots, width, height = FRAMEBUS_HEADER.unpack(header)
+            if magic != FRAMEBUS_MAGIC or version != FRAMEBUS_VERSION:
+                raise ValueError(
+                    f"{path} is not a frame bus (version {FRAMEBUS_VERSION})"
+                )
+            frame_size = width * height * 3
+            length = FRAMEBUS_OFFSET + slots * frame_size
+            if os.fstat(bus_file.fileno()).st_size < length:
+                raise ValueError(f"frame bus {path} is shorter than its {slots} slots")
+            self._mmap = mmap.mmap(bus_file.fileno(), 0)
+
+        self.size = (width, height)
+        self.slots = [
+            np.ndarray(
+                (height, width, 3),
+                np.uint8,
+                buffer=self._mmap,
+                offset=FRAMEBUS_OFFSET + slot * frame_size,
+            )
+            for slot in range(slots)
+        ]
+        self._next = 0
+
+    @staticmethod
+    def create(path, size, slots=2):
+        """Creates a bus file for a model input size (width, height)."""
+        width, height = size
+        with open(path, "w+b") as bus_file:
+            bus_file.truncate(FRAMEBUS_OFFSET + slots * width * height * 3)
+            bus_file.write(
+                FRAMEBUS_HEADER.pack(
+                    FRAMEBUS_MAGIC, FRAMEBUS_VERSION, slots, width, height
+                )
+            )
+        return FrameBus(path)
+
+    def write(self, frame):
+        """Writes a BGR camera frame into the next slot and returns the slot."""
+        slot = self._next
+        self._next = (slot + 1) % len(self.slots)
+        view = self.slots[slot]
+        cv2.resize(frame, self.size, dst=view)
+        cv2.cvtColor(view, cv2.COLOR_BGR2RGB, dst=view)
+        return slot
+
+
+def recv_exactly(sock, view):
+    """Fills a memoryview from a socket, without intermediate copies."""
+    while view:
+        received = sock.recv_into(view)
+        if not received:
+            raise ConnectionError("object detector closed the connection")
+        view = view[received:]
+
+
+class DetectorConnection:
+    """Connection to the object detector service.
+
+    Frames are sent with the binary wire format above (JPEG, or the frame
+    bus for a detector on the same host) and tagged with a frame id that
+    the detector echoes with its detections.
+
+    Args:
+        sock ([socket.socket]): connected socket
+        framebus ([FrameBus]): shared-memory path to a local detector,
+                               None to send the frame as JPEG
+    """
+
+    def __init__(self, sock, framebus=None):
+        self.sock = sock
+        self.framebus = framebus
+        self.frame_id = 0
+        self._header = bytearray(RESPONSE_HEADER.size)
+        self._buffer = bytearray(16 * DETECTION_DTYPE.itemsize)
+
+    def send(self, frame):
+        """Sends a BGR camera frame and returns its frame id."""
+        self.frame_id = (self.frame_id + 1) % 2 ** 32
+        height, width = frame.shape[:2]
+        if self.framebus is not None:
+            encoding = ENCODING_FRAMEBUS
+            payload = struct.pack(">H", self.framebus.write(frame))
+        else:
+            encoding = ENCODING_JPEG
+            flag, payload = cv2.imencode(".jpg", frame, encode_param)
+        header = REQUEST_HEADER.pack(
+            PROTOCOL_MAGIC,
+            PROTOCOL_VERSION,
+            encoding,
+            self.frame_id,
+            width,
+            height,
+            len(payload),
+        )
+        self.sock.sendall(header)
+        self.sock.sendall(payload)
+        return self.frame_id
+
+    def receive(self):
+        """Waits for the next answer of the detector.
+
+        Returns:
+            [tuple]: frame id and detections (dicts with label, percent and
+                     the x0, y0, x1, y1 box in camera frame pixels)
+        """
+        recv_exactly(self.sock, memoryview(self._header))
+        magic, version, frame_id, count = RESPONSE_HEADER.unpack(self._header)
+        if magic != PROTOCOL_MAGIC or version != PROTOCOL_VERSION:
+            raise ConnectionError(f"unknown detector protocol {magic} {version}")
+
+        size = count * DETECTION_DTYPE.itemsize
+        if size > len(self._buffer):
+            self._buffer = bytearray(size)
+        recv_exactly(self.sock, memoryview(self._buffer)[:size])
+        records = np.frombuffer(self._buffer, DETECTION_DTYPE, count)
+        return frame_id, [
+            {
+                "label": record["label"].decode(errors="replace"),
+                "percent": int(record["percent"]),
+                "x0": int(record["x0"]),
+                "x1": int(record["x1"]),
+                "y0": int(record["y0"]),
+                "y1": int(record["y1"]),
+            }
+            for record in records
+        ]
+
+    def detect(self, frame):
+        """Sends a frame and waits for its detections."""
+        frame_id = self.send(frame)
+        answer_id, detections = self.receive()
+        if answer_id != frame_id:
+            raise ConnectionError(f"detections of frame {answer_id}, not {frame_id}")
+        return detections
+
+
+def classify_objects(detector, frame, tracker, timestamp=None):
     """Detect objects on the provided camera frame and
-    return its coordinates and label. To do that, it sends
-    the frame via UDP to the object detector service.
+    update the tracked objects with their coordinates and label. To do
+    that, it sends the frame to the object detector service.
 
     Args:
-        tpu_socket ([socket.socket]): socket to connect to the service
+        detector ([DetectorConnection]): connection to the service
         frame ([numpy.ndarray]): camera frame
-        obj_detector ([list]): list to return the label and coordinates 
-                               of detected objects
+        tracker ([ObjectTracker]): tracks of the detected objects
+        timestamp ([float]): capture time of the frame
     """
-    # encode the frame in JPEG format
-    flag, frame_tmp = cv2.imencode(".jpg", frame, encode_param)
-
-    data = b""
-    payload_size = struct.calcsize(">L")
+    tracker.update(detector.detect(frame), timestamp)
 
-    # send image to classify
-    data_udp = pickle.dumps(frame_tmp, 0)
-    size_udp = len(data_udp)
-    tpu_socket.sendall(struct.pack(">L", size_udp) + data_udp)
 
-    # receive labels and coordinates
-    while len(data) < payload_size:
-        data += tpu_socket.recv(4096)
+class DetectionStage:
+    """Runs the object detector as a pipeline stage on its own thread.
 
-    packed_msg_size = data[:payload_size]
-    data = data[payload_size:]
-    msg_size = struct.unpack(">L", packed_msg_size)[0]
+    The preview loop submits frames without waiting: a frame is only taken
+    when the detector is idle, at least every frames after the last
+    detected one and interval seconds after the last request, otherwise it
+    is skipped. The answer is matched to the submitted frame by its frame
+    id and passed to the tracker, which predicts the objects in between.
+    So the preview runs at the camera frame rate whatever the detector
+    latency.
 
-    while len(data) < msg_size:
-        data += tpu_socket.recv(4096)
+    If the frames live in a FrameRing, a frame overwritten while it was
+    sent is reported and its detections are dropped.
 
-    labels_data = data[:msg_size]
-    data = data[msg_size:]
+    Args:
+        detector ([DetectorConnection]): connection to the detector service
+        tracker ([ObjectTracker]): tracks of the detected objects
+        interval ([float]): minimal time between two requests in seconds
+        every ([int]): detect at most every that many camera frames
+        ring ([FrameRing]): ring holding the submitted frames
+    """
 
-    new_objs = pickle.loads(labels_data, fix_imports=True, encoding="bytes")
+    def __init__(self, detector, tracker, interval=0.0, every=1, ring=None):
+        self.detector = detector
+        self.tracker = tracker
+        self.interval = interval
+        self.every = every
+        self.ring = ring
+        self.submitted = 0
+        self.skipped = 0
+        self.dropped = 0
+        self.latency = 0.0
+        self.seq = -1  # camera frame of the latest detections
+        self._cond = threading.Condition()
+        self._frame = None
+        self._busy = False
+        self._stopped = False
+        self._last = 0.0
+        self._last_seq = -every
+        self._thread = None
 
-    for obj in new_objs:
-        obj_temp = next(
-            (
-                (idx, item)
-                for idx, item in enumerate(obj_detector)
-                if item["label"] == obj["label"]
-            ),
-            False,
+    def start(self):
+        self._thread = threading.Thread(
+            target=self._run, name="object-detector", daemon=True
         )
-        if not obj_temp:
-            obj["selected"] = False
-            obj["added"] = time.time_ns()
-            obj_detector.append(obj)
-        else:
-            obj_detector[obj_temp[0]]["x0"] = obj["x0"]
-            obj_detector[obj_temp[0]]["x1"] = obj["x1"]
-            obj_detector[obj_temp[0]]["y0"] = obj["y0"]
-            obj_detector[obj_temp[0]]["y1"] = obj["y1"]
-            obj_detector[obj_temp[0]]["added"] = time.time_ns()
+        self._thread.start()
+        return self
+
+    def stop(self):
+        """Stops the stage and waits for the request in flight."""
+        with self._cond:
+            self._stopped = True
+            self._cond.notify()
+        thread = self._thread
+        if thread is not None and thread is not threading.current_thread():
+            thread.join()
+
+    def submit(self, seq, frame, timestamp=None):
+        """Hands a camera frame over to the detector unless it is busy.
+
+        Args:
+            seq ([int]): sequence number of the frame
+            frame ([np.array]): BGR camera frame, not modified afterwards
+            timestamp ([float]): capture time of the frame
+
+        Returns:
+            [bool]: whether the frame will be detected
+        """
+        with self._cond:
+            if (
+                self._busy
+                or self._stopped
+                or seq - self._last_seq < self.every
+                or time.monotonic() - self._last < self.interval
+            ):
+                self.skipped += 1
+                return False
+            self._frame = (seq, frame, timestamp)
+            self._last_seq = seq
+            self._busy = True
+            self.submitted += 1
+            self._cond.notify()
+        return True
+
+    def _run(self):
+        while True:
+            with self._cond:
+                self._cond.wait_for(lambda: self._stopped or self._frame is not None)
+                if self._stopped:
+                    return
+                (seq, frame, timestamp), self._frame = self._frame, None
+                self._last = start = time.monotonic()
+            try:
+                self._detect(seq, frame, timestamp)
+            except (OSError, ValueError) as e:
+                logging.error(f"object detection stopped: {e}")
+                self.stop()
+            self.latency = 0.8 * self.latency + 0.2 * (time.monotonic() - start)
+            with self._cond:
+                self._busy = False
+
+    def _detect(self, seq, frame, timestamp):
+        frame_id = self.detector.send(frame)
+        torn = self.ring is not None and not self.ring.valid(seq)
+        answer_id, detections = self.detector.receive()
+        while answer_id != frame_id:
+            # answer to a request given up on before
+            logging.warning(f"dropping detections of frame {answer_id}")
+            answer_id, detections = self.detector.receive()
+        if torn:
+            logging.warning(f"frame {seq} was overwritten while sent to the detector")
+            self.dropped += 1
+            return
+        self.tracker.update(detections, timestamp)
+        self.seq = seq
 
-    for idx, obj in enumerate(obj_detector):
-        if obj["added"] < time.time_ns() - 2e9:
-            obj_detector.pop(idx)
+    def stats(self):
+        """Returns the request counters and the mean detector latency."""
+        return {
+            "submitted": self.submitted,
+            "skipped": self.skipped,
+            "dropped": self.dropped,
+            "latency_ms": self.latency * 1e3,
+        }
 
 
-def check_object_selected(focus_config, obj_detector):
+def check_object_selected(focus_config, tracker):
     """Mark an object as selected if the coordinates of
     the clic are inside the object rectangle.
 
     Args:
         focus_config ([json]): coodinates of the clic
-        obj_detector ([list]): objects detected using classify_objects(...)
+        tracker ([ObjectTracker]): tracks of the detected objects
     """
-    for idx, obj in enumerate(obj_detector):
-        if (
-            obj["x0"] < focus_config["frame_x"]
-            and obj["x1"] > focus_config["frame_x"]
-            and obj["y0"] < focus_config["frame_y"]
-            and obj["y1"] > focus_config["frame_y"]
-        ):
-
-            obj_detector[idx]["selected"] = not obj_detector[idx]["selected"]
+    tracker.select(focus_config["frame_x"], focus_config["frame_y"])
@@ -0,0 +1,202 @@
+"""
+Copyright (C) 2020 Mauro Riva
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+import time
+import threading
+import cv2
+
+from frames import FrameRate
+
+
+def preview_image(image, width=None, draw=False):
+    """Returns the preview of a camera frame, downscaled to at most width
+    pixels, and its scale factor. Frames that are small enough are returned
+    as they are, unless draw is set: the preview can then be drawn on
+    without touching the frame.
+
+    Args:
+        image ([np.array]): camera frame
+        width ([int]): maximal preview width, None for full resolution
+        draw ([bool]): whether overlays will be drawn on the preview
+
+    Returns:
+        [tuple]: preview image and scale (preview / frame)
+    """
+    if width and image.shape[1] > width:
+        scale = width / image.shape[1]
+        size = (width, max(round(image.shape[0] * scale), 1))
+        return cv2.resize(image, size, interpolation=cv2.INTER_AREA), scale
+    return (image.copy() if draw else image), 1.0
+
+
+class MJPEGBroadcaster:
+    """Encodes each new preview frame once and fans the JPEG out to all
+    MJPEG clients.
+
+    The capture loop hands frames over with update() without waiting for
+    the encoder. An encoder thread compresses the latest frame (only while
+    somebody watches) into a ring of multipart chunks, and every client
+    generator waits on a condition variable for the next chunk. A client
+    that falls behind the ring skips to the latest chunk, so slow clients
+    drop frames instead of blocking the others.
+
+    The JPEG quality adapts to the throughput of the slowest client: the
+    time it needs to send a chunk is compared with the frame period, and
+    the quality is lowered (down to min_quality) when it uses most of it
+    and raised again (up to quality) when there is headroom.
+    """
+
+    def __init__(self, quality=80, min_quality=30, slots=4):
+        self.max_quality = quality
+        self.min_quality = min_quality
+        self.quality = quality
+        self.encoded = 0
+        self.dropped = 0
+        self.viewers = 0
+        self._lock = threading.Lock()
+        self._new_image = threading.Condition(self._lock)
+        self._new_part = threading.Condition(self._lock)
+        self._image = None
+        self._pending = False
+        self._ring = [None] * slots
+        self._seq = 0
+        self._stopped = False
+        self._thread = None
+        self._rate = FrameRate()
+        self._send_times = {}
+        self._adapted = 0.0
+
+    def start(self):
+        self._thread = threading.Thread(
+            target=self._encode_loop, name="mjpeg-encoder", daemon=True
+        )
+        self._thread.start()
+        return self
+
+    def stop(self):
+        with self._lock:
+            self._stopped = True
+            self._new_image.notify_all()
+            self._new_part.notify_all()
+
+    def update(self, image):
+        """Hands over a new preview frame. The image is encoded later on the
+        encoder thread, so it must not be modified afterwards.
+        """
+        with self._lock:
+            self._image = image
+            self._pending = True
+            self._new_image.notify()
+
+    def _encode_loop(self):
+        while True:
+            with self._lock:
+                self._new_image.wait_for(
+                    lambda: self._stopped or (self._pending and self.viewers)
+                )
+                if self._stopped:
+                    return
+                image, self._pending = self._image, False
+
+            flag, encoded_image = cv2.imencode(
+                ".jpg", image, [cv2.IMWRITE_JPEG_QUALITY, self.quality]
+            )
+            if not flag:
+                continue
+            part = (
+                b"--frame\r\n"
+                b"Content-Type: image/jpeg\r\n\r\n" + encoded_image.tobytes() + b"\r\n"
+            )
+
+            with self._lock:
+                self._seq += 1
+                self._ring[self._seq % len(self._ring)] = part
+                self.encoded += 1
+                self._new_part.notify_all()
+            self._rate.tick()
+            self._adapt()
+
+    def _adapt(self, interval=1.0):
+        now = time.monotonic()
+        if now - self._adapted < interval:
+            return
+        self._adapted = now
+        with self._lock:
+            slowest = max(self._send_times.values(), default=0.0)
+        load = slowest * max(self._rate.rate(), 1.0)
+        if load > 0.8:
+            self.quality = max(self.quality - 10, self.min_quality)
+        elif load < 0.4:
+            self.quality = min(self.quality + 5, self.max_quality)
+
+    def throughput(self):
+        """Returns the bytes per second of the slowest client (0 without
+        clients), estimated from its send times.
+        """
+        with self._lock:
+            slowest = max(self._send_times.values(), default=0.0)
+            part = self._ring[self._seq % len(self._ring)]
+        return len(part) / slowest if slowest and part else 0.0
+
+    def _next_part(self, seq, timeout):
+        """Returns (seq, part) of the chunk after seq, or of the latest one if
+        the chunk after seq already left the ring. Returns (seq, None) after
+        timeout seconds without a new chunk and None once stopped.
+        """
+        with self._lock:
+            if not self._new_part.wait_for(
+                lambda: self._stopped or self._seq > seq, timeout
+            ):
+                return seq, None
+            if self._stopped:
+                return None
+            if self._seq - seq > len(self._ring) - 1:
+                self.dropped += self._seq - seq - 1
+                seq = self._seq
+            else:
+                seq += 1
+            return seq, self._ring[seq % len(self._ring)]
+
+    def frames(self, timeout=1.0):
+        """Generator of multipart/x-mixed-replace chunks for one client. The
+        time the server takes to send each chunk is tracked per client.
+        """
+        client = object()
+        with self._lock:
+            self.viewers += 1
+            self._send_times[client] = 0.0
+            seq = self._seq
+            # encode the latest frame again, it may be older than the ring
+            self._pending = self._image is not None
+            self._new_image.notify()
+        try:
+            while True:
+                next_part = self._next_part(seq, timeout)
+                if next_part is None:
+                    return
+                seq, part = next_part
+                if part is not None:
+                    start = time.monotonic()
+                    yield part
+                    elapsed = time.monotonic() - start
+                    with self._lock:
+                        send_time = self._send_times[client]
+                        self._send_times[client] = 0.8 * send_time + 0.2 * elapsed
+        finally:
+            with self._lock:
+                self.viewers -= 1
+                del self._send_times[client]
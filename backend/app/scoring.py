@@ -0,0 +1,116 @@
+"""
+Copyright (C) 2020 Mauro Riva
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+import logging
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+
+from frames import ScoreCache
+from focus import get_focus_score, weighted_focus_score
+
+
+def score_frame(focus_frame, metric="dwt"):
+    """Scores a FocusFrame. All ROI boxes are scored in one pass and
+    combined, weighting the selected objects.
+
+    Args:
+        focus_frame ([FocusFrame]): frame snapshot to score
+        metric ([str]): name of the focus metric
+
+    Returns:
+        [float]: focus score of the frame
+    """
+    if focus_frame.rois:
+        scores = get_focus_score(focus_frame.image, metric, focus_frame.rois)
+        return weighted_focus_score(scores, focus_frame.weights)
+    return get_focus_score(focus_frame.image, metric)
+
+
+class FocusScorer:
+    """Scoring stage running on its own thread pool.
+
+    Frames are submitted as FocusFrame snapshots: the image is passed by
+    reference (the publisher never modifies it afterwards), and OpenCV
+    releases the GIL while it filters, so the workers neither copy the frame
+    nor block the preview threads. Scores are cached per (frame sequence,
+    ROIs, metric) and concurrent requests for the same key share one future.
+
+    If the frames live in a FrameRing, a score is checked against the ring
+    once computed: a frame overwritten during scoring has no score (None),
+    which is not cached. Callers drop the sample or score a newer frame.
+    """
+
+    def __init__(self, workers=2, cache=None, ring=None):
+        self.cache = cache or ScoreCache()
+        self.ring = ring
+        self._executor = ThreadPoolExecutor(
+            max_workers=workers, thread_name_prefix="focus-scorer"
+        )
+        self._lock = threading.Lock()
+        self._pending = {}
+        self.scored = 0
+
+    def submit(self, focus_frame, metric="dwt"):
+        """Schedules the scoring of a frame.
+
+        Args:
+            focus_frame ([FocusFrame]): frame snapshot to score
+            metric ([str]): name of the focus metric
+
+        Returns:
+            [concurrent.futures.Future]: future with the focus score
+        """
+        key = ScoreCache.key(focus_frame, metric)
+        score = self.cache.get(key)
+        if score is not None:
+            future = Future()
+            future.set_result(score)
+            return future
+
+        with self._lock:
+            future = self._pending.get(key)
+            created = future is None
+            if created:
+                future = self._executor.submit(self._score, focus_frame, metric)
+                self._pending[key] = future
+        if created:
+            future.add_done_callback(lambda f: self._done(key, f))
+        return future
+
+    def score(self, focus_frame, metric="dwt"):
+        """Scores a frame on the pool and waits for the result (None if the
+        frame was overwritten while it was scored).
+        """
+        return self.submit(focus_frame, metric).result()
+
+    def _score(self, focus_frame, metric):
+        with self._lock:
+            self.scored += 1
+        score = score_frame(focus_frame, metric)
+        if self.ring is not None and not self.ring.valid(focus_frame.seq):
+            logging.warning(f"frame {focus_frame.seq} was overwritten while scored")
+            return None
+        return score
+
+    def _done(self, key, future):
+        if future.exception() is None and future.result() is not None:
+            self.cache.put(key, future.result())
+        with self._lock:
+            self._pending.pop(key, None)
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False)
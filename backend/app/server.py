@@ -25,46 +25,86 @@ import time
 import threading
 import requests
 import numpy as np
+from collections import deque
 from flask import Flask, render_template, Response, request, jsonify
-from imutils.video import WebcamVideoStream
 from imutils.video import FPS
 from datetime import datetime
 
 from os import listdir, makedirs, replace, remove
 from os.path import isfile, join
 
-from motors import set_move_motor, get_motor_status
-from obj_detector import check_object_selected, classify_objects
+from motors import set_move_motor, move_motor_to, move_motor_batch
+from motors import get_motor_status, get_motor_client
+from obj_detector import (
+    check_object_selected,
+    DetectionStage,
+    DetectorConnection,
+    FrameBus,
+)
+from blur_detection import focus_metrics
+from frames import FocusFrame, FrameRing, FrameStore, FrameRate
+from scoring import FocusScorer
+from tracker import ObjectTracker
+from preview import MJPEGBroadcaster, preview_image
+from capture import OpenCVCapture, FileCapture
 from focus import (
-    get_focus_score,
     gaussian_fitting,
     parabola_fitting,
     fibs,
     smallfib,
     fib,
+    peak_fitting,
 )
 
-lock = threading.Lock()
-
 m5stack_host = None
 
 app = Flask(__name__)
-vc = WebcamVideoStream(src=0).start()
+vc = None
+# camera index (or video file) and requested resolution / frame rate
+camera_config = {"src": 0, "width": None, "height": None, "fps": None}
 fps = FPS().start()
 
-frame = vc.read()
-output_frame = frame.copy()
-focus_frame = frame.copy()
+# camera frames, written once by the capture loop and shared as read-only
+# views with the scoring and streaming threads
+frame_ring = FrameRing()
+frame = None
+# JPEG preview, encoded once per frame for all /api/video_feed clients
+preview = MJPEGBroadcaster()
+# maximal width of the preview, the focus is scored on the full frame
+preview_width = 640
+
+# latest frame handed over to the focus search, and the scores computed on it
+focus_frames = FrameStore()
+focus_scorer = FocusScorer(ring=frame_ring)
+# frame rate of every preview client, tracked during autofocus
+preview_rates = set()
+# time to wait after a motor move before a frame counts as settled [s]
+frame_settle = 0.05
+# time the motor holds each position of a batched scan for the camera [s],
+# None for one frame time of the camera
+scan_dwell = None
 
 focus_phase = 0
 focus_break = True
 focus_mode = 0
 score_history = []
 
+# cheap metric for the coarse search, expensive one near the peak
+coarse_metric = "tenengrad"
+fine_metric = "dwt"
+
 tpu_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+# shared-memory frame transport to a detector on the same host
+framebus = None
+tpu_detector = None
+# object detection running beside the preview, every detect_interval s and
+# every detect_every frames at most. The tracker predicts the objects between.
+detection = None
+detect_interval = 0.0
+detect_every = 3
 photo_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
 
-obj_detector = []
+obj_tracker = ObjectTracker()
 object_selected = []
 tpu_api_detected = False
 take_photo_detected = False
@@ -75,8 +115,8 @@ focus_config = {
     "focus_type": "box",
     "frame_x": 0,
     "frame_y": 0,
-    "frame_w": len(frame[0]),
-    "frame_h": len(frame),
+    "frame_w": 0,
+    "frame_h": 0,
 }
 
 color_selected = (109, 41, 3)
@@ -84,6 +124,10 @@ color_normal = (239, 218, 195)
 
 thread = threading.Thread()
 encode_param = [int(cv2.IMWRITE_JPEG_QUALITY), 90]
+still_encode_param = [int(cv2.IMWRITE_JPEG_QUALITY), 95]
+# camera of the photo service: with "broker", it takes the photos from the
+# live camera (/api/still), otherwise the camera is handed over to it
+photo_camera = "picamera"
 
 # ############################################
 # FOCUS SEARCH
@@ -92,16 +136,15 @@ encode_param = [int(cv2.IMWRITE_JPEG_QUALITY), 90]
 # ############################################
 
 
-def hill_climbing(step_size=300):
+def hill_climbing(step_size=300, metric="dwt"):
     """Climb to a higher place, find a smaller interval containing focus position
     (z1, z2, z3), (f1, f2, f3) = hill_climbing(f)
     """
-    global focus_frame
     mtype = "focus"
 
-    f1 = get_focus_score(focus_frame)
+    f1 = score_focus_frame(metric)
     z1 = 0
-    f2 = move_focus_motor(step_size, True)
+    f2 = move_focus_motor(step_size, True, metric)
     z2 = step_size
     score_history.append(f1)
     score_history.append(f2)
@@ -111,7 +154,7 @@ def hill_climbing(step_size=300):
         if f2 > f1:
             f0 = f1
             f1 = f2
-            f2 = move_focus_motor(step_size, True)
+            f2 = move_focus_motor(step_size, True, metric)
             score_history.append(f2)
             z2 += step_size
             iterations += 1
@@ -120,21 +163,21 @@ def hill_climbing(step_size=300):
             logging.info("Found a dip, assuming it is wrong and continuing")
             f0 = f1
             f1 = f2
-            f2 = move_focus_motor(step_size, True)
+            f2 = move_focus_motor(step_size, True, metric)
             score_history.append(f2)
             z2 += step_size
             iterations += 1
 
         elif iterations <= 2:
             logging.info("Changing search direction")
-            return hill_climbing(-step_size / 2)
+            return hill_climbing(-step_size / 2, metric)
 
         else:
             logging.info("Finised hill climbing")
             return ((z2 - 2 * step_size - 2, z2 - step_size, z2), (f0, f1, f2))
 
 
-def fibonacci_search(interval):
+def fibonacci_search(interval, metric="dwt"):
     """Carry out the fibonacci search method according* to the paper:
     'Autofocusing for tissue microscopy' by T.T.E.Yeo et al
 
@@ -142,8 +185,6 @@ def fibonacci_search(interval):
     interval = (a, b)
     f is the microscope control class
     """
-    global focus_frame
-
     a = interval[0]
     b = interval[1]
     c = np.mean((a, b))  # current position of z is inbetween the interval
@@ -153,8 +194,8 @@ def fibonacci_search(interval):
     x1 = a + delta
     x2 = b - delta
 
-    y1 = move_focus_motor(x1 - c, True)
-    y2 = move_focus_motor(x2 - x1, True)
+    y1 = move_focus_motor(x1 - c, True, metric)
+    y2 = move_focus_motor(x2 - x1, True, metric)
 
     score_history.append(y1)
     score_history.append(y2)
@@ -172,7 +213,7 @@ def fibonacci_search(interval):
             x1 = x2
             y1 = y2
             x2 = b - (fib(n - 2) / fib(n)) * (b - a)
-            y2 = move_focus_motor(x2 - curr_pos, True)
+            y2 = move_focus_motor(x2 - curr_pos, True, metric)
             score_history.append(y2)
 
             older_pos = old_pos
@@ -183,7 +224,7 @@ def fibonacci_search(interval):
             x2 = x1
             y2 = y1
             x1 = a + (fib(n - 2) / fib(n)) * (b - a)
-            y1 = move_focus_motor(x1 - curr_pos, True)
+            y1 = move_focus_motor(x1 - curr_pos, True, metric)
             score_history.append(y1)
             older_pos = old_pos
             old_pos = curr_pos
@@ -202,22 +243,64 @@ def fibonacci_search(interval):
 # ############################################
 
 
-def move_focus_motor(step_size, take_photo=False):
-    global focus_frame
+def score_focus_frame(metric="dwt", focus_frame=None):
+    """Scores a FocusFrame (default: the latest one) on the scoring pool and
+    waits for the result. No lock is held while the score is
+    computed, and a frame handed over twice is only scored once.
+    """
+    focus_frame = focus_frame or focus_frames.latest()
+    return rescore(focus_scorer.submit(focus_frame, metric), metric)
+
+
+def rescore(score, metric, retries=3):
+    """Waits for a score future. A frame overwritten while it was scored has
+    no score (None), so the latest frame is scored instead; the motor holds
+    its position meanwhile.
+    """
+    result = score.result()
+    for _ in range(retries):
+        if result is not None:
+            break
+        result = focus_scorer.score(focus_frames.latest(), metric)
+    if result is None:
+        raise RuntimeError("frames are overwritten faster than they are scored")
+    return result
+
+
+def move_focus_motor(step_size, take_photo=False, metric="dwt"):
+    position, score = submit_focus_move(step_size, metric if take_photo else None)
+
+    if take_photo:
+        return rescore(score, metric)
+
+
+def submit_focus_move(step_size, metric="dwt"):
+    """Moves the focus motor and schedules the scoring of the first frame
+    captured after the motor settled, without waiting for the score.
+
+    Args:
+        step_size ([float]): relative move in motor steps
+        metric ([str]): focus metric, None to skip scoring
+
+    Returns:
+        [tuple]: position reported by the motor and the future of the score
+                 (None if metric is None)
+    """
     mtype = "focus"
     mdir = 0 if step_size < 0 else 1
 
-    while not set_move_motor(m5stack_host, mtype, abs(int(step_size)), mdir):
-        pass
+    done, position = set_move_motor(m5stack_host, mtype, abs(int(step_size)), mdir)
 
-    if take_photo:
-        with lock:
-            time.sleep(0.1)
-            return get_focus_score(focus_frame)
+    if metric is None:
+        return position, None
 
+    settled = time.monotonic() + frame_settle
+    focus_frame = focus_frames.wait_after(settled)
+    return position, focus_scorer.submit(focus_frame, metric)
 
-def autofocus():
-    global focus_frame, focus_break, score_history
+
+def autofocus(finish=True):
+    global focus_break, score_history
     score_history = []
 
     motor_status = get_motor_status(m5stack_host, "focus")
@@ -234,7 +317,7 @@ def autofocus():
         move_focus_motor(max_steps / 2 - actual_position)
 
     logging.info("Starting hill_climbing search")
-    pos, scores = hill_climbing()
+    pos, scores = hill_climbing(metric=coarse_metric)
     if focus_break:
         return
 
@@ -250,7 +333,7 @@ def autofocus():
         return
 
     logging.info("Starting fibonacci_search search")
-    (a, b, x, z1, z3, z2) = fibonacci_search(interval)
+    (a, b, x, z1, z3, z2) = fibonacci_search(interval, fine_metric)
     if focus_break:
         return
 
@@ -264,68 +347,301 @@ def autofocus():
         f"max_steps: {max_steps} actual_position: {actual_position} move: {step_size}"
     )
 
-    score_history.append(get_focus_score(focus_frame))
+    score_history.append(score_focus_frame(fine_metric))
+    logging.info(f"score_x: {score_history[-1]}")
+    logging.info(f"preview fps: {preview_fps()}")
+
+    # livefocus keeps tracking the focus afterwards
+    if finish:
+        focus_break = True
+
+
+def pipelined_climb(step_size, metric, lookahead=2, margin=50):
+    """Hill climbing that keeps the motor moving while the previous positions
+    are still being scored. Up to lookahead moves are made speculatively in
+    the current direction; the search stops two scores after the peak.
+    Returns the (position, score) trace in the order of the moves.
+    """
+    motor_status = get_motor_status(m5stack_host, "focus")
+    max_steps = motor_status["max_steps"]
+    position = motor_status["position"]
+
+    trace = []
+    pending = deque()
+    pending.append((position, focus_scorer.submit(focus_frames.latest(), metric)))
+    direction = 1
+    turned = False
+    # first move of the current direction in the trace
+    since = 0
+
+    while not focus_break:
+        moved = margin < position + direction * step_size < max_steps - margin
+        if moved:
+            position, score = submit_focus_move(direction * step_size, metric)
+            pending.append((position, score))
+        elif not pending:
+            break
+
+        # collect the finished scores, block only when too far ahead
+        # or when the motor reached the end of its range
+        while pending and (
+            pending[0][1].done() or len(pending) > lookahead or not moved
+        ):
+            z, score = pending.popleft()
+            trace.append((z, score.result()))
+
+        # frames overwritten while scored have no score
+        scores = [f for z, f in trace[since:] if f is not None]
+        if len(scores) < 3:
+            continue
+        best = int(np.argmax(scores))
+        if best == 0 and not turned:
+            logging.info("Changing search direction")
+            direction = -direction
+            turned = True
+            since = len(trace) + len(pending)
+        elif best <= len(scores) - 3:
+            logging.info("Passed the peak")
+            break
+
+    while pending:
+        z, score = pending.popleft()
+        trace.append((z, score.result()))
+    return [(z, f) for z, f in trace if f is not None]
+
+
+def pipelined_autofocus(step_size=150):
+    """Autofocus that overlaps every motor move with the scoring of the
+    previous position and fits the peak over the trace once the climb has
+    passed it.
+    """
+    global focus_break, score_history
+
+    logging.info("Starting pipelined hill climbing")
+    trace = pipelined_climb(step_size, coarse_metric)
+    score_history = [f for z, f in trace]
+    if focus_break or len(trace) < 3:
+        focus_break = True
+        return
+
+    z, f = np.array(trace).T
+    mu = peak_fitting(z, f)
+    position = trace[-1][0]
+    logging.info(f"peak: {mu} position: {position} move: {mu - position}")
+    score_history.append(move_focus_motor(mu - position, True, fine_metric))
     logging.info(f"score_x: {score_history[-1]}")
+    logging.info(f"preview fps: {preview_fps()}")
 
     focus_break = True
 
 
-def livefocus():
-    global focus_break
+def sweep_focus(start, step_size, metric):
+    """Moves the focus motor by step_size in a single command and scores
+    every frame captured during the move. The motor is assumed to run at
+    constant speed, so each frame gets the position interpolated between
+    the start and the end of the move at its capture time. Frames that
+    arrive while a ring's worth of frames is still being scored are
+    skipped, as they would be overwritten before being scored.
+
+    Args:
+        start ([int]): motor position before the sweep
+        step_size ([int]): relative move in motor steps
+        metric ([str]): focus metric
+
+    Returns:
+        [tuple]: positions and scores of the frames, and the end position
+    """
+    samples = []
+    in_flight = deque()
+    # the capture thread writes into one more slot of the ring
+    max_in_flight = len(frame_ring) - 1
+    last_seq = [None]
+
+    def collect(focus_frame):
+        if focus_frame.seq == last_seq[0]:
+            return
+        last_seq[0] = focus_frame.seq
+        while in_flight and in_flight[0].done():
+            in_flight.popleft()
+        if len(in_flight) >= max_in_flight:
+            return
+        score = focus_scorer.submit(focus_frame, metric)
+        in_flight.append(score)
+        samples.append((focus_frame.timestamp, score))
+
+    mdir = 0 if step_size < 0 else 1
+    focus_frames.subscribe(collect)
+    try:
+        # raises if the move times out: the positions would be unknown
+        t0 = time.monotonic()
+        done, end = set_move_motor(m5stack_host, "focus", abs(int(step_size)), mdir)
+        t1 = time.monotonic()
+    finally:
+        focus_frames.unsubscribe(collect)
+
+    # frames overwritten while scored have no score and are dropped
+    samples = [(t, score.result()) for t, score in samples if t0 <= t <= t1]
+    samples = [(t, f) for t, f in samples if f is not None]
+    ts = np.array([t for t, f in samples])
+    z = start + (end - start) * (ts - t0) / max(t1 - t0, 1e-6)
+    f = np.array([f for t, f in samples])
+    return z, f, end
+
+
+def sweep_autofocus(margin=50):
+    """Autofocus in a single sweep: move to the nearest end of the focus
+    range, sweep to the other end while scoring every frame, fit the peak
+    over the whole trace and move there.
+    """
+    global focus_break, score_history
+
     motor_status = get_motor_status(m5stack_host, "focus")
     max_steps = motor_status["max_steps"]
+    position = motor_status["position"]
+
+    start, end = margin, max_steps - margin
+    if position > max_steps / 2:
+        start, end = end, start
+
+    logging.info(f"Sweeping from {start} to {end}")
+    done, position = move_motor_to(m5stack_host, "focus", start)
+    z, f, position = sweep_focus(position, end - position, coarse_metric)
+    score_history = list(f)
+    if focus_break or len(f) < 3:
+        focus_break = True
+        return
 
-    autofocus()
+    mu = peak_fitting(z, f)
+    logging.info(f"frames: {len(f)} peak: {mu} position: {position}")
+    score_history.append(move_focus_motor(mu - position, True, fine_metric))
+    logging.info(f"score_x: {score_history[-1]}")
+    logging.info(f"preview fps: {preview_fps()}")
 
-    mem = 2
-    margin = 50
-    score_old = np.zeros(mem)
-    step_size = 50
+    focus_break = True
 
-    mem_count = mem
-    mdir = 1
 
-    while mem_count > 0 and not focus_break:  # fill buffer
-        mem_count = mem_count - 1
-        score_x = move_focus_motor(15, True)
-        score_old = np.append(score_old, score_x)
-        score_old = np.delete(score_old, 0)
-        logging.info(f"score_x: {score_x}")
+def scan_focus(targets, metric):
+    """Sends a list of focus positions to the motor as one batched request.
+    The board signals each position once it settled; the frame captured
+    while it holds the position is scored as the motor moves on.
 
-    mdir_old = mdir
-    swing = 0
+    Returns:
+        [tuple]: reached positions and their scores
+    """
+    trace = []
 
-    while not focus_break:
-        motor_status = get_motor_status(m5stack_host, "focus")
-        max_steps = motor_status["max_steps"]
-        actual_position = motor_status["position"]
+    def score_position(index, done, position):
+        focus_frame = focus_frames.wait_after(time.monotonic())
+        trace.append((position, focus_scorer.submit(focus_frame, metric)))
 
-        score_x = move_focus_motor(mdir * step_size, True)
+    logging.info(
+        f"Scanning {len(targets)} positions from {targets[0]} to {targets[-1]}"
+    )
+    dwell = scan_dwell
+    if dwell is None:
+        # long enough for the camera to capture a frame at each position
+        dwell = 1.2 / (vc.fps or 30.0)
+    move_motor_batch(
+        m5stack_host, "focus", targets, frame_settle, dwell, score_position
+    )
+    # frames overwritten while scored have no score and are dropped
+    trace = [(z, score.result()) for z, score in trace]
+    z = np.array([z for z, f in trace if f is not None])
+    f = np.array([f for z, f in trace if f is not None])
+    return z, f
+
+
+def scan_autofocus(points=7, span=300):
+    """Autofocus with a batched fine scan: the hill climbing finds the
+    focus region with relative moves as in autofocus(), then the positions
+    around its fitted peak are scanned in one batched request, starting on
+    the near side. The peak is fitted over the scan and reached with one
+    absolute move.
+    """
+    global focus_break, score_history
+    score_history = []
 
-        logging.info(f"score_x: {score_x}")
+    logging.info("Starting hill_climbing search")
+    pos, scores = hill_climbing(metric=coarse_metric)
+    if focus_break:
+        return
 
-        score_old = np.append(score_old, score_x)
-        score_old = np.delete(score_old, 0)
+    motor_status = get_motor_status(m5stack_host, "focus", cached=True)
+    max_steps = motor_status["max_steps"]
+    position = motor_status["position"]
+    # the climb positions are relative to its start
+    mu = position - pos[2] + gaussian_fitting(pos, scores)
+    targets = np.linspace(mu - span, mu + span, points)
+    if position > mu:
+        targets = targets[::-1]  # start at the nearest end
+    targets = np.clip(targets, 0, max_steps).astype(int)
+
+    z, f = scan_focus(targets, fine_metric)
+    score_history.extend(f)
+    if focus_break or len(f) < 3:
+        focus_break = True
+        return
 
-        gradient = np.sum(np.gradient(score_old, 1)) / mem
-        mdir = 1 if gradient < 0 else -1
+    mu = peak_fitting(z, f)
+    done, position = move_motor_to(m5stack_host, "focus", mu)
+    focus_frame = focus_frames.wait_after(time.monotonic() + frame_settle)
+    score_history.append(score_focus_frame(fine_metric, focus_frame))
+    logging.info(f"peak: {mu} position: {position} score_x: {score_history[-1]}")
+    logging.info(f"preview fps: {preview_fps()}")
 
-        # avoid swing on maximal
-        if mdir != mdir_old:
-            swing = swing + 1
-        else:
-            swing = 0
+    focus_break = True
 
-        logging.info(
-            f"gradient: {gradient} score_old: {score_old} swing: {swing} actual_position: {actual_position} max_steps {max_steps}"
-        )
 
-        mdir_old = mdir
-        # reset position limit reached
-        if max_steps - actual_position < margin:
-            break
-        if actual_position < margin:
-            break
+def livefocus(metric=None, step_size=50, min_step=10, drop=0.1, interval=0.1):
+    """Autofocus, then keeps the scene in focus: the lens climbs to the
+    peak, holds its position while the score stays within drop of the
+    score at the peak, and climbs again once it falls below. A climb keeps
+    its direction while the score rises, and reverses and halves the step
+    when it falls, until the step is below min_step. The first climb
+    follows the autofocus, since the scene may have changed meanwhile.
+
+    Args:
+        metric ([str]): focus metric, the coarse one by default
+        step_size ([int]): first step of a climb in motor steps
+        min_step ([int]): smallest step of a climb in motor steps
+        drop ([float]): relative score drop that starts a climb
+        interval ([float]): seconds between two checks of the score
+    """
+    global focus_break
+    metric = metric or coarse_metric
+    margin = 50
+
+    autofocus(finish=False)
+
+    score_x = score_focus_frame(metric)
+    while not focus_break:
+        motor_status = get_motor_status(m5stack_host, "focus", cached=True)
+        max_steps = motor_status["max_steps"]
+        position = motor_status["position"]
+        mdir, step = 1, step_size
+        while step >= min_step and not focus_break:
+            if not margin < position + mdir * step < max_steps - margin:
+                mdir = -mdir
+            score_old = score_x
+            score_x = move_focus_motor(mdir * step, True, metric)
+            # the cached position follows every move, no need to poll the board
+            position = get_motor_status(m5stack_host, "focus", cached=True)[
+                "position"
+            ]
+            if score_x < score_old:
+                if step // 2 < min_step:
+                    # back to the best position of the climb
+                    score_x = move_focus_motor(-mdir * step, True, metric)
+                mdir, step = -mdir, step // 2
+            logging.info(f"score_x: {score_x} position: {position} step: {step}")
+
+        peak = score_x
+        while not focus_break:
+            focus_frame = focus_frames.wait_after(time.monotonic() + interval)
+            score_x = score_focus_frame(metric, focus_frame)
+            if score_x < (1 - drop) * peak:
+                logging.info(f"score_x: {score_x} below the peak {peak}, climbing")
+                break
 
 
 # ############################################
@@ -333,55 +649,113 @@ def livefocus():
 # ############################################
 
 
+def preview_fps():
+    """Returns the frame rate of the slowest preview client."""
+    rates = [rate.rate() for rate in list(preview_rates)]
+    return min(rates) if rates else 0.0
+
+
 def generate():
-    """Video streaming generator function."""
-    global output_frame, lock
-    while True:
-        with lock:
-            # check if the output frame is available, otherwise skip
-            # the iteration of the loop
-            if output_frame is None:
-                continue
-
-            # encode the frame in JPEG format
-            flag, encoded_image = cv2.imencode(".jpg", output_frame)
-
-            # ensure the frame was successfully encoded
-            if not flag:
-                continue
-
-        yield (
-            b"--frame\r\n"
-            b"Content-Type: image/jpeg\r\n\r\n" + bytearray(encoded_image) + b"\r\n"
-        )
+    """Video streaming generator function. The JPEG frames are shared with
+    the other clients, see MJPEGBroadcaster.
+    """
+    rate = FrameRate()
+    preview_rates.add(rate)
+    try:
+        for part in preview.frames():
+            rate.tick()
+            yield part
+    finally:
+        preview_rates.discard(rate)
+
+
+def open_camera():
+    """Opens the capture source described by camera_config. Image and video
+    files are replayed at the requested frame rate.
+    """
+    src = camera_config["src"]
+    if isinstance(src, str) and isfile(src):
+        image = cv2.imread(src)
+        frames = [image] if image is not None else src
+        return FileCapture(frames, camera_config["fps"] or 30.0, ring=frame_ring)
+    return OpenCVCapture(
+        src,
+        camera_config["width"],
+        camera_config["height"],
+        camera_config["fps"],
+        ring=frame_ring,
+    )
+
+
+def start_camera(camera=None):
+    """Starts the camera and publishes its first frame.
+
+    Args:
+        camera ([CaptureSource]): capture source writing into frame_ring,
+                                  by default the one of camera_config
+    """
+    global vc, frame
+    vc = (camera or open_camera()).start()
+    latest = vc.next_frame(timeout=5.0)
+    if latest is None:
+        raise IOError("no frame from the camera")
+    seq, timestamp, frame = latest
+    preview.update(preview_image(frame, preview_width)[0])
+    focus_frames.publish(FocusFrame(seq, timestamp, frame, None, None))
+
+    if focus_config["frame_w"] == 0:
+        focus_config["frame_w"] = len(frame[0])
+        focus_config["frame_h"] = len(frame)
+
+
+def start_live_preview():
+    global streaming
+    start_camera()
+    streaming = threading.Thread(target=video_streaming)
+    streaming.start()
 
 
 def restart_live_preview(task_id):
-    global streaming, vc
     request_check = args.photo + task_id
-    state = requests.get(request_check).json()["state"]
-    while state != "SUCCESS":
-        state = requests.get(request_check).json()["state"]
+    state = None
+    # the photo service merges the HDR image after releasing the camera
+    while state not in ("CAPTURED", "SUCCESS", "FAILURE"):
+        try:
+            state = requests.get(request_check, timeout=5).json()["state"]
+        except (requests.RequestException, ValueError, KeyError) as e:
+            logging.error(f"cannot get the state of photo {task_id}: {e}")
+            break
         time.sleep(0.1)
 
     logging.info("Starting live view after taking photos!")
     time.sleep(0.5)
-    vc = WebcamVideoStream(src=0).start()
-    streaming = threading.Thread(target=video_streaming)
-    streaming.start()
+    start_live_preview()
+
+
+def scale_point(point, scale):
+    """Maps a frame pixel to the preview."""
+    return tuple(int(v * scale) for v in point)
 
 
 def video_streaming():
-    global frame, output_frame, focus_frame, focus_config, obj_detector, focus_break
+    global frame, focus_config, focus_break
     t = threading.currentThread()
 
+    frame_seq = focus_frames.latest().seq
+
     while getattr(t, "do_run", True):
-        frame = vc.read()
+        # process every camera frame exactly once
+        latest = vc.next_frame(frame_seq)
+        if latest is None:
+            if vc.stopped:
+                logging.error("The camera stopped delivering frames")
+                break
+            continue
+        frame_seq, frame_time, frame = latest
 
         if focus_config["focus_type"] == "image":
-            with lock:
-                output_frame = frame.copy()
-                focus_frame = frame.copy()
+            preview.update(preview_image(frame, preview_width)[0])
+            focus_frames.publish(FocusFrame(frame_seq, frame_time, frame, None, None))
 
         elif focus_config["focus_type"] == "box":
             start_point = (focus_config["frame_x"], focus_config["frame_y"])
@@ -393,54 +767,58 @@ def video_streaming():
             color = color_selected
             thickness = 2
 
-            with lock:
-                focus_frame = frame[
-                    focus_config["frame_y"] : focus_config["frame_y"]
-                    + focus_config["frame_h"],
-                    focus_config["frame_x"] : focus_config["frame_x"]
-                    + focus_config["frame_w"],
-                ]
-                frame = cv2.rectangle(frame, start_point, end_point, color, thickness)
-                output_frame = frame.copy()
+            # draw on the preview only: the box is scored on the clean frame
+            frame_draw, scale = preview_image(frame, preview_width, draw=True)
+            cv2.rectangle(
+                frame_draw,
+                scale_point(start_point, scale),
+                scale_point(end_point, scale),
+                color,
+                thickness,
+            )
+
+            preview.update(frame_draw)
+            focus_frames.publish(
+                FocusFrame(
+                    frame_seq, frame_time, frame, [start_point + end_point], None
+                )
+            )
 
         elif focus_config["focus_type"] == "object":
-            if focus_break:
-                classify_objects(tpu_socket, frame, obj_detector)
+            if focus_break and detection is not None:
+                detection.submit(frame_seq, frame, frame_time)
 
-            cut_size = [len(frame), 0, len(frame[0]), 0]
+            # draw on the preview only: the boxes are scored on the clean frame
+            frame_draw, scale = preview_image(frame, preview_width, draw=True)
+            rois = []
+            weights = []
 
-            for obj in obj_detector:
+            # the boxes stand still while the focus is searched
+            objects = obj_tracker.predict(
+                frame_time, frame.shape[1::-1], hold=not focus_break
+            )
+            for obj in objects:
                 thickness = 2
                 if obj["selected"]:
                     color = color_selected
                 else:
                     color = color_normal
 
-                frame_draw = cv2.rectangle(
-                    frame,
-                    (obj["x0"], obj["y0"]),
-                    (obj["x1"], obj["y1"]),
+                cv2.rectangle(
+                    frame_draw,
+                    scale_point((obj["x0"], obj["y0"]), scale),
+                    scale_point((obj["x1"], obj["y1"]), scale),
                     color,
                     thickness,
                 )
 
-                if obj["x0"] < cut_size[0]:
-                    cut_size[0] = obj["x0"]
-                if obj["x1"] > cut_size[1]:
-                    cut_size[1] = obj["x1"]
-                if obj["y0"] < cut_size[2]:
-                    cut_size[2] = obj["y0"]
-                if obj["y1"] > cut_size[3]:
-                    cut_size[3] = obj["y1"]
-
-            with lock:
-                output_frame = frame.copy()
-                if len(obj_detector) == 0:
-                    focus_frame = frame.copy()
-                else:
-                    focus_frame = frame[
-                        cut_size[2] : cut_size[3], cut_size[0] : cut_size[1]
-                    ]
+                rois.append((obj["x0"], obj["y0"], obj["x1"], obj["y1"]))
+                weights.append(1 if obj["selected"] else 0)
+
+            preview.update(frame_draw)
+            focus_frames.publish(
+                FocusFrame(frame_seq, frame_time, frame, rois or None, weights)
+            )
 
         fps.update()
 
@@ -491,7 +869,7 @@ def api_focus_frame():
 
 @app.route("/api/object")
 def api_focus_object():
-    global focus_config, obj_detector
+    global focus_config
 
     if (
         request.args.get("x") is not None
@@ -502,10 +880,10 @@ def api_focus_object():
         focus_config["frame_x"] = int(request.args.get("x"))
         focus_config["frame_y"] = int(request.args.get("y"))
 
-    check_object_selected(focus_config, obj_detector)
+    check_object_selected(focus_config, obj_tracker)
 
     objects = ""
-    for obj in obj_detector:
+    for obj in obj_tracker.objects():
         if obj["selected"]:
             objects = objects + obj["label"] + ", "
 
@@ -518,8 +896,19 @@ def api_focus_object():
 
 @app.route("/api/autofocus")
 def api_autofocus():
-    global thread, focus_mode, focus_phase, focus_break
+    global thread, focus_mode, focus_phase, focus_break, coarse_metric, fine_metric
     autotype = ""
+    for arg in ("coarse", "metric"):
+        if request.args.get(arg) not in (None, *focus_metrics):
+            data = {
+                "error": f"unknown focus metric: {request.args.get(arg)}",
+                "metrics": list(focus_metrics),
+            }
+            return jsonify(data), 400
+
+    coarse_metric = request.args.get("coarse", coarse_metric)
+    fine_metric = request.args.get("metric", fine_metric)
+
     if request.args.get("mode") is not None:
         if focus_phase != 0 and focus_mode != int(request.args.get("mode")):
             focus_break = True
@@ -542,12 +931,35 @@ def api_autofocus():
                 thread = threading.Thread(target=livefocus)
                 thread.daemon = True
                 thread.start()
+        elif focus_mode == 4:  # pipelined autofocus
+            if not thread.is_alive():
+                focus_break = False
+                autotype = "pipelined"
+                thread = threading.Thread(target=pipelined_autofocus)
+                thread.daemon = True
+                thread.start()
+        elif focus_mode == 5:  # single sweep autofocus
+            if not thread.is_alive():
+                focus_break = False
+                autotype = "sweep"
+                thread = threading.Thread(target=sweep_autofocus)
+                thread.daemon = True
+                thread.start()
+        elif focus_mode == 6:  # batched scan autofocus
+            if not thread.is_alive():
+                focus_break = False
+                autotype = "scan"
+                thread = threading.Thread(target=scan_autofocus)
+                thread.daemon = True
+                thread.start()
 
     data = {
         "mode": focus_mode,
         "thread_name": str(thread.name),
         "autotype": autotype,
         "focus_phase": focus_phase,
+        "coarse_metric": coarse_metric,
+        "fine_metric": fine_metric,
         "started": True,
     }
 
@@ -577,6 +989,11 @@ def api_app_status():
         "mf_calibrated": mf_calibrated,
         "mf_max_steps": mf_max_steps,
         "tpu_api": tpu_api_detected,
+        "preview_fps": preview_fps(),
+        "preview_quality": preview.quality,
+        "preview_throughput": preview.throughput(),
+        "motor_round_trips": get_motor_client(m5stack_host).round_trips.summary(),
+        "detector": detection.stats() if detection is not None else None,
     }
 
     return jsonify(data), 200
@@ -591,27 +1008,22 @@ def api_set_move_motor():
         mtype = request.args.get("mtype")
         position = int(request.args.get("position"))
 
-        motor_status = get_motor_status(m5stack_host, mtype)
-        max_steps = motor_status["max_steps"]
-        actual_position = motor_status["position"]
-
-        if position < 0:
-            position = 0
-        if position > max_steps:
-            position = max_steps
+        motor_status = get_motor_status(m5stack_host, mtype, cached=True)
+        position = min(max(position, 0), motor_status["max_steps"])
 
-        step_size = int(position - actual_position)
-        mdir = 0 if step_size < 0 else 1
+        logging.info(f"mtype: {mtype} position: {position}")
 
-        logging.info(f"mtype: {mtype} step_size: {step_size} mdir: {mdir}")
-
-        motor_status = set_move_motor(m5stack_host, mtype, abs(step_size), mdir)
+        motor_status = move_motor_to(m5stack_host, mtype, position)
 
         return jsonify(motor_status), 200
 
 
 @app.route("/api/takephoto")
 def api_take_photo():
+    """Starts an HDR photo on the photo service. The live view is stopped
+    while the photo service uses the camera, unless it takes the photos
+    through /api/still (photo_camera "broker"). The progress of the photo is
+    streamed by /api/photoevents/<id>."""
     global streaming, vc
     now = datetime.now()
     hash = now.strftime("%Y%m%d_%H%M%S")
@@ -622,13 +1034,14 @@ def api_take_photo():
         and request.args.get("aeb") is not None
         and request.args.get("iso") is not None
     ):
-        # stop live view
-        logging.info("Stopping live view to take photos!")
-        streaming.do_run = False
-        streaming.join()
-        time.sleep(0.5)
-        vc.stream.release()
-        time.sleep(0.5)
+        if photo_camera != "broker":
+            # stop live view
+            logging.info("Stopping live view to take photos!")
+            streaming.do_run = False
+            streaming.join()
+            time.sleep(0.5)
+            vc.stop()
+            time.sleep(0.5)
 
         request_link = (
             args.photo
@@ -641,13 +1054,104 @@ def api_take_photo():
             )
         )
 
-        data = requests.get(request_link)
-        task_id = data.json()["task_id"]
+        try:
+            upstream = requests.get(request_link, timeout=10)
+            upstream.raise_for_status()
+            data = upstream.json()
+            task_id = data["id"]
+        except (requests.RequestException, ValueError, KeyError) as e:
+            logging.error(f"the photo service did not start the photo: {e}")
+            if photo_camera != "broker":
+                start_live_preview()
+            status = 504 if isinstance(e, requests.Timeout) else 502
+            return jsonify({"filename": hash + "_image", "error": str(e)}), status
+        data["events"] = "/api/photoevents/{0}".format(task_id)
+
+        if photo_camera != "broker":
+            photo_check = threading.Thread(
+                target=restart_live_preview, args=(data["task_id"],)
+            )
+            photo_check.start()
 
-        photo_check = threading.Thread(target=restart_live_preview, args=(task_id,))
-        photo_check.start()
+    return jsonify(data), 200
+
+
+@app.route("/api/photoevents/<task_id>")
+def api_photo_events(task_id):
+    """Relays the progress events of a photo (Server-Sent Events of the photo
+    service: captured, aligned, merged, tonemapped, written, then done or
+    failed, each with the stage durations) to the web app."""
+    headers = {}
+    if "Last-Event-ID" in request.headers:
+        headers["Last-Event-ID"] = request.headers["Last-Event-ID"]
+    try:
+        upstream = requests.get(
+            args.photo + "/events/" + task_id,
+            headers=headers,
+            stream=True,
+            timeout=(5, 120),
+        )
+        upstream.raise_for_status()
+    except requests.Timeout as e:
+        return jsonify({"error": str(e)}), 504
+    except requests.RequestException as e:
+        if e.response is not None:
+            e.response.close()
+        return jsonify({"error": str(e)}), 502
+
+    def relay():
+        try:
+            for chunk in upstream.iter_content(chunk_size=None):
+                yield chunk
+        except requests.RequestException as e:
+            # the web app reconnects with the Last-Event-ID
+            logging.warning(f"events of photo {task_id} interrupted: {e}")
+        finally:
+            upstream.close()
+
+    return Response(
+        relay(),
+        mimetype="text/event-stream",
+        headers={"Cache-Control": "no-cache"},
+    )
 
-    return jsonify(data.json()), 200
+
+@app.route("/api/still")
+def api_still():
+    """Takes a still photo with the live camera for the photo service,
+    without stopping the preview. The exposure time in seconds (shutter,
+    automatic without) and the ISO are query parameters; the exposure stays
+    until the next still or /api/exposure.
+
+    Returns the JPEG with the exposure time in seconds in the
+    X-Exposure-Time header and the camera in X-Sensor.
+    """
+    shutter = request.args.get("shutter", type=float)
+    iso = request.args.get("iso", "")
+    iso = int(iso) if iso.isdigit() else None
+    try:
+        timestamp, image, exposure = vc.still(shutter, iso)
+    except IOError as e:
+        return jsonify({"error": str(e)}), 503
+
+    _, jpeg = cv2.imencode(".jpg", image, still_encode_param)
+    if exposure is None:
+        # the driver does not report the automatic exposure, which is at
+        # most one frame time
+        exposure = 1.0 / (camera_config["fps"] or 30.0)
+    response = Response(jpeg.tobytes(), mimetype="image/jpeg")
+    response.headers["X-Exposure-Time"] = str(exposure)
+    response.headers["X-Sensor"] = vc.sensor
+    return response
+
+
+@app.route("/api/exposure")
+def api_exposure():
+    """Sets the exposure of the live camera (shutter in seconds, automatic
+    without)."""
+    shutter = request.args.get("shutter", type=float)
+    vc.request_exposure(shutter)
+    return jsonify({"shutter": shutter}), 200
 
 
 @app.route("/api/getphotos")
@@ -671,17 +1175,91 @@ if __name__ == "__main__":
         default="192.168.178.71",
         help="IP from the ESP32 controlling the steppers",
     )
+    parser.add_argument(
+        "--camera",
+        default="0",
+        help="camera index, or image / video file to replay",
+    )
+    parser.add_argument("--width", type=int, help="camera resolution width")
+    parser.add_argument("--height", type=int, help="camera resolution height")
+    parser.add_argument("--fps", type=float, help="camera frame rate")
     parser.add_argument(
         "--htpu", default="obj-detector", help="client host for object detector"
     )
     parser.add_argument(
         "--ptpu", type=int, default=8010, help="client port for object detector"
     )
+    parser.add_argument(
+        "--framebus",
+        help="frame bus file of an object detector on the same host, "
+        "frames are sent as JPEG without it",
+    )
     parser.add_argument(
         "--photo",
         default="http://photo-service:8005",
         help="client restapi address for photo service",
     )
+    parser.add_argument(
+        "--photo-camera",
+        default=photo_camera,
+        help="camera backend of the photo service, broker to keep the live "
+        "camera and serve its photos",
+    )
+    parser.add_argument(
+        "--coarse-metric",
+        default=coarse_metric,
+        choices=list(focus_metrics),
+        help="focus metric for hill climbing and live focus",
+    )
+    parser.add_argument(
+        "--fine-metric",
+        default=fine_metric,
+        choices=list(focus_metrics),
+        help="focus metric for the fibonacci search near the peak",
+    )
+    parser.add_argument(
+        "--settle",
+        type=float,
+        default=frame_settle,
+        help="seconds after a motor move before a frame is scored",
+    )
+    parser.add_argument(
+        "--scan-dwell",
+        type=float,
+        default=scan_dwell,
+        help="seconds the motor holds each position of a batched scan, one "
+        "frame time of the camera by default",
+    )
+    parser.add_argument(
+        "--preview-width",
+        type=int,
+        default=preview_width,
+        help="maximal width of the live preview in pixels, 0 for full resolution",
+    )
+    parser.add_argument(
+        "--preview-quality",
+        type=int,
+        default=preview.max_quality,
+        help="JPEG quality of the live preview, lowered for slow clients",
+    )
+    parser.add_argument(
+        "--detect-interval",
+        type=float,
+        default=detect_interval,
+        help="minimal time between object detections in seconds",
+    )
+    parser.add_argument(
+        "--detect-every",
+        type=int,
+        default=detect_every,
+        help="detect objects at most every that many frames, tracked in between",
+    )
+    parser.add_argument(
+        "--score-workers",
+        type=int,
+        default=2,
+        help="threads computing focus scores",
+    )
     parser.add_argument(
         "-v", "--verbose", action="store_true", help="set logging level to debug"
     )
@@ -696,6 +1274,20 @@ if __name__ == "__main__":
     logging.basicConfig(level=level)
 
     m5stack_host = args.motor
+    photo_camera = args.photo_camera
+    camera_config["src"] = int(args.camera) if args.camera.isdigit() else args.camera
+    camera_config["width"] = args.width
+    camera_config["height"] = args.height
+    camera_config["fps"] = args.fps
+    coarse_metric = args.coarse_metric
+    fine_metric = args.fine_metric
+    frame_settle = args.settle
+    scan_dwell = args.scan_dwell
+    detect_interval = args.detect_interval
+    detect_every = args.detect_every
+    focus_scorer = FocusScorer(args.score_workers, ring=frame_ring)
+    preview_width = args.preview_width
+    preview = MJPEGBroadcaster(args.preview_quality)
 
     try:
         tpu_socket.connect((args.htpu, args.ptpu))
@@ -704,7 +1296,19 @@ if __name__ == "__main__":
     except:
         tpu_api_detected = False
 
-    streaming = threading.Thread(target=video_streaming)
-    streaming.start()
+    if args.framebus:
+        try:
+            framebus = FrameBus(args.framebus)
+            logging.info(f"Sending frames to the object detector via {args.framebus}")
+        except (OSError, ValueError) as e:
+            logging.warning(f"frame bus not available ({e}), sending JPEG frames")
+    tpu_detector = DetectorConnection(tpu_socket, framebus)
+    if tpu_api_detected:
+        detection = DetectionStage(
+            tpu_detector, obj_tracker, detect_interval, detect_every, frame_ring
+        ).start()
+
+    preview.start()
+    start_live_preview()
 
     app.run(host="0.0.0.0", debug=True, threaded=True, use_reloader=False)
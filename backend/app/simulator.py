@@ -0,0 +1,262 @@
+"""
+Copyright (C) 2020 Mauro Riva
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+import re
+import json
+import time
+import threading
+from urllib.parse import urlsplit, parse_qs
+import cv2
+import numpy as np
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from capture import CaptureSource
+
+
+class SimulatedLens:
+    """Focus motor of a simulated lens. Moves block like the M5Stack API:
+    a request latency plus the travel time at constant speed, and the
+    position changes continuously while the motor runs.
+    """
+
+    def __init__(
+        self,
+        max_steps=3000,
+        focus_position=1234,
+        position=1500,
+        speed=2000.0,
+        latency=0.02,
+    ):
+        self.max_steps = max_steps
+        self.focus_position = focus_position
+        self.speed = speed
+        self.latency = latency
+        self.moves = 0
+        self.status_requests = 0
+        self._lock = threading.Lock()
+        self._start = self._target = position
+        self._t_start = self._t_end = 0.0
+
+    @property
+    def position(self):
+        with self._lock:
+            now = time.monotonic()
+            if now >= self._t_end:
+                return self._target
+            progress = (now - self._t_start) / (self._t_end - self._t_start)
+            return self._start + (self._target - self._start) * progress
+
+    def move(self, step, mdir):
+        """Moves step steps towards mdir (0: backwards, 1: forwards) and
+        returns (done, position) once the motor stopped.
+        """
+        time.sleep(self.latency / 2)
+        start = self.position
+        target = start + step if mdir else start - step
+        clipped = int(min(max(target, 0), self.max_steps))
+        duration = abs(clipped - start) / self.speed
+        with self._lock:
+            self._start, self._target = start, clipped
+            self._t_start = time.monotonic()
+            self._t_end = self._t_start + duration
+        self.moves += 1
+        time.sleep(duration + self.latency / 2)
+        # a move beyond the limits stops there and is reported as not done
+        return clipped == int(target), clipped
+
+    def move_to(self, position):
+        """Moves to an absolute position, see move()."""
+        step = int(position) - int(self.position)
+        return self.move(abs(step), 0 if step < 0 else 1)
+
+    def status(self):
+        time.sleep(self.latency)
+        self.status_requests += 1
+        return self.state()
+
+    def state(self):
+        """Returns the status reported along with batched moves."""
+        return {
+            "position": int(self.position),
+            "max_steps": self.max_steps,
+            "calibrated": True,
+        }
+
+
+class M5StackServer:
+    """In-process stand-in for the M5Stack stepper board. It serves the
+    firmware endpoints /move/<mtype>/<step>/<dir> and /status/<mtype> over
+    HTTP for one SimulatedLens per motor type, so server.py can talk to it
+    through m5stack_host exactly like to the real board.
+
+    With batched=True it also serves the batched protocol:
+
+    - /goto/<mtype>/<position>: absolute move, answered with the status and
+      position once the motor stopped
+    - /batch/<mtype>/<p1>,<p2>,...?settle=<ms>&dwell=<ms>: queue of absolute
+      moves. After each move the board waits settle ms, sends one JSON line
+      {"index", "status", "position"} and holds the position for dwell ms.
+      The last line is the motor status.
+    """
+
+    def __init__(self, lenses, host="127.0.0.1", port=0, batched=True):
+        self.lenses = lenses
+        self.batched = batched
+        self.requests = 0
+        simulator = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                simulator.requests += 1
+                batch = simulator.batched and re.fullmatch(
+                    r"/batch/(\w+)/([\d,]+)", urlsplit(self.path).path
+                )
+                if batch and batch.group(1) in simulator.lenses:
+                    self.send_response(200)
+                    self.send_header("Content-Type", "application/x-ndjson")
+                    self.end_headers()
+                    for line in simulator.handle_batch(self.path):
+                        self.wfile.write(json.dumps(line).encode() + b"\n")
+                        self.wfile.flush()
+                    return
+
+                status, body = simulator.handle(self.path)
+                payload = json.dumps(body).encode()
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.httpd = ThreadingHTTPServer((host, port), Handler)
+        self.httpd.daemon_threads = True
+
+    @property
+    def host(self):
+        """Value for server.m5stack_host / the --motor argument."""
+        host, port = self.httpd.server_address[:2]
+        return f"{host}:{port}"
+
+    def handle(self, path):
+        """Returns the (HTTP status, JSON body) answer to a request path."""
+        move = re.fullmatch(r"/move/(\w+)/(\d+)/([01])", path)
+        goto = self.batched and re.fullmatch(r"/goto/(\w+)/(\d+)", path)
+        status = re.fullmatch(r"/status/(\w+)", path)
+        match = move or goto or status
+        mtype = match.group(1) if match else None
+        if mtype not in self.lenses:
+            return 404, {"status": "false"}
+
+        lens = self.lenses[mtype]
+        if move:
+            done, position = lens.move(int(move.group(2)), int(move.group(3)))
+            return 200, {"status": "true" if done else "false", "position": position}
+        if goto:
+            done, position = lens.move_to(int(goto.group(2)))
+            return 200, dict(lens.state(), status="true" if done else "false")
+        return 200, lens.status()
+
+    def handle_batch(self, path):
+        """Runs a /batch request and yields its JSON lines."""
+        url = urlsplit(path)
+        mtype, targets = re.fullmatch(r"/batch/(\w+)/([\d,]+)", url.path).groups()
+        query = parse_qs(url.query)
+        settle = int(query.get("settle", ["0"])[0]) / 1e3
+        dwell = int(query.get("dwell", ["0"])[0]) / 1e3
+
+        lens = self.lenses[mtype]
+        for index, target in enumerate(t for t in targets.split(",") if t):
+            done, position = lens.move_to(int(target))
+            time.sleep(settle)
+            yield {
+                "index": index,
+                "status": "true" if done else "false",
+                "position": position,
+            }
+            time.sleep(dwell)
+        yield lens.state()
+
+    def start(self):
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+class SimulatedCamera(CaptureSource):
+    """Capture source looking through a SimulatedLens. The reference image
+    is blurred with a Gaussian whose sigma grows with the distance to the
+    focus position, and every frame gets sensor noise.
+    """
+
+    def __init__(
+        self, lens, image=None, fps=30, blur_scale=100.0, noise=2.0, ring=None
+    ):
+        super().__init__(ring)
+        self.lens = lens
+        self.fps = fps
+        self.blur_scale = blur_scale
+        self.image = synthetic_scene() if image is None else image
+        self._rendered = 0
+        rng = np.random.RandomState(1)
+        self._noise = [
+            rng.normal(0, noise, self.image.shape).astype(np.float32) for _ in range(8)
+        ]
+
+    def capture(self, buffer):
+        self.pace(self.fps)
+        timestamp = time.monotonic()
+        return self.render(self.lens.position, buffer), timestamp
+
+    def render(self, position, out=None):
+        """Returns a new frame seen at a lens position, rendered into out if
+        given."""
+        sigma = abs(position - self.lens.focus_position) / self.blur_scale
+        frame = self.image
+        if sigma > 2:
+            # strong blur: blur a downscaled image with sigma 2 and upscale it
+            height, width = frame.shape[:2]
+            small = cv2.resize(
+                frame, None, fx=2 / sigma, fy=2 / sigma, interpolation=cv2.INTER_AREA
+            )
+            small = cv2.GaussianBlur(small, (0, 0), 2)
+            frame = cv2.resize(small, (width, height), interpolation=cv2.INTER_LINEAR)
+        elif sigma >= 0.1:
+            frame = cv2.GaussianBlur(frame, (0, 0), sigma)
+        noise = self._noise[self._rendered % len(self._noise)]
+        self._rendered += 1
+        if out is None:
+            return cv2.add(frame, noise, dtype=cv2.CV_8U)
+        return cv2.add(frame, noise, dst=out, dtype=cv2.CV_8U)
+
+
+def synthetic_scene(shape=(480, 640), seed=0):
+    """Returns a reproducible BGR test scene with edges at several scales."""
+    rng = np.random.RandomState(seed)
+    scene = np.full(shape + (3,), 128, dtype=np.uint8)
+    for _ in range(60):
+        x0, y0 = rng.randint(0, shape[1]), rng.randint(0, shape[0])
+        w, h = rng.randint(10, shape[1] // 4), rng.randint(10, shape[0] // 4)
+        color = tuple(int(c) for c in rng.randint(0, 256, 3))
+        cv2.rectangle(scene, (x0, y0), (x0 + w, y0 + h), color, -1)
+    noise = rng.randint(-20, 21, scene.shape)
+    return np.clip(scene.astype(np.int16) + noise, 0, 255).astype(np.uint8)
@@ -0,0 +1,40 @@
+"""
+Copyright (C) 2020 Mauro Riva
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+import time
+
+import numpy as np
+
+from capture import FileCapture
+
+
+def test_still_waits_for_long_exposures():
+    frames = [np.full((48, 64, 3), 64, np.uint8)]
+    source = FileCapture(frames, fps=30.0, auto_exposure=1 / 30).start()
+    try:
+        source.next_frame(timeout=1.0)
+        start = time.monotonic()
+        # one frame of the long exposure takes longer than the timeout
+        timestamp, image, exposure = source.still(0.8, timeout=0.2)
+        assert time.monotonic() - start >= 0.6
+        assert exposure == 0.8
+        assert image.mean() == 255
+        # back from the long exposure
+        timestamp, image, exposure = source.still(None, timeout=0.2)
+        assert image.mean() == 64
+    finally:
+        source.stop()
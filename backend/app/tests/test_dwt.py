@@ -0,0 +1,82 @@
+"""
+Copyright (C) 2020 Mauro Riva
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+import cv2
+import numpy as np
+import pytest
+
+from blur_detection import dwt
+
+
+def baseline_rowdec(X, h):
+    # ROWDEC of the original engine: symmetric index extension without
+    # repetition of the end samples, one tap at a time, float64
+    c = X.shape[1]
+    m2 = h.size // 2
+    xe = np.array(
+        [
+            x
+            for y in [range(m2, 0, -1), range(c), range(c - 2, c - m2 - 2, -1)]
+            for x in y
+        ]
+    )
+    t = np.array(range(0, c - 1, 2))
+    Y = np.zeros((X.shape[0], t.size))
+    for i in range(h.size):
+        Y = Y + h[i] * X[:, xe[t + i]]
+    return Y
+
+
+def baseline_low_res_score(X, N=3):
+    h = np.array([-1, 2, 6, 2, -1]) / 8
+    score = np.var(X)
+    X = np.asarray(X, dtype=np.float64)
+    for _ in range(N):
+        X = baseline_rowdec(baseline_rowdec(X, h).T, h).T
+        score += np.var(X)
+    return score
+
+
+def textured(shape, seed):
+    rng = np.random.RandomState(seed)
+    image = rng.randint(0, 256, shape).astype(np.uint8)
+    return cv2.GaussianBlur(image, (5, 5), 1.0)
+
+
+@pytest.mark.parametrize(
+    "shape", [(64, 64), (480, 640), (101, 77), (99, 128), (37, 200), (250, 33)]
+)
+def test_low_res_score_matches_baseline(shape):
+    for seed in range(3):
+        image = textured(shape, seed)
+        expected = baseline_low_res_score(image)
+        assert dwt.low_res_score(image) == pytest.approx(expected, rel=1e-4)
+
+
+@pytest.mark.parametrize("shape", [(64, 64), (101, 77), (37, 200)])
+def test_levels_match_baseline(shape):
+    image = textured(shape, 7)
+    h = np.array(dwt.LEGALL_H1, dtype=np.float64)
+    X = image.astype(np.float64)
+    for level in dwt.nleveldwt(image)[1:]:
+        X = baseline_rowdec(baseline_rowdec(X, h).T, h).T
+        assert level.shape == X.shape
+        np.testing.assert_allclose(level, X, rtol=1e-4, atol=1e-2)
+
+
+def test_flat_image_scores_zero():
+    assert dwt.low_res_score(np.full((48, 64), 128, np.uint8)) == pytest.approx(0)
@@ -0,0 +1,40 @@
+"""
+Copyright (C) 2020 Mauro Riva
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+import pytest
+
+import benchmark
+
+# focus error (motor steps) the autofocus strategies reach on the simulated rig
+FOCUS_TOLERANCE = 40
+
+
+@pytest.mark.parametrize(
+    "after, time_limit",
+    [
+        (2.0, 8.0),  # the focus plane moves during the first autofocus
+        (6.0, 10.0),  # and once the focus is locked
+    ],
+)
+def test_livefocus_follows_a_scene_change(monkeypatch, after, time_limit):
+    monkeypatch.setitem(
+        benchmark.focus_strategies,
+        "drift",
+        lambda server, lens: benchmark.drift_livefocus(server, lens, after, shift=150),
+    )
+    result = benchmark.run_focus_strategy("drift", 1500, 1234, time_limit)
+    assert result["error"] <= FOCUS_TOLERANCE
@@ -0,0 +1,94 @@
+"""
+Copyright (C) 2020 Mauro Riva
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+import cv2
+import numpy as np
+import pytest
+
+from blur_detection import focus_metrics, get_focus_scores
+from blur_detection import metrics
+
+
+@pytest.fixture
+def frame():
+    rng = np.random.RandomState(0)
+    gray = cv2.GaussianBlur(
+        rng.randint(0, 256, (480, 640)).astype(np.uint8), (5, 5), 1.0
+    )
+    return cv2.cvtColor(gray, cv2.COLOR_GRAY2BGR)
+
+
+def per_roi(frame, rois, name):
+    gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+    return [focus_metrics[name](gray[y0:y1, x0:x1]) for x0, y0, x1, y1 in rois]
+
+
+@pytest.mark.parametrize("name", list(focus_metrics))
+def test_rois_outside_the_frame_score_zero(frame, name):
+    rois = [(10, 10, 100, 100), (700, 10, 800, 100), (-50, -50, -10, -10)]
+    scores = get_focus_scores(frame, rois, name)
+    assert len(scores) == 3
+    assert scores[0] == pytest.approx(per_roi(frame, rois[:1], name)[0])
+    assert scores[0] > 0
+    assert list(scores[1:]) == [0, 0]
+
+
+@pytest.mark.parametrize("name", list(focus_metrics))
+def test_degenerate_and_tiny_rois_score_zero(frame, name):
+    rois = [
+        (100, 100, 100, 200),  # zero width
+        (100, 100, 200, 100),  # zero height
+        (200, 200, 150, 250),  # inverted
+        (300, 300, 303, 400),  # 3 px wide
+        (630, 470, 700, 500),  # clipped to 10 x 10
+        (635, 10, 700, 100),  # clipped to 5 px
+    ]
+    scores = get_focus_scores(frame, rois, name)
+    assert len(scores) == len(rois)
+    assert np.all(np.isfinite(scores))
+    assert list(scores[[0, 1, 2, 3, 5]]) == [0] * 5
+    assert scores[4] > 0
+
+
+@pytest.mark.parametrize("name", list(focus_metrics))
+def test_no_valid_roi(frame, name):
+    assert list(get_focus_scores(frame, [(700, 0, 800, 100)], name)) == [0]
+    assert len(get_focus_scores(frame, [], name)) == 0
+
+
+@pytest.mark.parametrize("name", list(metrics.batch_focus_metrics))
+def test_batched_scores_match_per_roi(frame, name):
+    # enough identical boxes for the batched path
+    rois = [(100, 80, 400, 380)] * 6 + [(150, 100, 380, 300)] * 6
+    batch, _, _ = metrics.batch_focus_metrics[name]
+    gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+    scores = get_focus_scores(frame, rois, name)
+    # the batched maps see the pixels around the boxes instead of reflected
+    # borders, which moves the scores slightly
+    np.testing.assert_allclose(scores, per_roi(frame, rois, name), rtol=0.03)
+    x0, y0 = 100, 80  # origin of the bounding box
+    boxes = np.array(rois) - [x0, y0, x0, y0]
+    np.testing.assert_allclose(scores, batch(gray[y0:380, x0:400], boxes))
+
+
+@pytest.mark.parametrize("name", list(metrics.batch_focus_metrics))
+def test_few_rois_are_scored_on_crops(frame, name):
+    # overlapping, but fewer boxes than the batched path pays off for
+    _, min_rois, _ = metrics.batch_focus_metrics[name]
+    rois = [(100, 80, 400, 380)] * (min_rois - 1)
+    scores = get_focus_scores(frame, rois, name)
+    assert list(scores) == per_roi(frame, rois, name)
@@ -0,0 +1,62 @@
+"""
+Copyright (C) 2020 Mauro Riva
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+import pytest
+import requests
+
+from motors import MotorClient
+from simulator import M5StackServer, SimulatedLens
+
+
+@pytest.fixture
+def board():
+    # a slow motor: 200 steps take one second
+    lens = SimulatedLens(position=500, speed=200.0, latency=0.01)
+    server = M5StackServer({"focus": lens}, batched=False).start()
+    yield server, lens
+    server.stop()
+
+
+def test_move_timeout_grows_with_the_steps(board):
+    server, lens = board
+    client = MotorClient(server.host, timeout=0.2, step_time=0.01)
+    client.status("focus")
+    assert client.move("focus", 100, 1) == (True, 600)
+    assert client.status("focus", cached=True)["position"] == 600
+
+
+def test_move_timeout_raises_instead_of_a_stale_position(board):
+    server, lens = board
+    client = MotorClient(server.host, timeout=0.2, step_time=0.0)
+    client.status("focus")
+    with pytest.raises(requests.Timeout):
+        client.move("focus", 100, 1)
+    # the cached position is dropped, the next status asks the board
+    requests_before = lens.status_requests
+    client.status("focus", cached=True)
+    assert lens.status_requests == requests_before + 1
+
+
+def test_absolute_moves_without_goto_start_from_the_board_position(board):
+    server, lens = board
+    client = MotorClient(server.host)
+    client.status("focus")
+    # moved by another client since the status was cached
+    lens.move_to(800)
+    assert client.move_to("focus", 700) == (True, 700)
+    assert client.batched is False
+    assert lens.position == 700
@@ -0,0 +1,43 @@
+"""
+Copyright (C) 2020 Mauro Riva
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+import numpy as np
+import pytest
+
+from obj_detector import FrameBus
+
+
+def test_frames_are_written_into_the_bus(tmp_path):
+    bus = FrameBus.create(str(tmp_path / "frames"), (32, 16))
+    frame = np.zeros((120, 160, 3), np.uint8)
+    frame[..., 2] = 255  # red in BGR
+    assert [bus.write(frame), bus.write(frame), bus.write(frame)] == [0, 1, 0]
+    assert bus.slots[0].shape == (16, 32, 3)
+    assert (bus.slots[0][..., 0] == 255).all()  # red in RGB
+
+
+def test_short_or_foreign_bus_files_are_rejected(tmp_path):
+    path = str(tmp_path / "frames")
+    FrameBus.create(path, (32, 16))
+    with open(path, "r+b") as bus_file:
+        bus_file.truncate(100)
+    with pytest.raises(ValueError):
+        FrameBus(path)
+    with open(path, "wb") as bus_file:
+        bus_file.write(b"RP")
+    with pytest.raises(ValueError):
+        FrameBus(path)
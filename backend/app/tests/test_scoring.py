@@ -0,0 +1,76 @@
+"""
+Copyright (C) 2020 Mauro Riva
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+import threading
+
+import numpy as np
+import pytest
+
+import scoring
+from frames import FocusFrame, FrameRing
+from scoring import FocusScorer
+
+
+@pytest.fixture
+def ring():
+    ring = FrameRing(slots=2)
+    ring.write(np.random.RandomState(0).randint(0, 256, (120, 160), np.uint8))
+    return ring
+
+
+def focus_frame(ring):
+    seq, timestamp, image = ring.latest()
+    return FocusFrame(seq, timestamp, image, None, None)
+
+
+def test_score_valid_frame(ring):
+    scorer = FocusScorer(workers=1, ring=ring)
+    frame = focus_frame(ring)
+    score = scorer.score(frame, "tenengrad")
+    assert score is not None and score > 0
+    # cached: scored once
+    assert scorer.score(frame, "tenengrad") == score
+    assert scorer.scored == 1
+    scorer.shutdown()
+
+
+def test_score_frame_overwritten_while_scored(ring, monkeypatch):
+    started, overwritten = threading.Event(), threading.Event()
+    score_frame = scoring.score_frame
+
+    def slow_score_frame(focus_frame, metric):
+        started.set()
+        overwritten.wait(5)
+        return score_frame(focus_frame, metric)
+
+    monkeypatch.setattr(scoring, "score_frame", slow_score_frame)
+    scorer = FocusScorer(workers=1, ring=ring)
+    frame = focus_frame(ring)
+    future = scorer.submit(frame, "tenengrad")
+
+    # the capture thread laps the ring while the frame is scored
+    assert started.wait(5)
+    for _ in range(len(ring)):
+        ring.write(np.zeros((120, 160), np.uint8))
+    overwritten.set()
+
+    assert future.result(5) is None
+    # not cached: the frame is scored again (and is still torn)
+    assert scorer.score(frame, "tenengrad") is None
+    assert scorer.scored == 2
+    assert scorer.cache.get(scorer.cache.key(frame, "tenengrad")) is None
+    scorer.shutdown()
@@ -0,0 +1,110 @@
+"""
+Copyright (C) 2020 Mauro Riva
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+from tracker import ObjectTracker
+
+
+def detection(x0, y0, x1, y1, label="person"):
+    return {"label": label, "percent": 90, "x0": x0, "y0": y0, "x1": x1, "y1": y1}
+
+
+def moving_tracker(vx):
+    # one track moving vx pixels per second
+    tracker = ObjectTracker(max_age=10.0)
+    tracker.update([detection(100, 100, 200, 200)], 0.0)
+    tracker.update([detection(100 + vx, 100, 200 + vx, 200)], 1.0)
+    return tracker
+
+
+def test_predict_moves_at_constant_velocity():
+    (track,) = moving_tracker(40).predict(2.0)
+    # smoothed velocity: half of the measured 40 px/s
+    assert (track["x0"], track["y0"], track["x1"], track["y1"]) == (160, 100, 260, 200)
+
+
+def test_predict_clips_to_the_frame():
+    (track,) = moving_tracker(40).predict(8.0, (320, 240))
+    assert (track["x0"], track["y0"], track["x1"], track["y1"]) == (280, 100, 320, 200)
+
+
+def test_predict_drops_tracks_leaving_the_frame():
+    tracker = moving_tracker(40)
+    tracker.update([detection(10, 10, 40, 40, "cat")], 1.0)
+    assert len(tracker.predict(9.0, (320, 240))) == 2
+    objects = tracker.predict(10.0, (320, 240))
+    assert [o["label"] for o in objects] == ["cat"]
+    assert [o["label"] for o in tracker.objects()] == ["cat"]
+
+
+def test_predict_without_size_does_not_clip():
+    (track,) = moving_tracker(40).predict(10.0)
+    assert (track["x0"], track["x1"]) == (320, 420)
+
+
+def test_predict_holds_the_boxes_until_the_next_detection():
+    tracker = moving_tracker(40)
+    (track,) = tracker.predict(2.0, hold=True)
+    assert (track["x0"], track["x1"]) == (160, 260)
+    # no detections while focusing, and none extrapolated after it
+    (track,) = tracker.predict(4.0, hold=True)
+    assert (track["x0"], track["x1"]) == (160, 260)
+    (track,) = tracker.predict(5.0)
+    assert (track["x0"], track["x1"]) == (160, 260)
+    tracker.update([detection(180, 100, 280, 200)], 6.0)
+    (track,) = tracker.predict(7.0)
+    assert track["x0"] > 180
+
+
+def test_objects_with_the_same_label_keep_their_tracks():
+    tracker = ObjectTracker()
+    tracker.update([detection(0, 0, 100, 100), detection(150, 0, 250, 100)], 0.0)
+    ids = {o["x0"]: o["id"] for o in tracker.objects()}
+    # listed in the other order and both moved a bit
+    tracker.update([detection(160, 0, 260, 100), detection(10, 0, 110, 100)], 0.5)
+    objects = tracker.objects()
+    assert len(objects) == 2
+    assert {o["x0"]: o["id"] for o in objects} == {10: ids[0], 160: ids[150]}
+
+
+def test_lost_tracks_expire_after_max_age():
+    tracker = ObjectTracker(max_age=2.0)
+    tracker.update([detection(0, 0, 100, 100)], 0.0)
+    tracker.update([], 1.5)
+    assert len(tracker.objects()) == 1
+    tracker.update([], 2.5)
+    assert tracker.objects() == []
+
+
+def test_detections_below_the_iou_threshold_start_new_tracks():
+    # IoU 0.25, centers as far apart as the boxes are wide
+    moved = detection(60, 0, 160, 100)
+    tracker = ObjectTracker(iou_threshold=0.3)
+    tracker.update([detection(0, 0, 100, 100)], 0.0)
+    tracker.update([moved], 0.1)
+    assert sorted(o["id"] for o in tracker.objects()) == [1, 2]
+
+    tracker = ObjectTracker(iou_threshold=0.2)
+    tracker.update([detection(0, 0, 100, 100)], 0.0)
+    tracker.update([moved], 0.1)
+    assert [(o["id"], o["x0"]) for o in tracker.objects()] == [(1, 60)]
+
+
+def test_other_labels_do_not_match():
+    tracker = ObjectTracker()
+    tracker.update([detection(0, 0, 100, 100)], 0.0)
+    tracker.update([detection(0, 0, 100, 100, "cat")], 0.1)
+    assert sorted(o["label"] for o in tracker.objects()) == ["cat", "person"]
@@ -0,0 +1,197 @@
+"""
+Copyright (C) 2020 Mauro Riva
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+import time
+import threading
+
+
+def box_iou(a, b):
+    """Returns the intersection over union of two (x0, y0, x1, y1) boxes."""
+    w = min(a[2], b[2]) - max(a[0], b[0])
+    h = min(a[3], b[3]) - max(a[1], b[1])
+    if w <= 0 or h <= 0:
+        return 0.0
+    inter = w * h
+    union = (a[2] - a[0]) * (a[3] - a[1]) + (b[2] - b[0]) * (b[3] - b[1]) - inter
+    return inter / union if union > 0 else 0.0
+
+
+def _box(obj):
+    return (obj["x0"], obj["y0"], obj["x1"], obj["y1"])
+
+
+def _center(box):
+    return (box[0] + box[2]) / 2, (box[1] + box[3]) / 2
+
+
+class ObjectTracker:
+    """Keeps the detected objects as tracks between detector calls.
+
+    Detections are associated with the tracks of the same label by IoU
+    with the predicted box, or, for small or fast objects that do not
+    overlap any more, by the distance between the centers. Every track
+    keeps its id (and its selection) while it is matched and survives
+    max_age seconds without detection. The velocity of each track is
+    estimated from its detections, and predict() moves the boxes at
+    constant velocity, so the focus ROIs follow moving objects while the
+    detector only runs every few frames. While the focus is searched, the
+    detector pauses and predict(hold=True) keeps the boxes where they are,
+    so every focus step scores the same regions; a held track moves again
+    once it is detected again.
+
+    The tracks are dicts (id, label, percent, x0, y0, x1, y1, selected)
+    indexed by id.
+
+    Args:
+        iou_threshold ([float]): minimal IoU to match a detection
+        max_age ([float]): seconds a track survives without detection
+        smoothing ([float]): weight of the latest velocity measurement
+    """
+
+    def __init__(self, iou_threshold=0.3, max_age=2.0, smoothing=0.5):
+        self.iou_threshold = iou_threshold
+        self.max_age = max_age
+        self.smoothing = smoothing
+        self.tracks = {}
+        self._next_id = 1
+        self._lock = threading.Lock()
+
+    def _predicted(self, track, timestamp):
+        if track["held"]:
+            return _box(track)
+        dt = min(max(timestamp - track["detected"], 0.0), self.max_age)
+        dx, dy = track["vx"] * dt, track["vy"] * dt
+        x0, y0, x1, y1 = track["box"]
+        return (x0 + dx, y0 + dy, x1 + dx, y1 + dy)
+
+    def _match_score(self, box, detection):
+        score = box_iou(box, detection)
+        if score >= self.iou_threshold:
+            return score
+        # no overlap left: accept centers closer than half the box size,
+        # ranked below every IoU match
+        (cx, cy), (dx, dy) = _center(box), _center(detection)
+        limit = max(box[2] - box[0], box[3] - box[1]) / 2
+        distance = ((cx - dx) ** 2 + (cy - dy) ** 2) ** 0.5
+        return 1e-3 * (1 - distance / limit) if distance < limit else 0.0
+
+    def update(self, detections, timestamp=None):
+        """Associates the detections of one frame with the tracks.
+
+        Args:
+            detections ([list]): dicts with label, percent, x0, y0, x1, y1
+            timestamp ([float]): capture time of the frame (time.monotonic())
+        """
+        timestamp = time.monotonic() if timestamp is None else timestamp
+        with self._lock:
+            pairs = []
+            for track_id, track in self.tracks.items():
+                predicted = self._predicted(track, timestamp)
+                for idx, detection in enumerate(detections):
+                    if detection["label"] != track["label"]:
+                        continue
+                    score = self._match_score(predicted, _box(detection))
+                    if score > 0:
+                        pairs.append((score, track_id, idx))
+
+            matched_tracks, matched_detections = set(), set()
+            for score, track_id, idx in sorted(pairs, reverse=True):
+                if track_id in matched_tracks or idx in matched_detections:
+                    continue
+                matched_tracks.add(track_id)
+                matched_detections.add(idx)
+                self._correct(self.tracks[track_id], detections[idx], timestamp)
+
+            for idx, detection in enumerate(detections):
+                if idx not in matched_detections:
+                    self._add(detection, timestamp)
+
+            expired = [
+                track_id
+                for track_id, track in self.tracks.items()
+                if timestamp - track["detected"] > self.max_age
+            ]
+            for track_id in expired:
+                del self.tracks[track_id]
+
+    def _correct(self, track, detection, timestamp):
+        box = _box(detection)
+        dt = timestamp - track["detected"]
+        if dt > 0:
+            (cx, cy), (px, py) = _center(box), _center(track["box"])
+            s = self.smoothing
+            track["vx"] = s * (cx - px) / dt + (1 - s) * track["vx"]
+            track["vy"] = s * (cy - py) / dt + (1 - s) * track["vy"]
+        track.update(detection)
+        track["box"] = box
+        track["detected"] = timestamp
+        track["held"] = False
+
+    def _add(self, detection, timestamp):
+        track = dict(detection, id=self._next_id, selected=False)
+        track.update(box=_box(detection), detected=timestamp, vx=0.0, vy=0.0)
+        track["held"] = False
+        self.tracks[self._next_id] = track
+        self._next_id += 1
+
+    def predict(self, timestamp=None, size=None, hold=False):
+        """Moves the tracks to their predicted position at timestamp. With
+        the frame size, the boxes are clipped to the frame and the tracks
+        that left it are dropped.
+
+        Args:
+            timestamp ([float]): capture time of the frame (time.monotonic())
+            size ([tuple]): frame size (width, height), None not to clip
+            hold ([bool]): keep the boxes in place until the next detection
+
+        Returns:
+            [list]: snapshot of the tracks
+        """
+        timestamp = time.monotonic() if timestamp is None else timestamp
+        with self._lock:
+            left = []
+            for track_id, track in self.tracks.items():
+                x0, y0, x1, y1 = map(int, self._predicted(track, timestamp))
+                track["held"] = track["held"] or hold
+                if size is not None:
+                    width, height = size
+                    x0, x1 = min(max(x0, 0), width), min(max(x1, 0), width)
+                    y0, y1 = min(max(y0, 0), height), min(max(y1, 0), height)
+                    if x1 <= x0 or y1 <= y0:
+                        left.append(track_id)
+                track["x0"], track["y0"], track["x1"], track["y1"] = x0, y0, x1, y1
+            for track_id in left:
+                del self.tracks[track_id]
+            return [dict(track) for track in self.tracks.values()]
+
+    def objects(self):
+        """Returns a snapshot of the tracks."""
+        with self._lock:
+            return [dict(track) for track in self.tracks.values()]
+
+    def get(self, track_id):
+        """Returns a snapshot of a track, None if it expired."""
+        with self._lock:
+            track = self.tracks.get(track_id)
+            return dict(track) if track is not None else None
+
+    def select(self, x, y):
+        """Toggles the selection of the tracks containing a point."""
+        with self._lock:
+            for track in self.tracks.values():
+                if track["x0"] < x < track["x1"] and track["y0"] < y < track["y1"]:
+                    track["selected"] = not track["selected"]
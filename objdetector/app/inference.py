@@ -0,0 +1,170 @@
+"""
+Copyright (C) 2020 Mauro Riva
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+import time
+import logging
+import cv2
+import numpy as np
+
+try:
+    from pycoral.adapters.common import input_size
+    from pycoral.adapters.detect import get_objects
+    from pycoral.utils.dataset import read_label_file
+    from pycoral.utils.edgetpu import make_interpreter
+    from pycoral.utils.edgetpu import run_inference
+except ImportError:  # only the CPU stand-in is available
+    make_interpreter = None
+
+
+class Preprocessor:
+    """Turns JPEG camera frames into model inputs.
+
+    The JPEG is decoded at the smallest reduced size (1/2, 1/4 or 1/8,
+    scaled during the decoding) that still covers the model input, then
+    resized and converted to RGB in place into a preallocated input tensor.
+
+    Args:
+        size ([tuple]): model input size (width, height)
+        tensors ([int]): number of preallocated input tensors
+    """
+
+    reductions = (
+        (8, cv2.IMREAD_REDUCED_COLOR_8),
+        (4, cv2.IMREAD_REDUCED_COLOR_4),
+        (2, cv2.IMREAD_REDUCED_COLOR_2),
+    )
+
+    def __init__(self, size, tensors=1):
+        self.size = size
+        self.tensors = [
+            np.empty((size[1], size[0], 3), np.uint8) for _ in range(tensors)
+        ]
+
+    def imread_flag(self, width, height):
+        """Returns the imdecode flag for a frame of width x height pixels."""
+        for factor, flag in self.reductions:
+            if width // factor >= self.size[0] and height // factor >= self.size[1]:
+                return flag
+        return cv2.IMREAD_COLOR
+
+    def jpeg(self, payload, width, height, index=0):
+        """Decodes a JPEG camera frame of width x height pixels into the
+        input tensor index and returns the tensor.
+        """
+        image = cv2.imdecode(
+            np.frombuffer(payload, np.uint8), self.imread_flag(width, height)
+        )
+        if image is None:
+            raise ValueError("invalid JPEG image")
+        tensor = self.tensors[index]
+        cv2.resize(image, self.size, dst=tensor)
+        cv2.cvtColor(tensor, cv2.COLOR_BGR2RGB, dst=tensor)
+        return tensor
+
+
+class EdgeTPUModel:
+    """Object detection model running on the Coral Edge TPU.
+
+    Args:
+        model ([str]): path of the Edge TPU tflite model
+        labels ([str]): path of the label file
+        threshold ([float]): class score threshold
+        top_k ([int]): maximal number of objects per frame
+    """
+
+    def __init__(self, model, labels, threshold=0.4, top_k=3):
+        if make_interpreter is None:
+            raise RuntimeError("pycoral is not installed")
+        self.interpreter = make_interpreter(model)
+        self.interpreter.allocate_tensors()
+        self.labels = read_label_file(labels)
+        self.size = input_size(self.interpreter)
+        self.threshold = threshold
+        self.top_k = top_k
+
+    def detect(self, frames):
+        """Detects the objects on a batch of frames. The compiled models take
+        one frame per invocation, so the batch runs back to back on the
+        interpreter.
+
+        Args:
+            frames ([list]): RGB frames of the model input size, C-contiguous
+
+        Returns:
+            [list]: per frame, the (label, score, (xmin, ymin, xmax, ymax))
+                    of the objects, in model input pixels
+        """
+        results = []
+        for frame in frames:
+            # numpy arrays are passed to the interpreter without a copy
+            run_inference(self.interpreter, frame)
+            objs = get_objects(self.interpreter, self.threshold)[: self.top_k]
+            results.append(
+                [
+                    (
+                        str(self.labels.get(obj.id, obj.id)),
+                        obj.score,
+                        (obj.bbox.xmin, obj.bbox.ymin, obj.bbox.xmax, obj.bbox.ymax),
+                    )
+                    for obj in objs
+                ]
+            )
+        return results
+
+
+def warm_up(model):
+    """Runs a first inference, which loads the model onto the accelerator,
+    before the first frame arrives.
+    """
+    width, height = model.size
+    start = time.monotonic()
+    model.detect([np.zeros((height, width, 3), np.uint8)])
+    logging.info(f"model warm-up took {(time.monotonic() - start) * 1e3:.0f} ms")
+
+
+class StandInModel:
+    """CPU stand-in for EdgeTPUModel, to run the service and the benchmarks
+    without a Coral. It reports the bounding box of the bright pixels as one
+    object, after sleeping like an inference: setup once per batch plus
+    latency per frame.
+
+    Args:
+        size ([tuple]): model input size (width, height)
+        latency ([float]): inference time per frame in seconds
+        setup ([float]): invocation overhead per batch in seconds
+        label ([str]): label of the reported object
+    """
+
+    def __init__(self, size=(300, 300), latency=0.01, setup=0.002, label="object"):
+        self.size = size
+        self.latency = latency
+        self.setup = setup
+        self.label = label
+
+    def detect(self, frames):
+        """See EdgeTPUModel.detect()."""
+        time.sleep(self.setup + self.latency * len(frames))
+        results = []
+        for frame in frames:
+            gray = cv2.cvtColor(frame, cv2.COLOR_RGB2GRAY)
+            _, mask = cv2.threshold(gray, 128, 255, cv2.THRESH_BINARY)
+            x, y, w, h = cv2.boundingRect(mask)
+            if w and h:
+                results.append([(self.label, 0.9, (x, y, x + w, y + h))])
+            else:
+                results.append([])
+        return results
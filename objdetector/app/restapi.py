@@ -15,29 +15,435 @@ You should have received a copy of the GNU General Public License
 along with this program.  If not, see <https://www.gnu.org/licenses/>.
 """
 
+import os
 import socket
 import sys
 import cv2
-import pickle
+import mmap
+import time
+import logging
+import threading
+import selectors
+import collections
 import numpy as np
 import argparse
 import struct
 import zlib
 
-from pycoral.adapters.common import input_size
-from pycoral.adapters.detect import get_objects
-from pycoral.utils.dataset import read_label_file
-from pycoral.utils.edgetpu import make_interpreter
-from pycoral.utils.edgetpu import run_inference
+from inference import EdgeTPUModel, Preprocessor, StandInModel, warm_up
 
 HOST = ""
 
+# frame bus file: header (magic, version, slots, width, height) padded to
+# FRAMEBUS_OFFSET bytes, followed by the slots RGB frames of the model
+# input size.
+FRAMEBUS_MAGIC = b"RPFB"
+FRAMEBUS_VERSION = 1
+FRAMEBUS_HEADER = struct.Struct("<4sHHHH")
+FRAMEBUS_OFFSET = 64
+
+# wire format, see also backend/app/obj_detector.py. A request is the
+# header (magic, version, encoding, frame id, width and height of the
+# camera frame, payload size) followed by the payload: the JPEG image, or
+# the slot (uint16) of the frame bus. The answer is the header (magic,
+# version, frame id, number of detections) followed by the detections as
+# packed DETECTION_DTYPE records.
+PROTOCOL_MAGIC = b"RPFD"
+PROTOCOL_VERSION = 1
+ENCODING_JPEG = 0
+ENCODING_FRAMEBUS = 1
+REQUEST_HEADER = struct.Struct(">4sBBIHHI")
+RESPONSE_HEADER = struct.Struct(">4sBxIH")
+DETECTION_DTYPE = np.dtype(
+    [
+        ("label", "S32"),
+        ("percent", "u1"),
+        ("x0", ">i2"),
+        ("y0", ">i2"),
+        ("x1", ">i2"),
+        ("y1", ">i2"),
+    ]
+)
+
+
+def create_framebus(path, size, slots=2):
+    """Creates the shared-memory frame bus for a backend on the same host,
+    or opens the bus of a previous run. A backend may still have that bus
+    mapped, so it is never truncated (reading past the end of a shrunk
+    mapping kills the backend with SIGBUS), only extended when it is too
+    small.
+
+    Args:
+        path ([str]): bus file, on a tmpfs shared with the backend
+        size ([tuple]): model input size (width, height)
+        slots ([int]): number of frames in the bus
+
+    Returns:
+        [list]: the slots as (height, width, 3) RGB arrays
+    """
+    width, height = size
+    frame_size = width * height * 3
+    length = FRAMEBUS_OFFSET + slots * frame_size
+    header = FRAMEBUS_HEADER.pack(
+        FRAMEBUS_MAGIC, FRAMEBUS_VERSION, slots, width, height
+    )
+    if not os.path.exists(path):
+        open(path, "wb").close()
+    with open(path, "r+b") as bus_file:
+        current = bus_file.read(FRAMEBUS_HEADER.size)
+        if current and current[:4] != FRAMEBUS_MAGIC:
+            raise ValueError(f"{path} exists and is not a frame bus")
+        if os.fstat(bus_file.fileno()).st_size < length:
+            bus_file.truncate(length)
+        if current != header:
+            if current:
+                logging.warning(f"frame bus {path} changed, restart the backend")
+            bus_file.seek(0)
+            bus_file.write(header)
+        bus = mmap.mmap(bus_file.fileno(), 0)
+    return [
+        np.ndarray(
+            (height, width, 3),
+            np.uint8,
+            buffer=bus,
+            offset=FRAMEBUS_OFFSET + slot * frame_size,
+        )
+        for slot in range(slots)
+    ]
+
+
+class Client:
+    """Connection of one backend: the request being received, the queued
+    requests and the answers not sent yet.
+    """
+
+    def __init__(self, sock, addr):
+        self.sock = sock
+        self.addr = addr
+        self.header = bytearray(REQUEST_HEADER.size)
+        # received into directly and handed over to the queue as it is
+        self.payload = None
+        self.request = None  # header of the request being received
+        self.received = 0
+        self.queue = collections.deque()
+        self.pending = 0  # queued or being detected
+        self.outbox = bytearray()
+        self.events = 0
+        self.closed = False
+        self.served = 0
+        self.wait = 0.0
+
+
+class DetectionServer:
+    """Object detector service for any number of backends.
+
+    One thread multiplexes the connections with a selector: requests are
+    received without blocking into per-client buffers and queued per
+    client. The inference thread runs the model serially: it takes the
+    queued requests round robin, one per client and up to max_batch frames
+    at once, so a client sending fast cannot starve the others, and
+    hands the answers back to the selector thread. A client with
+    max_pending requests in the queue is not read from until one is
+    answered, so TCP pushes back on it.
+
+    The frame bus has one set of slots and is meant for one backend on the
+    same host; other backends send JPEG frames.
+
+    Args:
+        model ([EdgeTPUModel, StandInModel]): detection model
+        framebus ([list]): slots of the frame bus, None without
+        max_batch ([int]): maximal number of frames per model invocation
+        max_pending ([int]): maximal number of queued requests per client
+        max_payload ([int]): maximal payload size of a request in bytes,
+                             clients sending larger ones are disconnected
+    """
+
+    def __init__(
+        self, model, framebus=None, max_batch=4, max_pending=2, max_payload=16 << 20
+    ):
+        self.model = model
+        self.framebus = framebus
+        self.preprocessor = Preprocessor(model.size, max_batch)
+        self.max_batch = max_batch
+        self.max_pending = max_pending
+        self.max_payload = max_payload
+        self.selector = selectors.DefaultSelector()
+        self.clients = []
+        self.batches = 0
+        self.detected = 0
+        self.queued = 0
+        self.max_queued = 0
+        self._cond = threading.Condition()
+        self._ready = collections.deque()  # clients with queued requests
+        self._answered = []
+        self._stopped = False
+        self._wake_r, self._wake_w = socket.socketpair()
+        self._wake_r.setblocking(False)
+
+    def connect(self, sock, addr):
+        """Serves an already connected socket, e.g. one end of a socketpair.
+        Only called before serve_forever() or from its thread.
+        """
+        sock.setblocking(False)
+        client = Client(sock, addr)
+        with self._cond:
+            self.clients.append(client)
+        self._update(client)
+        logging.info(f"backend {addr} connected")
+
+    def serve_forever(self, listener=None, stats_interval=60.0):
+        """Serves the connections of a listening socket (and the ones passed
+        to connect()) until stop().
+        """
+        if listener is not None:
+            listener.setblocking(False)
+            self.selector.register(listener, selectors.EVENT_READ, "accept")
+        self.selector.register(self._wake_r, selectors.EVENT_READ, "wake")
+        threading.Thread(target=self._infer, name="inference", daemon=True).start()
+
+        next_stats = time.monotonic() + stats_interval
+        while not self._stopped:
+            for key, mask in self.selector.select(timeout=1.0):
+                if key.data == "accept":
+                    self._accept(listener)
+                elif key.data == "wake":
+                    self._flush()
+                else:
+                    if mask & selectors.EVENT_READ:
+                        self._read(key.data)
+                    if mask & selectors.EVENT_WRITE and not key.data.closed:
+                        self._write(key.data)
+            if time.monotonic() > next_stats:
+                next_stats += stats_interval
+                logging.info(f"detector stats: {self.stats()}")
+
+    def stop(self):
+        with self._cond:
+            self._stopped = True
+            self._cond.notify()
+        self._wake_w.send(b"\0")
+
+    def stats(self):
+        """Returns the served requests, the queue depth and mean wait of
+        every client, and the batching counters.
+        """
+        with self._cond:
+            return {
+                "clients": [
+                    {
+                        "addr": str(client.addr),
+                        "served": client.served,
+                        "queued": len(client.queue),
+                        "wait_ms": client.wait / max(client.served, 1) * 1e3,
+                    }
+                    for client in self.clients
+                ],
+                "queued": self.queued,
+                "max_queued": self.max_queued,
+                "batches": self.batches,
+                "mean_batch": self.detected / max(self.batches, 1),
+            }
+
+    def _accept(self, listener):
+        try:
+            sock, addr = listener.accept()
+        except BlockingIOError:
+            return
+        self.connect(sock, addr)
+
+    def _close(self, client, reason):
+        logging.info(f"backend {client.addr} disconnected: {reason}")
+        if client.events:
+            self.selector.unregister(client.sock)
+            client.events = 0
+        client.sock.close()
+        with self._cond:
+            client.closed = True
+            self.queued -= len(client.queue)
+            client.queue.clear()
+            if client in self._ready:
+                self._ready.remove(client)
+            self.clients.remove(client)
+
+    def _update(self, client):
+        """Selects the events to wait for on a client socket."""
+        with self._cond:
+            events = selectors.EVENT_READ if client.pending < self.max_pending else 0
+            if client.outbox:
+                events |= selectors.EVENT_WRITE
+        if events == client.events:
+            return
+        if not client.events:
+            self.selector.register(client.sock, events, client)
+        elif not events:
+            self.selector.unregister(client.sock)
+        else:
+            self.selector.modify(client.sock, events, client)
+        client.events = events
+
+    def _read(self, client):
+        try:
+            while client.pending < self.max_pending:
+                if client.request is None:
+                    buffer, size = client.header, len(client.header)
+                else:
+                    buffer, size = client.payload, client.request[-1]
+                if client.received < size:
+                    view = memoryview(buffer)[client.received : size]
+                    received = client.sock.recv_into(view)
+                    if not received:
+                        raise ConnectionError("connection closed")
+                    client.received += received
+                    continue
+
+                client.received = 0
+                if client.request is None:
+                    client.request = self._check(REQUEST_HEADER.unpack(client.header))
+                    client.payload = bytearray(client.request[-1])
+                else:
+                    self._enqueue(client, client.request, client.payload)
+                    client.request = client.payload = None
+        except BlockingIOError:
+            pass
+        except (OSError, ValueError) as e:
+            self._close(client, e)
+            return
+        self._update(client)
+
+    def _check(self, request):
+        magic, version, encoding, frame_id, width, height, size = request
+        if magic != PROTOCOL_MAGIC or version != PROTOCOL_VERSION:
+            raise ValueError(f"unknown protocol {magic} {version}")
+        if size > self.max_payload:
+            raise ValueError(f"payload of {size} bytes above {self.max_payload}")
+        if encoding == ENCODING_FRAMEBUS and (self.framebus is None or size != 2):
+            raise ValueError("frame bus request without frame bus")
+        return request
+
+    def _enqueue(self, client, request, payload):
+        with self._cond:
+            client.queue.append((time.monotonic(), request, payload))
+            client.pending += 1
+            if len(client.queue) == 1:
+                self._ready.append(client)
+            self.queued += 1
+            self.max_queued = max(self.max_queued, self.queued)
+            self._cond.notify()
+
+    def _next_batch(self):
+        """Waits for queued requests and takes up to max_batch of them, at
+        most one per client. Clients left out come first in the next batch.
+        """
+        with self._cond:
+            self._cond.wait_for(lambda: self._stopped or self._ready)
+            batch = []
+            for _ in range(min(len(self._ready), self.max_batch)):
+                client = self._ready.popleft()
+                batch.append((client,) + client.queue.popleft())
+                if client.queue:
+                    self._ready.append(client)
+            self.queued -= len(batch)
+            return batch
+
+    def _decode(self, request, payload, index):
+        encoding, frame_id, width, height = request[2:6]
+        if encoding == ENCODING_FRAMEBUS:
+            # already resized and converted to RGB by the backend
+            (slot,) = struct.unpack(">H", payload)
+            return self.framebus[slot % len(self.framebus)]
+        return self.preprocessor.jpeg(payload, width, height, index)
+
+    def _answer(self, request, objs):
+        frame_id, width, height = request[3:6]
+        scale_x, scale_y = width / self.model.size[0], height / self.model.size[1]
+
+        detections = np.zeros(len(objs), DETECTION_DTYPE)
+        for ret, (label, score, bbox) in zip(detections, objs):
+            xmin, ymin, xmax, ymax = bbox
+            ret["label"] = label.encode()[:32]
+            ret["percent"] = int(100 * score)
+            ret["x0"] = int(xmin * scale_x)
+            ret["x1"] = int(xmax * scale_x)
+            ret["y0"] = int(ymin * scale_y)
+            ret["y1"] = int(ymax * scale_y)
+
+        return (
+            RESPONSE_HEADER.pack(PROTOCOL_MAGIC, PROTOCOL_VERSION, frame_id, len(objs))
+            + detections.tobytes()
+        )
+
+    def _infer(self):
+        while True:
+            batch = self._next_batch()
+            if self._stopped:
+                return
+            start = time.monotonic()
+            frames, answers = [], []
+            for client, queued, request, payload in batch:
+                try:
+                    frames.append(self._decode(request, payload, len(frames)))
+                except (cv2.error, ValueError) as e:
+                    logging.warning(f"cannot decode the frame of {client.addr}: {e}")
+                    answers.append(self._answer(request, []))
+                else:
+                    answers.append(None)
+
+            results = iter(())
+            if frames:
+                try:
+                    results = iter(self.model.detect(frames))
+                except Exception as e:
+                    # the batch is answered without detections
+                    logging.exception(f"detection of {len(frames)} frames failed: {e}")
+            with self._cond:
+                for (client, queued, request, payload), answer in zip(batch, answers):
+                    if answer is None:
+                        answer = self._answer(request, next(results, []))
+                    client.pending -= 1
+                    if client.closed:
+                        continue
+                    client.outbox += answer
+                    client.served += 1
+                    client.wait += start - queued
+                    self._answered.append(client)
+                self.batches += 1
+                self.detected += len(batch)
+            self._wake_w.send(b"\0")
+
+    def _flush(self):
+        """Sends the answers of the inference thread."""
+        try:
+            while self._wake_r.recv(4096):
+                pass
+        except BlockingIOError:
+            pass
+        with self._cond:
+            answered, self._answered = self._answered, []
+        for client in set(answered):
+            if not client.closed:
+                self._write(client)
+
+    def _write(self, client):
+        with self._cond:
+            data = bytes(client.outbox)
+        try:
+            sent = client.sock.send(data) if data else 0
+        except BlockingIOError:
+            sent = 0
+        except OSError as e:
+            self._close(client, e)
+            return
+        with self._cond:
+            del client.outbox[:sent]
+        self._update(client)
+
+
 if __name__ == "__main__":
     assert sys.version_info >= (3, 6), sys.version_info
 
     parser = argparse.ArgumentParser()
-    parser.add_argument("--model", help="File path of Tflite model.", required=True)
-    parser.add_argument("--labels", help="File path of label file.", required=True)
+    parser.add_argument("--model", help="File path of Tflite model.")
+    parser.add_argument("--labels", help="File path of label file.")
     parser.add_argument(
         "--top_k",
         type=int,
@@ -48,67 +454,62 @@ if __name__ == "__main__":
         "--threshold", type=float, default=0.4, help="class score threshold"
     )
     parser.add_argument("--port", type=int, default=8010, help="server port for images")
+    parser.add_argument(
+        "--framebus",
+        help="file (on a tmpfs shared with the backend) for the shared-memory "
+        "frame bus, frames are sent as JPEG without it",
+    )
+    parser.add_argument(
+        "--max-batch",
+        type=int,
+        default=4,
+        help="maximal number of queued frames detected in one go",
+    )
+    parser.add_argument(
+        "--max-pending",
+        type=int,
+        default=2,
+        help="maximal number of queued frames per backend",
+    )
+    parser.add_argument(
+        "--max-payload",
+        type=int,
+        default=16 << 20,
+        help="maximal size of a frame in bytes, larger ones close the connection",
+    )
+    parser.add_argument(
+        "--standin",
+        action="store_true",
+        help="run a CPU stand-in instead of the model, without a Coral",
+    )
     parser.add_argument(
         "-v", "--verbose", action="store_true", help="set logging level to debug"
     )
 
     args = parser.parse_args()
 
-    interpreter = make_interpreter(args.model)
-    interpreter.allocate_tensors()
-    labels = read_label_file(args.labels)
-    inference_size = input_size(interpreter)
+    level = logging.DEBUG if args.verbose else logging.INFO
+    logging.basicConfig(level=level)
+
+    if args.standin:
+        model = StandInModel()
+    elif args.model and args.labels:
+        model = EdgeTPUModel(args.model, args.labels, args.threshold, args.top_k)
+    else:
+        parser.error("--model and --labels are required without --standin")
 
-    labels = read_label_file(args.labels)
+    warm_up(model)
+
+    framebus = None
+    if args.framebus:
+        framebus = create_framebus(args.framebus, model.size)
 
     s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
     s.bind((HOST, args.port))
     s.listen(10)
-    conn, addr = s.accept()
-    data = b""
-    payload_size = struct.calcsize(">L")
-
-    while True:
-        while len(data) < payload_size:
-            data += conn.recv(4096)
-
-        packed_msg_size = data[:payload_size]
-        data = data[payload_size:]
-        msg_size = struct.unpack(">L", packed_msg_size)[0]
-
-        while len(data) < msg_size:
-            data += conn.recv(4096)
-
-        frame_data = data[:msg_size]
-        data = data[msg_size:]
-
-        frame = pickle.loads(frame_data, fix_imports=True, encoding="bytes")
-        frame = cv2.imdecode(frame, cv2.COLOR_BGR2RGB)
-        height, width, channels = frame.shape
-
-        frame = cv2.resize(frame, inference_size)
-        run_inference(interpreter, frame.tobytes())
-        objs = get_objects(interpreter, args.threshold)[: args.top_k]
-
-        scale_x, scale_y = width / inference_size[0], height / inference_size[1]
-
-        ret_array = []
-        for obj in objs:
-            ret = {}
-
-            bbox = obj.bbox.scale(scale_x, scale_y)
-            x0, y0 = int(bbox.xmin), int(bbox.ymin)
-            x1, y1 = int(bbox.xmax), int(bbox.ymax)
-
-            percent = int(100 * obj.score)
-            ret["label"] = labels.get(obj.id, obj.id)
-            ret["percent"] = percent
-            ret["x0"] = x0
-            ret["x1"] = x1
-            ret["y0"] = y0
-            ret["y1"] = y1
-            ret_array.append(ret)
-
-        data_udp = pickle.dumps(ret_array, 0)
-        size_udp = len(data_udp)
-        conn.sendall(struct.pack(">L", size_udp) + data_udp)
+
+    server = DetectionServer(
+        model, framebus, args.max_batch, args.max_pending, args.max_payload
+    )
+    server.serve_forever(s)
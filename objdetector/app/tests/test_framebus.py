@@ -0,0 +1,51 @@
+"""
+Copyright (C) 2020 Mauro Riva
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+import os
+
+import pytest
+
+from restapi import FRAMEBUS_OFFSET, create_framebus
+
+
+def test_restart_keeps_the_mapped_bus(tmp_path):
+    path = str(tmp_path / "frames")
+    slots = create_framebus(path, (32, 16))
+    slots[1][:] = 7
+    length = os.path.getsize(path)
+    # the detector restarts while the backend still maps the bus
+    again = create_framebus(path, (32, 16))
+    assert os.path.getsize(path) == length
+    assert (again[1] == 7).all()
+
+
+def test_bus_is_extended_but_never_shrunk(tmp_path):
+    path = str(tmp_path / "frames")
+    create_framebus(path, (32, 16))
+    create_framebus(path, (64, 32))
+    assert os.path.getsize(path) == FRAMEBUS_OFFSET + 2 * 64 * 32 * 3
+    slots = create_framebus(path, (16, 8))
+    assert os.path.getsize(path) == FRAMEBUS_OFFSET + 2 * 64 * 32 * 3
+    assert slots[0].shape == (8, 16, 3)
+
+
+def test_other_files_are_not_overwritten(tmp_path):
+    path = tmp_path / "frames"
+    path.write_bytes(b"not a frame bus")
+    with pytest.raises(ValueError):
+        create_framebus(str(path), (32, 16))
+    assert path.read_bytes() == b"not a frame bus"
@@ -0,0 +1,149 @@
+"""
+Copyright (C) 2020 Mauro Riva
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+import socket
+import threading
+import time
+
+import cv2
+import numpy as np
+import pytest
+
+from inference import StandInModel
+from restapi import (
+    DETECTION_DTYPE,
+    ENCODING_JPEG,
+    PROTOCOL_MAGIC,
+    PROTOCOL_VERSION,
+    REQUEST_HEADER,
+    RESPONSE_HEADER,
+    DetectionServer,
+)
+
+
+class GatedModel(StandInModel):
+    """Stand-in that records its batch sizes and holds its first batch
+    until the gate opens, so requests queue up behind it."""
+
+    def __init__(self):
+        super().__init__(size=(64, 64), latency=0.0, setup=0.0)
+        self.batches = []
+        self.started = threading.Event()
+        self.gate = threading.Event()
+
+    def detect(self, frames):
+        self.batches.append(len(frames))
+        self.started.set()
+        self.gate.wait(5.0)
+        return super().detect(frames)
+
+
+def frame_request(frame_id, width=160, height=120):
+    # a bright object at (40, 30)-(80, 60) of a dark frame
+    image = np.zeros((height, width, 3), np.uint8)
+    image[30:60, 40:80] = 255
+    jpeg = cv2.imencode(".jpg", image)[1].tobytes()
+    header = REQUEST_HEADER.pack(
+        PROTOCOL_MAGIC,
+        PROTOCOL_VERSION,
+        ENCODING_JPEG,
+        frame_id,
+        width,
+        height,
+        len(jpeg),
+    )
+    return header + jpeg
+
+
+def receive(sock, size):
+    data = b""
+    while len(data) < size:
+        chunk = sock.recv(size - len(data))
+        if not chunk:
+            raise ConnectionError("connection closed")
+        data += chunk
+    return data
+
+
+def answer(sock):
+    magic, version, frame_id, count = RESPONSE_HEADER.unpack(
+        receive(sock, RESPONSE_HEADER.size)
+    )
+    assert (magic, version) == (PROTOCOL_MAGIC, PROTOCOL_VERSION)
+    detections = receive(sock, count * DETECTION_DTYPE.itemsize)
+    return frame_id, np.frombuffer(detections, DETECTION_DTYPE)
+
+
+@pytest.fixture
+def serve():
+    servers = []
+
+    def start(model, clients, **kwargs):
+        server = DetectionServer(model, **kwargs)
+        sockets = []
+        for idx in range(clients):
+            ours, theirs = socket.socketpair()
+            ours.settimeout(5.0)
+            server.connect(theirs, f"backend {idx}")
+            sockets.append(ours)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        servers.append(server)
+        return server, sockets
+
+    yield start
+    for server in servers:
+        server.stop()
+
+
+def test_frames_are_answered_with_their_detections(serve):
+    model = StandInModel(size=(64, 64), latency=0.0, setup=0.0)
+    server, (sock,) = serve(model, 1)
+    for frame_id in (7, 8):
+        sock.sendall(frame_request(frame_id))
+        received_id, (detection,) = answer(sock)
+        assert received_id == frame_id
+        assert detection["label"] == b"object"
+        # scaled back from the model input to the camera frame
+        box = [int(detection[k]) for k in ("x0", "y0", "x1", "y1")]
+        assert box == pytest.approx([40, 30, 80, 60], abs=3)
+
+
+def test_queued_frames_of_several_backends_are_batched(serve):
+    model = GatedModel()
+    server, sockets = serve(model, 4, max_batch=4)
+    sockets[0].sendall(frame_request(0))
+    assert model.started.wait(5.0)
+    # queued while the model is busy: one batch, one frame per backend
+    for frame_id, sock in enumerate(sockets[1:], 1):
+        sock.sendall(frame_request(frame_id))
+    deadline = time.monotonic() + 5.0
+    while server.stats()["queued"] < 3 and time.monotonic() < deadline:
+        time.sleep(0.01)
+    model.gate.set()
+    for frame_id, sock in enumerate(sockets):
+        assert answer(sock)[0] == frame_id
+    assert model.batches == [1, 3]
+    assert server.stats()["mean_batch"] == 2
+
+
+def test_payloads_above_the_limit_close_the_connection(serve):
+    model = StandInModel(size=(64, 64), latency=0.0, setup=0.0)
+    server, (sock,) = serve(model, 1, max_payload=1024)
+    sock.sendall(
+        frame_request(1)[: REQUEST_HEADER.size - 4] + (2048).to_bytes(4, "big")
+    )
+    assert sock.recv(1) == b""
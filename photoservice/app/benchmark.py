@@ -0,0 +1,345 @@
+"""
+Copyright (C) 2020 Mauro Riva
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+import os
+import sys
+import shutil
+import argparse
+import tempfile
+import time
+import threading
+import cv2
+import numpy as np
+
+from camera import StandInCamera, expose, get_camera, synthetic_scene
+from events import TaskEvents, channel, history, subscribe
+from hdr import (
+    StageTimer,
+    ResponseStore,
+    load_bracket,
+    merge_hdr,
+    response_store,
+    workers,
+)
+
+# exposure times of the reference photo and the four brackets
+bracket_times = [1 / 60, 1 / 250, 1 / 125, 1 / 30, 1 / 15]
+
+
+def synthetic_brackets(shape=(960, 1280), times=bracket_times, seed=0):
+    """Returns reproducible 8-bit exposures of a synthetic high dynamic range
+    scene, one per exposure time.
+    """
+    radiance = synthetic_scene(shape, seed)
+    return [expose(radiance, t) for t in times]
+
+
+def reference_process_photos(ptmp, save_folder, save_file, times):
+    """HDR merge as originally implemented in restapi.process_photos (with
+    the exposure times given instead of read from the EXIF tags): every step
+    in sequence.
+    """
+    images = []
+    for filename in sorted(os.listdir(ptmp)):
+        filedest = save_folder + "/" + filename
+        shutil.move(ptmp + "/" + filename, filedest)
+        images.append(cv2.imread(filedest))
+    times = np.array(times, dtype=np.float32)
+
+    align_MTB = cv2.createAlignMTB()
+    align_MTB.process(images, images)
+    response = cv2.createCalibrateDebevec().process(images, times)
+    hdr = cv2.createMergeDebevec().process(images, times, response)
+    cv2.imwrite(save_file + ".hdr", hdr)
+
+    ldr_drago = 3 * cv2.createTonemapDrago(1.0, 0.7).process(hdr)
+    cv2.imwrite(save_file + "_drago.jpg", ldr_drago * 255)
+    ldr_reinhard = cv2.createTonemapReinhard(1.5, 0, 0, 0).process(hdr)
+    cv2.imwrite(save_file + "_reinhard.jpg", ldr_reinhard * 255)
+    ldr_mantiuk = 3 * cv2.createTonemapMantiuk(2.2, 0.85, 1.2).process(hdr)
+    cv2.imwrite(save_file + "_mantiuk.jpg", ldr_mantiuk * 255)
+
+
+def bench_hdr(args):
+    # shutter to gallery-ready for a reference photo and four brackets; the
+    # camera is simulated by sleeping capture seconds and writing the JPEG
+    brackets = synthetic_brackets()
+
+    def capture(path, image):
+        time.sleep(args.capture)
+        cv2.imwrite(path, image)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        results = {}
+        for mode in ("sequential", "pipeline"):
+            ptmp, raw = f"{tmp}/{mode}_tmp", f"{tmp}/{mode}_raw"
+            os.makedirs(ptmp)
+            os.makedirs(raw)
+            save_file = f"{tmp}/{mode}"
+            response_store().clear()
+            timer = StageTimer()
+            start = time.perf_counter()
+            if mode == "sequential":
+                for pic, image in enumerate(brackets):
+                    capture(f"{ptmp}/{pic}.jpg", image)
+                captured = time.perf_counter() - start
+                reference_process_photos(ptmp, raw, save_file, bracket_times)
+            else:
+                loads = []
+                for pic, image in enumerate(brackets):
+                    with timer.stage("capture"):
+                        capture(f"{ptmp}/{pic}.jpg", image)
+                    loads.append(
+                        workers.submit(
+                            load_bracket,
+                            f"{ptmp}/{pic}.jpg",
+                            f"{raw}/{pic}.jpg",
+                            timer,
+                        )
+                    )
+                captured = time.perf_counter() - start
+                images = [load.result() for load in loads]
+                merge_hdr(images, bracket_times, save_file, ("bench",), timer)
+            elapsed = time.perf_counter() - start
+            results[mode] = cv2.imread(save_file + "_reinhard.jpg").astype(np.int16)
+            print(
+                f"hdr {mode}: camera busy {captured:.2f} s, "
+                f"shutter to gallery {elapsed:.2f} s"
+                + (f"  stages {timer.summary()}" if mode == "pipeline" else "")
+            )
+
+        diff = np.abs(results["sequential"] - results["pipeline"]).max()
+        if diff > 1:
+            print(f"hdr: pipeline result differs from the reference by {diff}")
+            return 1
+    return 0
+
+
+def bench_crf(args):
+    # merge latency with the camera response calibrated on every merge, and
+    # reused from the store (loaded from the .npy file by a new process)
+    brackets = synthetic_brackets()
+    key = ResponseStore.key("bench", 100, brackets[0].shape)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        results = {}
+        for mode in ("calibrate", "stored"):
+            timings = []
+            for run in range(args.runs):
+                # a new store per merge, like a freshly started worker
+                if mode == "calibrate":
+                    store = ResponseStore()
+                else:
+                    store = ResponseStore(f"{tmp}/calibration")
+                timer = StageTimer()
+                start = time.perf_counter()
+                merge_hdr(
+                    [image.copy() for image in brackets],
+                    bracket_times,
+                    f"{tmp}/{mode}",
+                    key,
+                    timer,
+                    store,
+                )
+                timings.append(time.perf_counter() - start)
+                if mode == "calibrate" and run == 0:
+                    # what the calibration task stores
+                    ResponseStore(f"{tmp}/calibration").put(key, store.get(key))
+            results[mode] = cv2.imread(f"{tmp}/{mode}_reinhard.jpg").astype(np.int16)
+            print(
+                f"crf {mode}: merge {np.median(timings):.2f} s (median of {args.runs})"
+                f"  stages {timer.summary()}"
+            )
+
+        diff = np.abs(results["calibrate"] - results["stored"]).max()
+        if diff > 1:
+            print(f"crf: merge with the stored curve differs by {diff}")
+            return 1
+    return 0
+
+
+def bench_camera(args):
+    # single shot and reference photo + four brackets, with a camera session
+    # per photo (like raspistill) and with one session and a burst
+    def camera():
+        if args.camera == "standin":
+            return StandInCamera(open_time=args.camera_open, frame_time=args.frame_time)
+        return get_camera(args.camera)
+
+    shutters = bracket_times[1:]
+    with tempfile.TemporaryDirectory() as tmp:
+        results = {}
+        for mode in ("per photo", "session"):
+            prefix = f"{tmp}/{mode.replace(' ', '_')}"
+            start = time.perf_counter()
+            with camera() as cam:
+                exposures = [cam.capture(f"{prefix}_single.jpg", None, 100)]
+            single = time.perf_counter() - start
+
+            paths = [f"{prefix}_{pic + 1}.jpg" for pic in range(len(shutters))]
+            start = time.perf_counter()
+            if mode == "per photo":
+                with camera() as cam:
+                    exposures.append(cam.capture(f"{prefix}_0.jpg", None, 100))
+                for path, shutter in zip(paths, shutters):
+                    with camera() as cam:
+                        exposures.append(cam.capture(path, shutter, 100))
+            else:
+                with camera() as cam:
+                    exposures.append(cam.capture(f"{prefix}_0.jpg", None, 100))
+                    exposures += [t for path, t in cam.burst(paths, shutters, 100)]
+            bracket = time.perf_counter() - start
+            results[mode] = exposures, [cv2.imread(path) for path in paths]
+            print(
+                f"camera {args.camera} {mode}: single shot {single:.2f} s, "
+                f"{len(paths) + 1} photos {bracket:.2f} s ({bracket / single:.1f}x)"
+            )
+
+        (exposures, photos), (session_exposures, session_photos) = results.values()
+        if not np.allclose(exposures, session_exposures, rtol=0.05):
+            print(f"camera: burst exposures {session_exposures} instead of {exposures}")
+            return 1
+        for photo, session_photo in zip(photos, session_photos):
+            diff = np.abs(photo.astype(np.int16) - session_photo).mean()
+            if diff > 8:
+                print(f"camera: burst photos differ by {diff:.1f} on average")
+                return 1
+    return 0
+
+
+def bench_events(args):
+    # delay between a pipeline event and its delivery, and requests per
+    # photo: status polled every 100 ms as in the original backend and one
+    # subscription to the event stream (needs a Redis server, --redis)
+    try:
+        import redis
+
+        client = redis.Redis.from_url(args.redis)
+        client.ping()
+    except Exception as e:
+        print(f"events: skipped, no Redis at {args.redis} ({e})")
+        return 0
+
+    # the stages of a photo, with their durations in seconds
+    stages = [
+        ("captured", 2.5),
+        ("aligned", 0.1),
+        ("merged", 0.6),
+        ("tonemapped", 0.1),
+        ("tonemapped", 0.1),
+        ("tonemapped", 0.7),
+        ("written", 0.05),
+        ("done", 0.0),
+    ]
+    status = 0
+    for mode in ("polling", "push"):
+        task_id = f"bench-{mode}-{time.time()}"
+
+        def run():
+            events = TaskEvents(client, task_id, ttl=60)
+            for name, seconds in stages:
+                time.sleep(seconds)
+                events.publish(name)
+
+        delays, requests = [], 0
+        start = time.monotonic()
+        task = threading.Thread(target=run)
+        task.start()
+        if mode == "polling":
+            after = 0
+            while after < len(stages):
+                requests += 1
+                for event in history(client, task_id, after):
+                    delays.append(time.time() - event["time"])
+                    after = event["index"]
+                time.sleep(0.1)
+        else:
+            requests += 1
+            for event in subscribe(client, task_id):
+                delays.append(time.time() - event["time"])
+        task.join()
+        client.delete(channel(task_id), channel(task_id) + ":index")
+        print(
+            f"events {mode}: {len(delays)} events in {time.monotonic() - start:.2f} s, "
+            f"{requests} requests, delay mean {np.mean(delays) * 1e3:.1f} ms "
+            f"max {np.max(delays) * 1e3:.1f} ms"
+        )
+        if len(delays) != len(stages):
+            print(f"events {mode}: {len(delays)} events of {len(stages)}")
+            status = 1
+    return status
+
+
+benchmarks = {
+    "hdr": bench_hdr,
+    "crf": bench_crf,
+    "camera": bench_camera,
+    "events": bench_events,
+}
+
+
+if __name__ == "__main__":
+    assert sys.version_info >= (3, 6), sys.version_info
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "benchmark",
+        nargs="*",
+        default=list(benchmarks),
+        help="benchmarks to run: {0} (default: all)".format(", ".join(benchmarks)),
+    )
+    parser.add_argument(
+        "--capture",
+        type=float,
+        default=0.5,
+        help="simulated capture time per photo in seconds",
+    )
+    parser.add_argument(
+        "--camera",
+        default="standin",
+        choices=["standin", "picamera", "raspistill"],
+        help="camera backend of the camera benchmark",
+    )
+    parser.add_argument(
+        "--camera-open",
+        type=float,
+        default=1.5,
+        help="stand-in camera session start time in seconds",
+    )
+    parser.add_argument(
+        "--frame-time",
+        type=float,
+        default=0.15,
+        help="stand-in camera readout and encoding time per photo in seconds",
+    )
+    parser.add_argument(
+        "--redis",
+        default="redis://localhost:6379/0",
+        help="Redis server of the events benchmark",
+    )
+    parser.add_argument(
+        "--runs", type=int, default=3, help="merges per crf benchmark mode"
+    )
+    args = parser.parse_args()
+
+    for name in args.benchmark:
+        if name not in benchmarks:
+            parser.error(f"unknown benchmark: {name}")
+
+    status = 0
+    for name in args.benchmark:
+        status |= benchmarks[name](args)
+    sys.exit(status)
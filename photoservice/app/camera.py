@@ -0,0 +1,374 @@
+"""
+Copyright (C) 2020 Mauro Riva
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+import time
+import struct
+import logging
+import subprocess
+from fractions import Fraction
+import cv2
+import numpy as np
+import requests
+
+try:
+    import exifread
+except ImportError:  # only needed to read the photos of raspistill
+    exifread = None
+
+try:
+    import picamera
+except ImportError:  # not on a Raspberry Pi
+    picamera = None
+
+
+def read_exif(path_name):
+    """Reads the EXIF tags of a photo, without the thumbnail and maker notes."""
+    with open(path_name, "rb") as file_data:
+        return exifread.process_file(file_data, details=False)
+
+
+def iso_value(iso):
+    """Returns the ISO as an int, 0 for automatic ("auto", None)."""
+    return int(iso) if str(iso).isdigit() else 0
+
+
+def _ifd(entries, offset):
+    # TIFF directory at offset, followed by the values longer than 4 bytes
+    data_at = offset + 2 + 12 * len(entries) + 4
+    table, data = struct.pack("<H", len(entries)), b""
+    for tag, kind, count, value in sorted(entries):
+        if len(value) > 4:
+            table += struct.pack("<HHII", tag, kind, count, data_at + len(data))
+            data += value + b"\0" * (len(value) % 2)
+        else:
+            table += struct.pack("<HHI", tag, kind, count) + value.ljust(4, b"\0")
+    return table + struct.pack("<I", 0) + data
+
+
+def exif_segment(exposure, iso=None, model="unknown"):
+    """Returns a JPEG APP1 segment with the EXIF tags the photo service reads
+    back from its photos: camera model, exposure time and ISO (left out if
+    automatic).
+    """
+    model = model.encode("ascii", "replace") + b"\0"
+    ratio = Fraction(exposure).limit_denominator(1000000)
+    exif = [(0x829A, 5, 1, struct.pack("<II", ratio.numerator, ratio.denominator))]
+    if iso_value(iso):
+        exif.append((0x8827, 3, 1, struct.pack("<H", iso_value(iso))))
+    ifd0 = [(0x0110, 2, len(model), model), (0x8769, 4, 1, struct.pack("<I", 0))]
+    exif_at = 8 + len(_ifd(ifd0, 8))
+    ifd0[1] = (0x8769, 4, 1, struct.pack("<I", exif_at))
+    payload = b"Exif\0\0II*\0" + struct.pack("<I", 8)
+    payload += _ifd(ifd0, 8) + _ifd(exif, exif_at)
+    return b"\xff\xe1" + struct.pack(">H", len(payload) + 2) + payload
+
+
+def write_jpeg(path, jpeg, exposure, iso=None, model="unknown"):
+    """Writes a JPEG (bytes) with the EXIF tags of exif_segment()."""
+    with open(path, "wb") as photo:
+        photo.write(jpeg[:2] + exif_segment(exposure, iso, model) + jpeg[2:])
+
+
+class Camera:
+    """Still camera of the photo service. The camera session is opened once
+    (with open() or as a context manager) and stays open for all the photos
+    of a bracket sequence.
+
+    Subclasses implement capture() and, where the hardware allows it, a
+    faster burst().
+    """
+
+    sensor = "unknown"
+
+    def open(self):
+        return self
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self.open()
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def capture(self, path, shutter=None, iso=None, ev=0, mode="auto"):
+        """Takes a JPEG photo.
+
+        Args:
+            path ([str]): output file
+            shutter ([float]): exposure time in seconds, None for automatic
+            iso ([str, int]): sensor sensitivity, "auto" or None for automatic
+            ev ([int]): exposure compensation (automatic exposure)
+            mode ([str]): exposure mode of the automatic exposure
+
+        Returns:
+            [float]: exposure time of the photo in seconds
+        """
+        raise NotImplementedError
+
+    def burst(self, paths, shutters, iso=None, ev=0):
+        """Takes one photo per exposure time, keeping the gains of the last
+        automatic exposure. Yields (path, exposure time) after every photo,
+        so the caller can process a photo while the next one is taken.
+        """
+        for path, shutter in zip(paths, shutters):
+            yield path, self.capture(path, shutter, iso, ev)
+
+
+class RaspistillCamera(Camera):
+    """Starts raspistill for every photo, as the photo service originally did.
+    Every launch initializes the camera and settles the automatic exposure
+    again.
+    """
+
+    def capture(self, path, shutter=None, iso=None, ev=0, mode="auto"):
+        if shutter is None:
+            cmd = "raspistill -n -bm -r -ev {0} -ex {1} -ISO {2} -o {3} -tl 0 --thumb none".format(
+                ev, mode, iso, path
+            )
+        else:
+            cmd = "raspistill -n -bm -r -ev {0} -ISO {1} -ss {2} -o {3} -tl 0 --thumb none".format(
+                ev, iso, shutter * 1e6, path
+            )
+        logging.debug(cmd)
+        subprocess.call(cmd, shell=True)
+        tags = read_exif(path)
+        self.sensor = str(tags.get("Image Model", "unknown"))
+        return float(tags["EXIF ExposureTime"].values[0])
+
+
+class PiCamera(Camera):
+    """Raspberry Pi camera kept open with picamera. The sensor mode is set
+    and the automatic exposure settles once per session; in a burst, the
+    gains are locked after the reference photo and only the shutter speed
+    changes from photo to photo.
+
+    Args:
+        resolution ([tuple]): photo resolution, None for the sensor maximum
+        framerate ([float]): frame rate between photos (automatic exposure)
+        settle ([float]): automatic exposure settling time in seconds
+    """
+
+    def __init__(self, resolution=None, framerate=10, settle=1.0):
+        if picamera is None:
+            raise RuntimeError("picamera is not installed")
+        self.resolution = resolution
+        self.framerate = framerate
+        self.settle = settle
+        self.camera = None
+
+    def open(self):
+        self.camera = picamera.PiCamera(framerate=self.framerate)
+        self.camera.resolution = self.resolution or self.camera.MAX_RESOLUTION
+        # the EXIF model written by raspistill, for the same calibration keys
+        self.sensor = "RP_" + self.camera.revision
+        time.sleep(self.settle)
+        return self
+
+    def close(self):
+        if self.camera is not None:
+            self.camera.close()
+            self.camera = None
+
+    def _expose(self, shutter):
+        # the frame time has to cover the exposure time
+        framerate = min(self.framerate, 1 / shutter) if shutter else self.framerate
+        self.camera.framerate = Fraction(framerate).limit_denominator(1000)
+        self.camera.shutter_speed = int(shutter * 1e6) if shutter else 0
+
+    def capture(self, path, shutter=None, iso=None, ev=0, mode="auto"):
+        camera = self.camera
+        camera.iso = iso_value(iso)
+        camera.exposure_compensation = ev
+        if shutter is None:
+            camera.exposure_mode = mode
+        self._expose(shutter)
+        camera.capture(path, format="jpeg", thumbnail=None)
+        return camera.exposure_speed / 1e6 or shutter
+
+    def burst(self, paths, shutters, iso=None, ev=0):
+        camera = self.camera
+        camera.iso = iso_value(iso)
+        camera.exposure_compensation = ev
+        camera.exposure_mode = "off"
+        try:
+            for path, shutter in zip(paths, shutters):
+                self._expose(shutter)
+                camera.capture(path, format="jpeg", thumbnail=None)
+                yield path, camera.exposure_speed / 1e6 or shutter
+        finally:
+            self._expose(None)
+            camera.exposure_mode = "auto"
+
+
+class BrokerCamera(Camera):
+    """Takes the photos with the camera of the backend, which owns the
+    camera and keeps streaming the live preview meanwhile (see /api/still of
+    the backend). The photos have the resolution of the preview stream, and
+    the brackets change the exposure of the running camera instead of
+    reopening it. The backend answers with the bare JPEG: the exposure time
+    and the camera are written into its EXIF tags, as the photo service
+    reads them back from the photos. The backend camera only has one
+    automatic exposure mode: the exposure compensation is applied by
+    metering an automatic photo first, and other exposure modes are
+    rejected.
+
+    Args:
+        url ([str]): backend address
+        timeout ([float]): request timeout in seconds, on top of the
+                           exposure time of the frames a still waits for
+    """
+
+    # frames a still can wait for: the frame being captured, the sensor
+    # latency of the new exposure and the photo itself
+    still_frames = 5
+
+    def __init__(self, url="http://backend:5000", timeout=10.0):
+        self.url = url.rstrip("/")
+        self.timeout = timeout
+        self.session = None
+        # exposure time of the frames the backend camera is capturing
+        self._shutter = None
+
+    def open(self):
+        self.session = requests.Session()
+        return self
+
+    def close(self):
+        if self.session is None:
+            return
+        try:
+            # back to the automatic exposure of the preview
+            self.session.get(self.url + "/api/exposure", timeout=self.timeout)
+            self._shutter = None
+        except requests.RequestException as e:
+            logging.warning(f"cannot reset the exposure of the backend camera: {e}")
+        finally:
+            self.session.close()
+            self.session = None
+
+    def capture(self, path, shutter=None, iso=None, ev=0, mode="auto"):
+        if shutter is None and mode != "auto":
+            raise ValueError(f"the broker camera has no {mode} exposure mode")
+        if shutter is None and ev:
+            # meter with the automatic exposure, then compensate the shutter
+            shutter = self._still(path, None, iso) * 2.0**ev
+        return self._still(path, shutter, iso)
+
+    def _still(self, path, shutter, iso):
+        params = {"iso": iso or ""}
+        if shutter is not None:
+            params["shutter"] = shutter
+        longest = max(shutter or 0, self._shutter or 0)
+        response = self.session.get(
+            self.url + "/api/still",
+            params=params,
+            timeout=self.timeout + self.still_frames * longest,
+        )
+        response.raise_for_status()
+        self._shutter = shutter
+        self.sensor = response.headers.get("X-Sensor", self.sensor)
+        exposure = float(response.headers["X-Exposure-Time"])
+        write_jpeg(path, response.content, exposure, iso, self.sensor)
+        return exposure
+
+
+def synthetic_scene(shape=(960, 1280), seed=0):
+    """Returns the reproducible radiance of a synthetic high dynamic range
+    scene (spanning five decades), as float32 BGR.
+    """
+    rng = np.random.RandomState(seed)
+    height, width = shape
+    radiance = np.logspace(-1, 4, width, dtype=np.float32)[None, :, None]
+    radiance = np.repeat(np.repeat(radiance, height, 0), 3, 2) / 100
+    for _ in range(40):
+        x0, y0 = rng.randint(0, width), rng.randint(0, height)
+        w, h = rng.randint(20, width // 4), rng.randint(20, height // 4)
+        radiance[y0 : y0 + h, x0 : x0 + w] *= rng.uniform(0.2, 5, 3).astype(np.float32)
+    return radiance
+
+
+def expose(radiance, exposure):
+    """Returns the 8-bit photo of a radiance map taken with exposure seconds."""
+    return (np.clip(radiance * exposure, 0, 1) ** (1 / 2.2) * 255).astype(np.uint8)
+
+
+class StandInCamera(Camera):
+    """Camera stand-in that photographs a synthetic scene, to run the photo
+    service and the benchmarks without a camera. It sleeps like a camera:
+    open_time to open the session (initialization, sensor mode and
+    automatic exposure), then frame_time plus the exposure time per photo.
+
+    Args:
+        shape ([tuple]): photo size (height, width)
+        open_time ([float]): session start time in seconds
+        frame_time ([float]): readout and encoding time per photo in seconds
+        auto_exposure ([float]): exposure time of the automatic exposure
+    """
+
+    sensor = "standin"
+
+    def __init__(
+        self, shape=(960, 1280), open_time=1.0, frame_time=0.1, auto_exposure=1 / 60
+    ):
+        self.radiance = synthetic_scene(shape)
+        self.open_time = open_time
+        self.frame_time = frame_time
+        self.auto_exposure = auto_exposure
+        self.opened = False
+
+    def open(self):
+        time.sleep(self.open_time)
+        self.opened = True
+        return self
+
+    def close(self):
+        self.opened = False
+
+    def capture(self, path, shutter=None, iso=None, ev=0, mode="auto"):
+        if not self.opened:
+            raise RuntimeError("camera session is not open")
+        exposure = shutter if shutter is not None else self.auto_exposure * 2.0**ev
+        time.sleep(self.frame_time + exposure)
+        ok, jpeg = cv2.imencode(".jpg", expose(self.radiance, exposure))
+        write_jpeg(path, jpeg.tobytes(), exposure, iso, self.sensor)
+        return exposure
+
+
+cameras = {
+    "broker": BrokerCamera,
+    "picamera": PiCamera,
+    "raspistill": RaspistillCamera,
+    "standin": StandInCamera,
+}
+
+
+def get_camera(name="picamera", broker=None):
+    """Returns the (not yet opened) camera of a backend in cameras. Without
+    picamera, the raspistill backend is used instead.
+
+    Args:
+        name ([str]): camera backend
+        broker ([str]): backend address of the broker camera
+    """
+    if name == "broker":
+        return BrokerCamera(broker) if broker else BrokerCamera()
+    if name == "picamera" and picamera is None:
+        logging.warning("picamera is not installed, using raspistill")
+        name = "raspistill"
+    return cameras[name]()
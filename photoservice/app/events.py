@@ -0,0 +1,118 @@
+"""
+Copyright (C) 2020 Mauro Riva
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+import json
+import time
+import threading
+
+# events after which a task does not publish any more
+final_events = ("done", "failed")
+
+
+def channel(task_id):
+    return f"task-events:{task_id}"
+
+
+class TaskEvents:
+    """Progress events of a Celery task, published on Redis.
+
+    Every event is appended to a list, so subscribers that connect late
+    (or reconnect) get the events they missed, and published on a pub/sub
+    channel for the subscribers already listening. The events are numbered
+    by a counter next to the list.
+
+    Args:
+        client ([redis.Redis]): Redis connection
+        task_id ([str]): Celery task id
+        ttl ([int]): seconds the events are kept after the last one
+    """
+
+    def __init__(self, client, task_id, ttl=3600):
+        self.client = client
+        self.key = channel(task_id)
+        self.counter = self.key + ":index"
+        self.ttl = ttl
+        # the stages of a merge report from several threads, in index order
+        self._lock = threading.Lock()
+
+    def publish(self, name, data=None):
+        """Publishes an event, e.g. publish("merged", {"timings": {...}})."""
+        event = dict(data or {}, event=name, time=time.time())
+        with self._lock:
+            event["index"] = self.client.incr(self.counter)
+            message = json.dumps(event)
+            pipe = self.client.pipeline()
+            pipe.rpush(self.key, message)
+            pipe.expire(self.key, self.ttl)
+            pipe.expire(self.counter, self.ttl)
+            pipe.publish(self.key, message)
+            pipe.execute()
+        return event
+
+    def __call__(self, name, data=None):
+        """Publishes an event, so a TaskEvents is a StageTimer listener."""
+        self.publish(name, data)
+
+
+def history(client, task_id, after=0):
+    """Returns the events of a task with an index above after."""
+    events = [json.loads(m) for m in client.lrange(channel(task_id), 0, -1)]
+    return [event for event in events if event["index"] > after]
+
+
+def subscribe(client, task_id, after=0, timeout=None, keepalive=15.0):
+    """Yields the events of a task with an index above after, as they are
+    published, until its final event. Without events for keepalive
+    seconds, the events missed by the subscription are read from the
+    history, and None is yielded if there are none, so that a stream can
+    send a keepalive. With a timeout, the subscription ends once no event
+    arrived for timeout seconds.
+    """
+    pubsub = client.pubsub(ignore_subscribe_messages=True)
+    # subscribed before reading the history, so no event falls in between
+    pubsub.subscribe(channel(task_id))
+    try:
+        events = history(client, task_id, after)
+        last_event = last_yield = time.monotonic()
+        while True:
+            for event in events:
+                if event["index"] <= after:
+                    continue
+                after = event["index"]
+                last_event = last_yield = time.monotonic()
+                yield event
+                if event["event"] in final_events:
+                    return
+
+            now = time.monotonic()
+            if timeout is not None and now - last_event >= timeout:
+                return
+            wait = last_yield + keepalive - now
+            if timeout is not None:
+                wait = min(wait, last_event + timeout - now)
+            message = pubsub.get_message(timeout=max(wait, 0))
+            events = []
+            if message is not None:
+                events = [json.loads(message["data"])]
+            elif time.monotonic() - last_yield >= keepalive:
+                # catch up with the events the subscription missed
+                events = history(client, task_id, after)
+                if not events:
+                    last_yield = time.monotonic()
+                    yield None
+    finally:
+        pubsub.close()
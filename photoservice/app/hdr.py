@@ -0,0 +1,263 @@
+"""
+Copyright (C) 2020 Mauro Riva
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+import os
+import re
+import time
+import shutil
+import logging
+import threading
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+import cv2
+import numpy as np
+
+# OpenCV releases the GIL while it decodes, merges, tonemaps and encodes, so
+# the stages run in parallel on threads without copying the images between
+# processes. The threads start with the first task, after the Celery fork.
+workers = ThreadPoolExecutor(max_workers=os.cpu_count() or 4, thread_name_prefix="hdr")
+
+# tonemapper factory and gain of every gallery image
+tonemaps = {
+    "drago": (lambda: cv2.createTonemapDrago(1.0, 0.7), 3),
+    "reinhard": (lambda: cv2.createTonemapReinhard(1.5, 0, 0, 0), 1),
+    "mantiuk": (lambda: cv2.createTonemapMantiuk(2.2, 0.85, 1.2), 3),
+}
+
+
+class StageTimer:
+    """Wall time spent in each stage of the HDR pipeline, in seconds.
+    Stages running on several threads add up.
+
+    Args:
+        listener ([callable]): called with (event, data) for the progress
+                               events of the pipeline, e.g. a TaskEvents
+    """
+
+    def __init__(self, listener=None):
+        self.durations = {}
+        self.listener = listener
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def stage(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, time.perf_counter() - start)
+
+    def add(self, name, seconds):
+        with self._lock:
+            self.durations[name] = self.durations.get(name, 0.0) + seconds
+
+    def summary(self):
+        with self._lock:
+            return {name: round(seconds, 3) for name, seconds in self.durations.items()}
+
+    def event(self, name, **data):
+        """Reports a progress event with the stage durations so far."""
+        if self.listener is None:
+            return
+        try:
+            self.listener(name, dict(data, timings=self.summary()))
+        except Exception as e:
+            # the photo matters more than its progress report
+            logging.warning(f"cannot report the {name} event: {e}")
+
+
+# bumped when the calibration changes, curves of other versions are ignored
+CALIBRATION_VERSION = 1
+
+
+class ResponseStore:
+    """Camera response curves of the Debevec calibration, per sensor, ISO
+    and image size. The curve barely changes between shots with the same
+    settings, and the calibration is the most expensive step of a merge.
+
+    With a folder, the curves are saved as .npy files in
+    folder/v<CALIBRATION_VERSION>/ and shared by all Celery workers: a curve
+    rebuilt by another process is reloaded when its file changes.
+
+    Args:
+        folder ([str]): calibration folder, None to keep the curves in memory
+    """
+
+    def __init__(self, folder=None):
+        self.folder = folder
+        self._curves = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key(sensor, iso, shape):
+        return (str(sensor), str(iso), tuple(shape[:2]))
+
+    def path(self, key):
+        sensor, iso, (height, width) = key
+        name = re.sub(r"[^\w.-]+", "_", f"{sensor}_iso{iso}_{width}x{height}")
+        return os.path.join(self.folder, f"v{CALIBRATION_VERSION}", name + ".npy")
+
+    def get(self, key):
+        """Returns the stored curve of key, None if there is none."""
+        with self._lock:
+            cached = self._curves.get(key)
+        if self.folder is None:
+            return cached[0] if cached else None
+        try:
+            mtime = os.stat(self.path(key)).st_mtime
+        except FileNotFoundError:
+            return None
+        if cached and cached[1] == mtime:
+            return cached[0]
+        response = np.load(self.path(key))
+        with self._lock:
+            self._curves[key] = (response, mtime)
+        return response
+
+    def put(self, key, response):
+        mtime = None
+        if self.folder is not None:
+            path = self.path(key)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            # written aside and renamed, readers never see a partial file
+            with open(path + ".tmp", "wb") as tmp_file:
+                np.save(tmp_file, response)
+            os.replace(path + ".tmp", path)
+            mtime = os.stat(path).st_mtime
+        with self._lock:
+            self._curves[key] = (response, mtime)
+
+    def clear(self):
+        """Forgets the curves kept in memory (not the stored files)."""
+        with self._lock:
+            self._curves.clear()
+
+
+_stores = {}
+
+
+def response_store(folder=None):
+    """Returns the shared ResponseStore of a calibration folder."""
+    if folder not in _stores:
+        _stores[folder] = ResponseStore(folder)
+    return _stores[folder]
+
+
+def load_bracket(src, dest=None, timer=None):
+    """Decodes a bracket photo and moves it to dest (the raw folder).
+
+    Args:
+        src ([str]): captured file
+        dest ([str]): destination of the file, None to leave it
+        timer ([StageTimer]): timings to add the decoding to
+
+    Returns:
+        [np.array]: BGR image
+    """
+    timer = timer or StageTimer()
+    with timer.stage("decode"):
+        image = cv2.imread(src)
+    if image is None:
+        raise IOError(f"cannot read {src}")
+    if dest is not None:
+        shutil.move(src, dest)
+    return image
+
+
+def calibrate(images, times, key=None, timer=None, store=None, rebuild=False):
+    """Returns the camera response curve: the stored one if a curve is
+    known for key (see ResponseStore.key), otherwise calibrated on the
+    images and stored.
+
+    Args:
+        images ([list]): aligned BGR images of the brackets
+        times ([np.array]): exposure times in seconds (float32)
+        key ([tuple]): ResponseStore key, None to calibrate without storing
+        timer ([StageTimer]): timings to add the calibration to
+        store ([ResponseStore]): curve store, the in-memory one by default
+        rebuild ([bool]): calibrate and replace the stored curve
+    """
+    timer = timer or StageTimer()
+    store = store or response_store()
+    response = store.get(key) if key is not None and not rebuild else None
+    if response is not None:
+        return response
+    with timer.stage("calibrate"):
+        response = cv2.createCalibrateDebevec().process(images, times)
+    if key is not None:
+        store.put(key, response)
+    return response
+
+
+def tonemap(hdr, name, save_file, timer):
+    """Tonemaps the HDR image with one method and writes the JPEG."""
+    factory, gain = tonemaps[name]
+    with timer.stage(f"tonemap_{name}"):
+        ldr = factory().process(hdr)
+    with timer.stage(f"encode_{name}"):
+        cv2.imwrite(f"{save_file}_{name}.jpg", gain * ldr * 255)
+    timer.event("tonemapped", method=name, file=f"{save_file}_{name}.jpg")
+    return f"{save_file}_{name}.jpg"
+
+
+def merge_hdr(images, times, save_file, key=None, timer=None, store=None):
+    """Aligns and merges bracketed photos into an HDR image, and writes it
+    with its tonemapped versions. The HDR file and the tonemaps are written
+    in parallel.
+
+    Args:
+        images ([list]): BGR images of the brackets, aligned in place
+        times ([np.array]): exposure times in seconds (float32)
+        save_file ([str]): path of the gallery files without extension
+        key ([tuple]): ResponseStore key of the camera settings
+        timer ([StageTimer]): timings to add the stages to
+        store ([ResponseStore]): camera response curves
+
+    Returns:
+        [list]: written files
+    """
+    timer = timer or StageTimer()
+    times = np.asarray(times, dtype=np.float32)
+
+    logging.info("Align input images")
+    with timer.stage("align"):
+        cv2.createAlignMTB().process(images, images)
+    timer.event("aligned")
+
+    logging.info("Obtain Camera Response Function (CRF)")
+    response = calibrate(images, times, key, timer, store)
+
+    logging.info("Merge images into an HDR linear image")
+    with timer.stage("merge"):
+        hdr = cv2.createMergeDebevec().process(images, times, response)
+    timer.event("merged")
+
+    logging.info("Save HDR image and tonemaps")
+    with timer.stage("tonemap"):
+
+        def write_hdr():
+            with timer.stage("encode_hdr"):
+                cv2.imwrite(save_file + ".hdr", hdr)
+            return save_file + ".hdr"
+
+        jobs = [workers.submit(write_hdr)]
+        jobs += [
+            workers.submit(tonemap, hdr, name, save_file, timer) for name in tonemaps
+        ]
+        files = [job.result() for job in jobs]
+    timer.event("written", files=files)
+    return files
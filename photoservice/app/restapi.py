@@ -17,14 +17,14 @@ along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
 import os
 import sys
+import json
 import argparse
 import struct
 import cv2
-import exifread
 import time
-import subprocess
 import numpy as np
 import logging
+import redis
 from flask import Flask, render_template, Response, request, jsonify, url_for
 from celery import Celery
 from celery.result import AsyncResult
@@ -32,6 +32,18 @@ from os import listdir, makedirs, replace, remove
 from os.path import isfile, join
 import shutil 
 
+from camera import cameras, get_camera, read_exif
+from events import TaskEvents, history, subscribe
+from hdr import (
+    ResponseStore,
+    StageTimer,
+    calibrate,
+    load_bracket,
+    merge_hdr,
+    response_store,
+    workers,
+)
+
 app = Flask(__name__)
 app.config["CELERY_broker_url"] = "redis://{0}:6379/0".format(os.environ["HOST_REDIS"])
 app.config["result_backend"] = "redis://{0}:6379/0".format(os.environ["HOST_REDIS"])
@@ -39,8 +51,28 @@ app.config["result_backend"] = "redis://{0}:6379/0".format(os.environ["HOST_REDI
 celery = Celery(app.name, broker=app.config["CELERY_broker_url"])
 celery.conf.update(app.config)
 
+# progress events of the tasks, see events.py
+redis_client = redis.Redis.from_url(app.config["result_backend"])
+
+
+class EventTask(celery.Task):
+    """Task publishing its final event: done with the result, or failed."""
+
+    def events(self):
+        return TaskEvents(redis_client, self.request.id)
+
+    def on_success(self, retval, task_id, args, kwargs):
+        TaskEvents(redis_client, task_id).publish("done", retval)
+
+    def on_failure(self, exc, task_id, args, kwargs, einfo):
+        TaskEvents(redis_client, task_id).publish("failed", {"error": str(exc)})
+
+
 tmp_photo_folder = None
 save_photo_folder = None
+calib_photo_folder = None
+camera_backend = "picamera"
+camera_broker = "http://backend:5000"
 
 hdr_b = np.array([30, 25, 20, 15, 13, 10, 8, 6, 5, 4, 3.2, 2.5, 2, 1.6, 1.3, 1, 0.8, 0.6,
                   0.5, 0.4, 0.3, 1/4, 1/5, 1/6, 1/8, 1/10, 1/20, 1/25, 1/30, 1/40, 1/50, 1/60,
@@ -54,8 +86,46 @@ def find_nearest(array, value):
     idx = (np.abs(array - value)).argmin()
     return idx
 
-@celery.task()
-def process_photos(folders):
+
+def response_key(tags, iso, shape):
+    """ResponseStore key of a photo: camera model, ISO and image size."""
+    sensor = tags.get("Image Model", "unknown")
+    return ResponseStore.key(sensor, iso, shape)
+
+
+def load_folder(folder, dest=None, timer=None):
+    """Decodes the photos of a folder in parallel and reads their EXIF tags.
+
+    Returns:
+        [tuple]: images, exposure times and the EXIF tags of the first photo
+    """
+    timer = timer or StageTimer()
+    onlyfiles = sorted(
+        f for f in listdir(folder) if isfile(join(folder, f)) and f.endswith(".jpg")
+    )
+
+    def load(filename):
+        filesrc = folder + "/" + filename
+        with timer.stage("exif"):
+            tags = read_exif(filesrc)
+        exposure = float(tags["EXIF ExposureTime"].values[0])
+        filedest = dest + "/" + filename if dest is not None else None
+        return load_bracket(filesrc, filedest, timer), exposure, tags
+
+    loaded = list(workers.map(load, onlyfiles))
+    if not loaded:
+        raise IOError(f"no photos in {folder}")
+    images = [image for image, exposure, tags in loaded]
+    times = [exposure for image, exposure, tags in loaded]
+    return images, times, loaded[0][2]
+
+
+@celery.task(bind=True, base=EventTask)
+def process_photos(self, folders):
+    """Merges the photos of a folder (e.g. captured before) into an HDR image,
+    reading the exposure times from their EXIF tags."""
+    start = time.perf_counter()
+    timer = StageTimer(self.events())
     psave = folders["psave"]
     ptmp = folders["ptmp"]
     pgal = folders["pgal"]
@@ -65,61 +135,30 @@ def process_photos(folders):
     save_folder = psave + "/" + foldername
     makedirs(save_folder)
 
-    onlyfiles = [f for f in listdir(ptmp) if isfile(join(ptmp, f))]
-
-    images = []
-    times = np.array([], dtype=np.float32)
     logging.info("Loading images for HDR")
-    for filename in onlyfiles:
-        filesrc = ptmp + "/" + filename
-        filedest = save_folder + "/" + filename
-        shutil.move(filesrc, filedest)
-
-        file_data = open(filedest, 'rb')
-        tags = exifread.process_file(file_data)
-        exposure = float(tags['EXIF ExposureTime'].values[0])
-
-        im = cv2.imread(filedest)
-        images.append(im)
-        times = np.append(times, np.float32(exposure))
-
-    logging.info("Align input images")
-    align_MTB = cv2.createAlignMTB()
-    align_MTB.process(images, images)
-
-    logging.info('Obtain Camera Response Function (CRF)')
-    calibrate_debevec = cv2.createCalibrateDebevec()
-    response_debevec = calibrate_debevec.process(images, times)
-
-    logging.info('Merge images into an HDR linear image')
-    merge_debevec = cv2.createMergeDebevec()
-    hdr_debevec = merge_debevec.process(images, times, response_debevec)
-
-    logging.info('Save HDR image')
-    save_file = pgal + "/" + foldername 
-    cv2.imwrite(save_file + ".hdr", hdr_debevec)
-
-    logging.info("Tonemaping using Drago's method ... ")
-    tonemap_drago = cv2.createTonemapDrago(1.0, 0.7)
-    ldr_drago = tonemap_drago.process(hdr_debevec)
-    ldr_drago = 3 * ldr_drago
-    cv2.imwrite(save_file + "_drago.jpg", ldr_drago * 255)
-    
-    logging.info("Tonemaping using Reinhard's method ... ")
-    tonemap_reinhard = cv2.createTonemapReinhard(1.5, 0,0,0)
-    ldr_reinhard = tonemap_reinhard.process(hdr_debevec)
-    cv2.imwrite(save_file + "_reinhard.jpg", ldr_reinhard * 255)
-    
-    logging.info("Tonemaping using Mantiuk's method ... ")
-    tonemap_mantiuk = cv2.createTonemapMantiuk(2.2,0.85, 1.2)
-    ldr_mantiuk = tonemap_mantiuk.process(hdr_debevec)
-    ldr_mantiuk = 3 * ldr_mantiuk
-    cv2.imwrite(save_file + "_mantiuk.jpg", ldr_mantiuk * 255)
-
-
-@celery.task()
-def take_photo(parameters):
+    images, times, tags = load_folder(ptmp, save_folder, timer)
+    timer.event("loaded")
+    iso = tags.get("EXIF ISOSpeedRatings", "auto")
+
+    save_file = pgal + "/" + foldername
+    key = response_key(tags, iso, images[0].shape)
+    store = response_store(folders.get("pcalib"))
+    files = merge_hdr(images, times, save_file, key, timer, store)
+    timer.add("total", time.perf_counter() - start)
+    logging.info(f"HDR {foldername} ready: {timer.summary()}")
+    return {"files": files, "timings": timer.summary()}
+
+
+@celery.task(bind=True, base=EventTask)
+def take_photo(self, parameters):
+    """Captures the reference photo and the brackets in one camera session,
+    and merges them into an HDR image. The brackets are taken in a burst
+    with the gains of the reference photo, and every photo is decoded while
+    the next one is captured. The task state is CAPTURED once the camera is
+    free again. The progress events are published on Redis."""
     global hdr_b
+    start = time.perf_counter()
+    timer = StageTimer(self.events())
     # foto parameters
     aeb = parameters["aeb"]
     ev = parameters["ev"]
@@ -131,47 +170,105 @@ def take_photo(parameters):
     psave = parameters["psave"]
     pgal = parameters["pgal"]
 
-    logging.info("Taking a reference photo")
-    path_name = ptmp + "/0.jpg"
-    cmd = """raspistill -n -bm -r -ev {0} -ex {1} -ISO {2} -o {3} -tl 0 --thumb none""".format(ev, ex, iso, path_name)
-    subprocess.call(cmd, shell=True)
-
-    if aeb > 0:
-        logging.info("Getting parameters from reference photo")
-        file_data = open(path_name, 'rb')
-        tags = exifread.process_file(file_data)
-        exposure = float(tags['EXIF ExposureTime'].values[0])
-        idx = find_nearest(hdr_b, exposure)
-
-        delta_aeb = aeb + 1 # getting aeb from array
-
-        # getting exposure times
-        idx_m2 = idx - delta_aeb * 2
-        idx_m2 = idx_m2 if idx_m2 > 0 else 0
-        idx_m1 = idx - delta_aeb
-        idx_m1 = idx_m1 if idx_m1 > 0 else 0
-
-        idx_p2 = idx + delta_aeb * 2
-        idx_p2 = idx_p2 if idx_p2 < len(hdr_b) else len(hdr_b)
-        idx_p1 = idx + delta_aeb
-        idx_p1 = idx_p1 if idx_p1 < len(hdr_b) else len(hdr_b)
-
-        hdr_ss = [hdr_b[idx_m2] * 1e6, hdr_b[idx_m1] * 1e6, hdr_b[idx_p1] * 1e6, hdr_b[idx_p2] * 1e6]
-
-        for pic, hdr in enumerate(hdr_ss):
-            path_name = ptmp + "/{0}.jpg".format(pic + 1)
-            cmd = """raspistill -n -bm -r -ev {0} -ISO {1} -ss {2} -o {3} -tl 0 --thumb none""".format(ev, iso, hdr, path_name)
-            print(cmd)
-            subprocess.call(cmd, shell=True)
+    save_folder = psave + "/" + foldername
+    makedirs(save_folder)
 
-    folders = {
-                "psave": psave, 
-                "ptmp": ptmp, 
-                "pgal": pgal,
-                "foldername": foldername
-            }
+    def load(filename):
+        # decoded while the next photo is captured
+        return workers.submit(
+            load_bracket, ptmp + "/" + filename, save_folder + "/" + filename, timer
+        )
+
+    camera = get_camera(parameters.get("camera", "picamera"), parameters.get("broker"))
+    with timer.stage("camera_open"):
+        camera.open()
+    try:
+        logging.info("Taking a reference photo")
+        with timer.stage("capture"):
+            exposure = camera.capture(ptmp + "/0.jpg", None, iso, ev, ex)
+        loads = [load("0.jpg")]
+        times = [exposure]
+
+        if aeb > 0:
+            idx = find_nearest(hdr_b, exposure)
+
+            delta_aeb = aeb + 1  # getting aeb from array
+
+            # getting exposure times
+            idx_m2 = idx - delta_aeb * 2
+            idx_m2 = idx_m2 if idx_m2 > 0 else 0
+            idx_m1 = idx - delta_aeb
+            idx_m1 = idx_m1 if idx_m1 > 0 else 0
+
+            idx_p2 = idx + delta_aeb * 2
+            idx_p2 = idx_p2 if idx_p2 < len(hdr_b) else len(hdr_b)
+            idx_p1 = idx + delta_aeb
+            idx_p1 = idx_p1 if idx_p1 < len(hdr_b) else len(hdr_b)
+
+            hdr_ss = [hdr_b[idx_m2], hdr_b[idx_m1], hdr_b[idx_p1], hdr_b[idx_p2]]
+            paths = [ptmp + "/{0}.jpg".format(pic + 1) for pic in range(len(hdr_ss))]
+
+            with timer.stage("capture"):
+                for path_name, exposure in camera.burst(paths, hdr_ss, iso, ev):
+                    loads.append(load(os.path.basename(path_name)))
+                    times.append(exposure)
+    finally:
+        camera.close()
+
+    timer.add("shutter_to_captured", time.perf_counter() - start)
+    self.update_state(state="CAPTURED", meta={"timings": timer.summary()})
+    timer.event("captured")
+
+    images = [load.result() for load in loads]
+    save_file = pgal + "/" + foldername
+    key = ResponseStore.key(camera.sensor, iso, images[0].shape)
+    store = response_store(parameters.get("pcalib"))
+    files = merge_hdr(images, times, save_file, key, timer, store)
+    timer.add("total", time.perf_counter() - start)
+    logging.info(f"HDR {foldername} ready: {timer.summary()}")
+    return {"files": files, "timings": timer.summary()}
+
+
+@celery.task(base=EventTask)
+def calibrate_response(folders):
+    """Rebuilds the stored camera response curves from raw photo folders, e.g.
+    after a camera or firmware change. Merges keep the previous curve until the
+    new one is stored. Without foldernames, the newest raw folder of every
+    camera setting is used."""
+    psave = folders["psave"]
+    store = response_store(folders["pcalib"])
+    foldernames = folders.get("foldernames")
+    if not foldernames:
+        foldernames = sorted(
+            (
+                f
+                for f in listdir(psave)
+                if not isfile(join(psave, f)) and join(psave, f) != store.folder
+            ),
+            reverse=True,
+        )
+
+    rebuilt = {}
+    for foldername in foldernames:
+        timer = StageTimer()
+        try:
+            images, times, tags = load_folder(psave + "/" + foldername, timer=timer)
+        except (IOError, KeyError) as e:
+            logging.warning(f"cannot calibrate on {foldername}: {e}")
+            continue
+        iso = tags.get("EXIF ISOSpeedRatings", "auto")
+        key = response_key(tags, iso, images[0].shape)
+        if str(key) in rebuilt:
+            continue
+        with timer.stage("align"):
+            cv2.createAlignMTB().process(images, images)
+        calibrate(
+            images, np.asarray(times, dtype=np.float32), key, timer, store, rebuild=True
+        )
+        rebuilt[str(key)] = foldername
+        logging.info(f"calibrated {key} on {foldername}: {timer.summary()}")
+    return {"calibrations": rebuilt}
 
-    process_photos.delay(folders)
 
 @app.route("/api/takephoto")
 def api_take_photo():
@@ -189,12 +286,19 @@ def api_take_photo():
                     "iso": iso,
                     "ptmp": tmp_photo_folder,
                     "psave": save_photo_folder,
-                    "pgal": gallery_photo_folder
+                    "pgal": gallery_photo_folder,
+                    "pcalib": calib_photo_folder,
+                    "camera": camera_backend,
+                    "broker": camera_broker
                 }
 
     task = take_photo.delay(parameters)
 
-    data = {"task_id": url_for("taskstatus", task_id=task.id)}
+    data = {
+        "id": task.id,
+        "task_id": url_for("taskstatus", task_id=task.id),
+        "events": url_for("taskevents", task_id=task.id),
+    }
 
     return jsonify(data), 200
 
@@ -208,11 +312,33 @@ def api_hrd_photo():
     parameters = {  
                     "foldername": foldername, 
                     "ptmp": ptmp,
-                    "psave": psave
+                    "psave": psave,
+                    "pcalib": calib_photo_folder
                 }
 
     task = process_photos.delay(parameters)
 
+    data = {
+        "id": task.id,
+        "task_id": url_for("taskstatus", task_id=task.id),
+        "events": url_for("taskevents", task_id=task.id),
+    }
+
+    return jsonify(data), 200
+
+
+@app.route("/api/calibrate")
+def api_calibrate():
+    foldernames = request.args.getlist("foldername")
+
+    parameters = {
+        "foldernames": foldernames,
+        "psave": save_photo_folder,
+        "pcalib": calib_photo_folder,
+    }
+
+    task = calibrate_response.delay(parameters)
+
     data = {"task_id": url_for("taskstatus", task_id=task.id)}
 
     return jsonify(data), 200
@@ -227,6 +353,8 @@ def taskstatus(task_id):
         response = {
             "state": task.state,
         }
+        if isinstance(task.info, dict) and "timings" in task.info:
+            response["timings"] = task.info["timings"]
     else:
         response = {
             "state": task.state,
@@ -235,6 +363,48 @@ def taskstatus(task_id):
     return jsonify(response)
 
 
+@app.route("/events/<task_id>")
+def taskevents(task_id):
+    """Streams the progress events of a task as Server-Sent Events, from the
+    first one (or after Last-Event-ID when the client reconnects) until the
+    task is done or failed. Every event carries the stage durations so far.
+    A comment is sent every 15 s without events to keep the stream open."""
+    after = int(request.headers.get("Last-Event-ID", request.args.get("after", 0)))
+
+    def stream():
+        yield "retry: 1000\n\n"
+        for event in subscribe(redis_client, task_id, after):
+            if event is None:
+                yield ": keepalive\n\n"
+                continue
+            yield "id: {0}\nevent: {1}\ndata: {2}\n\n".format(
+                event["index"], event["event"], json.dumps(event)
+            )
+
+    return Response(
+        stream(),
+        mimetype="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+@app.route("/events/<task_id>/poll")
+def taskevents_poll(task_id):
+    """Long poll of the progress events of a task: returns the events after
+    the index after, waiting up to timeout seconds for the next one."""
+    after = request.args.get("after", 0, type=int)
+    timeout = min(request.args.get("timeout", 30, type=float), 60)
+
+    events = history(redis_client, task_id, after)
+    if not events:
+        for event in subscribe(redis_client, task_id, after, timeout):
+            if event is None:
+                continue
+            events = [event] + history(redis_client, task_id, event["index"])
+            break
+    return jsonify(events)
+
+
 if __name__ == "__main__":
     assert sys.version_info >= (3, 6), sys.version_info
 
@@ -243,6 +413,22 @@ if __name__ == "__main__":
     parser.add_argument("--ptmp", default="/mnt/ramdisk", help="folder for temp photos")
     parser.add_argument("--praw", default="/mnt/raw", help="folder to save raw photos")
     parser.add_argument("--pgallery", default="/mnt/gallery", help="folder to save gallery photos")
+    parser.add_argument(
+        "--pcalib",
+        default="/mnt/raw/calibration",
+        help="folder to store the camera response curves",
+    )
+    parser.add_argument(
+        "--camera",
+        default="picamera",
+        choices=list(cameras),
+        help="camera backend of the photos",
+    )
+    parser.add_argument(
+        "--broker",
+        default="http://backend:5000",
+        help="backend taking the photos with the broker camera",
+    )
     parser.add_argument("-v", "--verbose", action="store_true", help="set logging level to debug")
     
     args = parser.parse_args()
@@ -250,6 +436,9 @@ if __name__ == "__main__":
     tmp_photo_folder = args.ptmp
     save_photo_folder = args.praw
     gallery_photo_folder = args.pgallery
+    calib_photo_folder = args.pcalib
+    camera_backend = args.camera
+    camera_broker = args.broker
 
     app.run(
         host="0.0.0.0", debug=True, port=args.port, threaded=True, use_reloader=False
@@ -0,0 +1,77 @@
+"""
+Copyright (C) 2020 Mauro Riva
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+import cv2
+import numpy as np
+import pytest
+
+from camera import BrokerCamera, StandInCamera, read_exif, write_jpeg
+
+exifread = pytest.importorskip("exifread")
+
+
+class FakeResponse:
+    def __init__(self, content, headers):
+        self.content = content
+        self.headers = headers
+
+    def raise_for_status(self):
+        pass
+
+
+class FakeSession:
+    """Answers /api/still like the backend: a bare JPEG and the exposure
+    time in the headers."""
+
+    def __init__(self):
+        self.jpeg = cv2.imencode(".jpg", np.full((48, 64, 3), 128, np.uint8))[1]
+
+    def get(self, url, params=None, timeout=None):
+        shutter = params.get("shutter", 1 / 60)
+        headers = {"X-Exposure-Time": str(shutter), "X-Sensor": "RP_imx477"}
+        return FakeResponse(self.jpeg.tobytes(), headers)
+
+
+def test_written_tags_are_read_back(tmp_path):
+    path = str(tmp_path / "photo.jpg")
+    jpeg = cv2.imencode(".jpg", np.zeros((48, 64, 3), np.uint8))[1].tobytes()
+    write_jpeg(path, jpeg, 1 / 250, 400, "RP_imx477")
+    tags = read_exif(path)
+    assert str(tags["Image Model"]) == "RP_imx477"
+    assert float(tags["EXIF ExposureTime"].values[0]) == pytest.approx(1 / 250)
+    assert str(tags["EXIF ISOSpeedRatings"]) == "400"
+    assert cv2.imread(path).shape == (48, 64, 3)
+
+
+def test_broker_stills_carry_their_exposure(tmp_path):
+    camera = BrokerCamera()
+    camera.session = FakeSession()
+    path = str(tmp_path / "still.jpg")
+    assert camera.capture(path, shutter=0.5, iso="auto") == 0.5
+    tags = read_exif(path)
+    assert float(tags["EXIF ExposureTime"].values[0]) == 0.5
+    assert str(tags["Image Model"]) == "RP_imx477"
+    # automatic ISO is left out, as the response key falls back to "auto"
+    assert "EXIF ISOSpeedRatings" not in tags
+
+
+def test_standin_photos_carry_their_exposure(tmp_path):
+    camera = StandInCamera(shape=(96, 128), open_time=0, frame_time=0)
+    path = str(tmp_path / "standin.jpg")
+    with camera:
+        camera.capture(path, shutter=1 / 8)
+    assert float(read_exif(path)["EXIF ExposureTime"].values[0]) == 0.125
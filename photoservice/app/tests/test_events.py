@@ -0,0 +1,186 @@
+"""
+Copyright (C) 2020 Mauro Riva
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+import queue
+import threading
+import time
+
+import pytest
+
+from events import TaskEvents, history, subscribe
+
+
+class FakeRedis:
+    """In-memory stand-in for the Redis commands used by the events."""
+
+    def __init__(self):
+        self.lists = {}
+        self.counters = {}
+        self.channels = {}
+        self.lock = threading.Lock()
+
+    def incr(self, key):
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + 1
+            return self.counters[key]
+
+    def rpush(self, key, value):
+        with self.lock:
+            self.lists.setdefault(key, []).append(value.encode())
+            return len(self.lists[key])
+
+    def lrange(self, key, start, end):
+        with self.lock:
+            values = self.lists.get(key, [])
+            return values[start : len(values) if end == -1 else end + 1]
+
+    def expire(self, key, ttl):
+        pass
+
+    def publish(self, key, message):
+        with self.lock:
+            for messages in self.channels.get(key, []):
+                messages.put({"data": message.encode()})
+
+    def pipeline(self):
+        return FakePipeline(self)
+
+    def pubsub(self, ignore_subscribe_messages=False):
+        return FakePubSub(self)
+
+
+class FakePipeline:
+    def __init__(self, client):
+        self.client = client
+        self.commands = []
+
+    def __getattr__(self, name):
+        return lambda *args: self.commands.append((name, args))
+
+    def execute(self):
+        return [getattr(self.client, name)(*args) for name, args in self.commands]
+
+
+class FakePubSub:
+    def __init__(self, client):
+        self.client = client
+        self.messages = queue.Queue()
+
+    def subscribe(self, key):
+        with self.client.lock:
+            self.client.channels.setdefault(key, []).append(self.messages)
+
+    def get_message(self, timeout=0.0):
+        try:
+            return self.messages.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+    def close(self):
+        pass
+
+
+@pytest.fixture
+def client():
+    return FakeRedis()
+
+
+def names(events):
+    return [(event["index"], event["event"]) for event in events]
+
+
+def publish_later(events, stages, delay=0.02):
+    def run():
+        for name in stages:
+            time.sleep(delay)
+            events.publish(name)
+
+    thread = threading.Thread(target=run)
+    thread.start()
+    return thread
+
+
+def test_publish_numbers_the_events(client):
+    events = TaskEvents(client, "task")
+    first = events.publish("captured", {"timings": {"capture": 1.5}})
+    events("aligned")
+
+    assert first["index"] == 1 and first["timings"] == {"capture": 1.5}
+    assert names(history(client, "task")) == [(1, "captured"), (2, "aligned")]
+    assert names(history(client, "task", after=1)) == [(2, "aligned")]
+    assert history(client, "other") == []
+
+
+def test_publish_from_several_threads(client):
+    events = TaskEvents(client, "task")
+    threads = [
+        threading.Thread(target=lambda: [events("tonemapped") for _ in range(20)])
+        for _ in range(4)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert [event["index"] for event in history(client, "task")] == list(range(1, 81))
+
+
+def test_subscribe_until_the_final_event(client):
+    events = TaskEvents(client, "task")
+    events("captured")
+    thread = publish_later(events, ["aligned", "merged", "done", "late"])
+
+    received = names(subscribe(client, "task", timeout=5))
+    thread.join()
+    assert received == [(1, "captured"), (2, "aligned"), (3, "merged"), (4, "done")]
+
+
+def test_subscribe_resumes_after_an_index(client):
+    events = TaskEvents(client, "task")
+    for name in ("captured", "aligned", "merged"):
+        events(name)
+    thread = publish_later(events, ["written", "done"])
+
+    received = names(subscribe(client, "task", after=2, timeout=5))
+    thread.join()
+    assert received == [(3, "merged"), (4, "written"), (5, "done")]
+
+
+def test_subscribe_sends_keepalives_while_idle(client):
+    events = TaskEvents(client, "task")
+    thread = publish_later(events, ["captured", "done"], delay=0.25)
+
+    received = list(subscribe(client, "task", keepalive=0.1))
+    thread.join()
+    assert None in received
+    assert names(e for e in received if e is not None) == [(1, "captured"), (2, "done")]
+
+
+def test_subscribe_catches_up_with_missed_events(client):
+    events = TaskEvents(client, "task")
+    subscription = subscribe(client, "task", keepalive=0.05)
+    assert next(subscription) is None
+    # published without reaching the subscription
+    client.channels.clear()
+    events("captured")
+    assert names([next(subscription)]) == [(1, "captured")]
+
+
+def test_subscribe_timeout(client):
+    start = time.monotonic()
+    assert list(subscribe(client, "task", timeout=0.1, keepalive=1.0)) == []
+    assert time.monotonic() - start < 1.0
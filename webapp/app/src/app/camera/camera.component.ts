@@ -254,6 +254,11 @@ export class CameraComponent implements OnInit {
       this.cameraService.takePhoto(this.photoConfig).subscribe((photoStatus) => {
         console.info('Photo filename:', photoStatus);
         this.updateGui()
+        if (photoStatus.events) {
+          this.cameraService.getPhotoEvents(photoStatus).subscribe((photoEvent) => {
+            console.info('Photo ' + photoEvent.event + ':', photoEvent.timings);
+          });
+        }
       });
     }
 
@@ -26,7 +26,10 @@ import {
     FocusConfig,
     FocusStatus,
     ObjectConfig,
-    PhotoConfig
+    PhotoConfig,
+    PhotoEvent,
+    PhotoStatus,
+    PHOTO_EVENTS
 } from "./types";
 
 const SERVER_URL: string = 'api/';
@@ -66,11 +69,28 @@ export class CameraService {
     }
 
 
-    public takePhoto(config: PhotoConfig[]): Observable<String> {
+    public takePhoto(config: PhotoConfig[]): Observable<PhotoStatus> {
         var requestUrl = `${SERVER_URL}takephoto?ev=${config[0].ev}&ex=${config[0].exposure}&iso=${config[0].iso}&aeb=${config[0].aeb}`
         return this.http.get(requestUrl).map((res) => res.json());
     }
 
+    // one subscription per photo instead of polling its status
+    public getPhotoEvents(photoStatus: PhotoStatus): Observable<PhotoEvent> {
+        return new Observable<PhotoEvent>((observer) => {
+            var source = new EventSource(photoStatus.events);
+            var onEvent = (message: MessageEvent) => {
+                var photoEvent: PhotoEvent = JSON.parse(message.data);
+                observer.next(photoEvent);
+                if (photoEvent.event == "done" || photoEvent.event == "failed") {
+                    source.close();
+                    observer.complete();
+                }
+            };
+            PHOTO_EVENTS.forEach((name) => source.addEventListener(name, onEvent));
+            return () => source.close();
+        });
+    }
+
     public setFocusFrame(frame: FocusConfig[]): Observable<FocusConfig[]> {
         if ((frame[0].frame_x + frame[0].frame_w) > this.CAM_WIDTH) {
             frame[0].frame_w = this.CAM_WIDTH - frame[0].frame_x;
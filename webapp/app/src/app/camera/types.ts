@@ -37,8 +37,21 @@ export class PhotoConfig {
 
 export class PhotoStatus {
     filename: string = "";
+    events: string = "";
 }
 
+export class PhotoEvent {
+    index: number = 0;
+    event: string = "";
+    time: number = 0;
+    timings: { [stage: string]: number } = {};
+}
+
+// progress events of a photo, streamed by the backend
+export const PHOTO_EVENTS: string[] = [
+    "captured", "loaded", "aligned", "merged", "tonemapped", "written", "done", "failed"
+];
+
 export class FocusStatus {
     mode: number = 0;
     focus_phase: number = 0;